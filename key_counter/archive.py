@@ -0,0 +1,302 @@
+"""Append-only binary columnar archive of pushed data packets.
+
+An archive is made of two files. The data file starts with a header, followed
+by blocks, each one a kind byte, a payload length and the payload:
+
+    "KCA" | version (1 byte)
+    "U" | length (4 bytes) | first id (4 bytes) | users (4 bytes)
+        | name length (2 bytes) | name (UTF-8) | ...
+    "T" | length (4 bytes) | timestamp (8 bytes, double) | users (4 bytes)
+        | ids width (1 byte) | values width (1 byte)
+        | user ids (ascending) | values
+
+User ("U") blocks assign consecutive ids to users not seen before, tick ("T")
+blocks hold the values of a packet as two arrays, ids and values. Each array
+uses the narrowest width (1, 2 or 4 bytes) fitting its largest number.
+
+The index file ("<data file>.idx") holds, for each tick block, its timestamp
+and its offset in the data file (8 bytes each). All numbers are little-endian.
+
+The reader memory-maps both files, so a user's time series, or a time range,
+are read without parsing the whole archive.
+"""
+import bisect
+import mmap
+import struct
+import os
+
+MAGIC = 'KCA\x01'
+USERS_BLOCK = 'U'
+TICK_BLOCK = 'T'
+
+_BLOCK_HEADER = struct.Struct('<cI')
+_USERS_HEADER = struct.Struct('<II')
+_NAME_LENGTH = struct.Struct('<H')
+_TICK_HEADER = struct.Struct('<dIBB')
+_INDEX_RECORD = struct.Struct('<dQ')
+# Struct codes for the array widths.
+_CODES = {1: 'B', 2: 'H', 4: 'I'}
+_ITEMS = dict((width, struct.Struct('<' + code))
+              for width, code in _CODES.items())
+
+# Largest value a tick block can hold.
+MAX_VALUE = 0xFFFFFFFF
+
+
+def _index_name(file_name):
+    return "%s.idx" % file_name
+
+
+def _map(file_name):
+    "Memory-map a whole file for reading, or return '' if it is empty."
+    with open(file_name, 'rb') as mapped:
+        if os.fstat(mapped.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _scan(data):
+    """Yield (kind, payload offset, payload length) for each complete block
+    in the data, after the header.
+    """
+    offset = len(MAGIC)
+    while offset + _BLOCK_HEADER.size <= len(data):
+        kind, length = _BLOCK_HEADER.unpack_from(data, offset)
+        start = offset + _BLOCK_HEADER.size
+        if start + length > len(data):
+            # Truncated block, from an interrupted write.
+            break
+        yield kind, start, length
+        offset = start + length
+
+
+def _width(largest):
+    "Return the narrowest array width fitting the largest number."
+    if largest <= 0xFF:
+        return 1
+    if largest <= 0xFFFF:
+        return 2
+    return 4
+
+
+def _read_users(data, offset):
+    "Return the first id and the list of names in a users block."
+    first_id, count = _USERS_HEADER.unpack_from(data, offset)
+    offset += _USERS_HEADER.size
+    names = []
+    for _ in xrange(count):
+        length, = _NAME_LENGTH.unpack_from(data, offset)
+        offset += _NAME_LENGTH.size
+        names.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return first_id, names
+
+
+class _Column (object):
+    "A read-only sequence of fixed-size numbers in a buffer, for bisect."
+
+    def __init__(self, data, offset, size, item):
+        self.data = data
+        self.offset = offset
+        self.size = size
+        self.item = item
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.item.unpack_from(self.data,
+                                     self.offset + i * self.item.size)[0]
+
+
+###############################################################################
+
+class ArchiveWriter (object):
+    "Append data packets to an archive, creating it if needed."
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # Ids of the users already in the archive.
+        self._ids = {}
+        end = self._load()
+        self._data = open(file_name, 'r+b' if end else 'wb')
+        if end:
+            # Drop whatever an interrupted write left.
+            self._data.truncate(end)
+            self._data.seek(end)
+        else:
+            self._data.write(MAGIC)
+            self._data.flush()
+        self._index = open(_index_name(file_name), 'ab')
+
+    def _load(self):
+        """Read the users of an existing archive, and rebuild its index if
+        needed. Return the offset where the complete blocks end, or 0 if
+        there is no archive.
+        """
+        if not os.path.exists(self.file_name):
+            return 0
+        data = _map(self.file_name)
+        if not data:
+            return 0
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not an archive.' % self.file_name)
+        end = len(MAGIC)
+        index = []
+        for kind, offset, length in _scan(data):
+            if kind == USERS_BLOCK:
+                first_id, names = _read_users(data, offset)
+                self._ids.update(
+                    (name, first_id + i) for i, name in enumerate(names))
+            elif kind == TICK_BLOCK:
+                timestamp = _TICK_HEADER.unpack_from(data, offset)[0]
+                index.append(_INDEX_RECORD.pack(timestamp,
+                                                offset - _BLOCK_HEADER.size))
+            end = offset + length
+        data.close()
+        with open(_index_name(self.file_name), 'wb') as index_file:
+            index_file.write(''.join(index))
+        return end
+
+    def _write_block(self, kind, payload):
+        "Append a block, and return its offset."
+        offset = self._data.tell()
+        self._data.write(_BLOCK_HEADER.pack(kind, len(payload)))
+        self._data.write(payload)
+        return offset
+
+    def write(self, timestamp, packet):
+        "Append a packet (a user to value mapping) taken at timestamp."
+        new_users = [user for user in packet if user not in self._ids]
+        if new_users:
+            first_id = len(self._ids)
+            chunks = [_USERS_HEADER.pack(first_id, len(new_users))]
+            for user in new_users:
+                name = user.encode('utf-8')
+                chunks.append(_NAME_LENGTH.pack(len(name)))
+                chunks.append(name)
+            self._write_block(USERS_BLOCK, ''.join(chunks))
+            # Only once written, so ids always match the names on disk.
+            self._ids.update((user, first_id + i)
+                             for i, user in enumerate(new_users))
+
+        ids = self._ids
+        rows = sorted((ids[user], min(value, MAX_VALUE))
+                      for user, value in packet.iteritems())
+        count = len(rows)
+        user_ids = [row[0] for row in rows]
+        values = [row[1] for row in rows]
+        ids_width = _width(user_ids[-1] if rows else 0)
+        values_width = _width(max(values) if rows else 0)
+        payload = (_TICK_HEADER.pack(timestamp, count, ids_width,
+                                     values_width)
+                   + struct.pack('<%d%s' % (count, _CODES[ids_width]),
+                                 *user_ids)
+                   + struct.pack('<%d%s' % (count, _CODES[values_width]),
+                                 *values))
+        offset = self._write_block(TICK_BLOCK, payload)
+        # The index goes last, so it never points past the data.
+        self._data.flush()
+        self._index.write(_INDEX_RECORD.pack(timestamp, offset))
+        self._index.flush()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+class ArchiveReader (object):
+    """Read an archive, as of the time it is opened.
+
+    Timestamps are those of the packets; time ranges include their start and
+    exclude their end.
+    """
+
+    def __init__(self, file_name):
+        self._data = _map(file_name)
+        if self._data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not an archive.' % file_name)
+        # Names by id, None for ids without one.
+        self._names = []
+        for kind, offset, length in _scan(self._data):
+            if kind == USERS_BLOCK:
+                first_id, names = _read_users(self._data, offset)
+                end = first_id + len(names)
+                if end > len(self._names):
+                    self._names.extend([None] * (end - len(self._names)))
+                self._names[first_id:end] = names
+        self._ids = dict((name, i) for i, name in enumerate(self._names)
+                         if name is not None)
+
+        self._index = _map(_index_name(file_name))
+        count = len(self._index) // _INDEX_RECORD.size
+        self._timestamps = _Column(self._index, 0, count,
+                                   struct.Struct('<d8x'))
+        self._offsets = _Column(self._index, 0, count,
+                                struct.Struct('<8xQ'))
+
+    def __len__(self):
+        "The number of packets in the archive."
+        return len(self._timestamps)
+
+    def users(self):
+        "Return the list of users in the archive."
+        return [name for name in self._names if name is not None]
+
+    def _range(self, start, end):
+        "Return the range of packet positions between start and end."
+        first, last = 0, len(self._timestamps)
+        if start is not None:
+            first = bisect.bisect_left(self._timestamps, start)
+        if end is not None:
+            last = bisect.bisect_left(self._timestamps, end)
+        return xrange(first, last)
+
+    def _tick(self, position):
+        """Return the timestamp, size, and arrays (offset and width of each)
+        of a tick block.
+        """
+        offset = self._offsets[position] + _BLOCK_HEADER.size
+        timestamp, count, ids_width, values_width = \
+            _TICK_HEADER.unpack_from(self._data, offset)
+        ids_offset = offset + _TICK_HEADER.size
+        values_offset = ids_offset + count * ids_width
+        return (timestamp, count, ids_offset, ids_width, values_offset,
+                values_width)
+
+    def packets(self, start=None, end=None):
+        "Yield (timestamp, packet) pairs, in order, for a time range."
+        data, names = self._data, self._names
+        for position in self._range(start, end):
+            (timestamp, count, ids_offset, ids_width, values_offset,
+             values_width) = self._tick(position)
+            ids = struct.unpack_from('<%d%s' % (count, _CODES[ids_width]),
+                                     data, ids_offset)
+            values = struct.unpack_from(
+                '<%d%s' % (count, _CODES[values_width]), data, values_offset)
+            yield timestamp, dict((names[i], value)
+                                  for i, value in zip(ids, values))
+
+    def series(self, user, start=None, end=None):
+        """Return the list of (timestamp, value) pairs of a user, for a time
+        range. Packets without the user are skipped.
+        """
+        user_id = self._ids.get(user)
+        if user_id is None:
+            return []
+        series = []
+        for position in self._range(start, end):
+            (timestamp, count, ids_offset, ids_width, values_offset,
+             values_width) = self._tick(position)
+            ids = _Column(self._data, ids_offset, count, _ITEMS[ids_width])
+            i = bisect.bisect_left(ids, user_id)
+            if i < count and ids[i] == user_id:
+                value, = _ITEMS[values_width].unpack_from(
+                    self._data, values_offset + i * values_width)
+                series.append((timestamp, value))
+        return series
+
+    def close(self):
+        for mapped in (self._data, self._index):
+            if mapped:
+                mapped.close()
@@ -0,0 +1,28 @@
+"""A monotonic clock, for measuring time intervals.
+
+Python 2 lacks time.monotonic(), so CLOCK_MONOTONIC is read through libc.
+"""
+import ctypes
+import ctypes.util
+import os
+
+try:
+    from time import monotonic
+except ImportError:
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long),
+                    ('tv_nsec', ctypes.c_long)]
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _clock_gettime = _libc.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        "Return the value (in seconds) of a clock that never goes back."
+        spec = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
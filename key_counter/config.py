@@ -2,6 +2,8 @@ import gevent
 import json
 import gevent_inotifyx as inotify
 from core import PushStrategy
+from groups import validate_groups
+from filters import PacketFilter, ChangeFilter
 
 import logging
 logger = logging.getLogger('config')
@@ -68,11 +70,23 @@ class ConfigManager (object):
     upstream. The "options" dict in each dict is free form, should be defined
     per each type of upstream, and should contain the minimum possible to
     configure that type.
+
+    The config object may also be a dict, with that list as "upstreams", and
+    the groups of users as "groups", a mapping from group name to the list of
+    its users (see the "level" upstream option):
+
+    {
+        "upstreams": [...],
+        "groups": {
+            (group name): [(user name), ...]
+        }
+    }
     """
 
     def __init__(self, pusher, config=None):
         # Successful configuration is kept, keyed by inner upstream "name".
         self._config = {}
+        self._groups = None
 
         # Reconfiguration will affect the single pusher object.
         self.pusher = pusher
@@ -94,10 +108,27 @@ class ConfigManager (object):
             types = ', '.join(PushStrategy.PUSH_TYPES)
             raise ValueError('invalid "type" entry in upstream config. Should '
                              'be one of %s.' % types)
-        logger.debug("Normalized: %s" % upstream)
+        if not isinstance(upstream["options"], dict):
+            raise ValueError('"options" entry in upstream config must be an '
+                             'object.')
+        # Raise on bad filter options before touching the upstreams.
+        options = dict(upstream["options"])
+        PacketFilter.from_options(options)
+        ChangeFilter.from_options(options)
+        logger.debug("Normalized: %s", upstream)
         return upstream
 
     def reconfigure(self, config):
+        groups = None
+        if isinstance(config, dict):
+            groups = config.get('groups')
+            if groups is not None:
+                validate_groups(groups)
+            config = config.get('upstreams', [])
+        if groups != self._groups:
+            logger.debug("Updated groups of users.")
+            self.pusher.set_groups(groups)
+            self._groups = groups
         new_names = []
         for raw_upstream in config:
             upstream = self._normalize_upstream(raw_upstream)
@@ -120,7 +151,7 @@ class ConfigManager (object):
             if name in names_to_keep:
                 new_config[name] = self._config[name]
             else:
-                logger.debug('Removing unused upstream "%s"' % name)
+                logger.debug('Removing unused upstream "%s"', name)
                 self.pusher.remove_upstream(name)
         self._config = new_config
 
@@ -130,7 +161,7 @@ class ConfigManager (object):
         options = upstream_config["options"]
         self.pusher.add_upstream(name, _type, **options)
         self._config[name] = upstream_config
-        logger.debug('Added config for upstream "%s"' % name)
+        logger.debug('Added config for upstream "%s"', name)
 
     def _update_upstream(self, upstream_config):
         name = upstream_config["name"]
@@ -140,7 +171,7 @@ class ConfigManager (object):
         new_options = upstream_config["options"]
 
         if old_type != new_type or old_options != new_options:
-            logger.debug('Updated config for upstream "%s"' % name)
+            logger.debug('Updated config for upstream "%s"', name)
             del self._config[name]
             self.pusher.remove_upstream(name)
             self.pusher.add_upstream(name, new_type, **new_options)
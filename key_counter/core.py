@@ -1,17 +1,116 @@
 from gevent.server import DatagramServer
+from gevent import socket
+from itertools import izip
+from array import array
 import gevent
+import gevent.event
+import threading
+import random
+import heapq
 import json
+import time
+import zlib
+import os
+
+from timeseries import TimeSeriesStore, DEFAULT_WINDOWS
+from leaderboard import Leaderboard, top_packet
+from groups import GroupRollup, group_packet
+from filters import PacketFilter, ChangeFilter
+import groups as group_stats
+from clock import monotonic
+import protocol
+import metrics
 
 import logging
 
+# NumPy is optional, only used to compute kpm values in bulk.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# zstandard is optional, only used to compress pushed data.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Typecode for arrays of key counts. Python 2 arrays lack 'q', but 'l' is a
+# 64 bits signed integer on the LP64 platforms we run on.
+COUNT_TYPECODE = 'l'
+
+# Python 2 does not expose SO_REUSEPORT, this is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Instrumentation, see the metrics module.
+DATAGRAMS_RECEIVED = metrics.REGISTRY.counter(
+    'key_counter_datagrams_received_total', 'Datagrams received.')
+DATAGRAMS_REJECTED = metrics.REGISTRY.counter(
+    'key_counter_datagrams_rejected_total',
+    'Datagrams received but ignored, as malformed.')
+TICK_USERS = metrics.REGISTRY.histogram(
+    'key_counter_tick_users', 'Users in each data packet.',
+    buckets=(10, 100, 1000, 10000, 100000, 1000000))
+PACKET_SECONDS = metrics.REGISTRY.histogram(
+    'key_counter_packet_seconds', 'Time taken to compute each data packet.')
+PUSH_SECONDS = metrics.REGISTRY.histogram(
+    'key_counter_push_seconds', 'Time taken by each push, per upstream.',
+    label='upstream')
+USERS_EVICTED = metrics.REGISTRY.counter(
+    'key_counter_users_evicted_total',
+    'Users forgotten, as idle for too long ("ttl") or to make room ("lru").',
+    label='reason')
+RECORDS_REJECTED = metrics.REGISTRY.counter(
+    'key_counter_records_rejected_total',
+    'Records of new users ignored, as too many users are tracked.')
+TICK_OVERRUNS = metrics.REGISTRY.counter(
+    'key_counter_tick_overruns_total',
+    'Ticks skipped, as the previous ones took too long.')
+
 
 ###############################################################################
 
+class DataPacket (dict):
+    """A data packet, mapping user names to computed values.
+
+    The pusher stamps each packet with the (wall clock) time it was taken at,
+    and the seconds elapsed since the previous one was taken. If an upstream
+    asked for them, the rolling windows of the values pushed so far are in
+    timeseries (see TimeSeriesStore), and the ranking of the users in
+    leaderboard (see Leaderboard). The statistics of each group of users, if
+    groups are defined, are in groups (see GroupRollup).
+    """
+    timestamp = None
+    elapsed = None
+    timeseries = None
+    leaderboard = None
+    groups = None
+
+
+# What to do with a new user once max_users are tracked.
+POLICY_REJECT = 'reject'    # Ignore its records.
+POLICY_SAMPLE = 'sample'    # Track it with a probability, else reject it.
+POLICY_LRU = 'lru'          # Forget the least recently updated users.
+POLICIES = [POLICY_REJECT, POLICY_SAMPLE, POLICY_LRU]
+
+
 class NumbersManager:
-    "Collect user counts and provides collected computed values."
+    """Collect user counts and provides collected computed values.
 
-    def __init__(self):
+    Users are tracked for a packet only, and the one after (to compute their
+    values). Up to max_users users are aggregated per packet, if given, the
+    records of new users beyond are rejected, or sampled (see POLICIES).
+    """
+
+    def __init__(self, max_users=None, policy=POLICY_REJECT, sample=0.01):
+        if policy not in (POLICY_REJECT, POLICY_SAMPLE):
+            raise ValueError('Policy "%s" not known.' % policy)
+        self.max_users = max_users
+        self.policy = policy
+        self.sample = sample
         self.compute = None
+        # Optional compute() for many (old, new) pairs at once.
+        self.compute_batch = None
         # Buffer for previous data, used to compute new values.
         self.stashed_data = {}
         # Mapping from user name to previous key count.
@@ -24,8 +123,36 @@ class NumbersManager:
         Repeated entries (different counts for the same user) are possible, but
         only the latest is retained.
         """
+        if (self.max_users is not None and user not in self.aggregated
+                and len(self.aggregated) >= self.max_users
+                and not self._admit()):
+            RECORDS_REJECTED.inc()
+            return
         self.aggregated[user] = count
 
+    def _admit(self):
+        "Return whether to aggregate a new user, beyond max_users."
+        return self.policy == POLICY_SAMPLE and random.random() < self.sample
+
+    def aggregate_batch(self, records):
+        """Aggregate data as an iterable of (user, count) pairs.
+
+        Same as calling aggregate_user_data() for each pair, in order.
+        """
+        if self.max_users is None:
+            self.aggregated.update(records)
+            return
+        for user, count in records:
+            self.aggregate_user_data(user, count)
+
+    def pop_aggregated(self):
+        """Return the data aggregated so far, as a user to count mapping, and
+        drop it without computing any value.
+        """
+        aggregated = self.aggregated
+        self.aggregated = {}
+        return aggregated
+
     def get_data_packet(self):
         """Return the data packet and a token to it.
 
@@ -36,11 +163,19 @@ class NumbersManager:
         used to produce a value.
         """
         # Only aggregated users will be in the packet.
-        packet = {user: 0 for user in self.aggregated}
-        for user, count in self.aggregated.items():
-            if user in self.stashed_data:
-                # With previously collected data compute value to send.
-                packet[user] = self.compute(self.stashed_data[user], count)
+        aggregated, stashed = self.aggregated, self.stashed_data
+        packet = DataPacket.fromkeys(aggregated, 0)
+        if self.compute_batch is not None:
+            # With previously collected data compute values to send, at once.
+            users = [user for user in aggregated if user in stashed]
+            values = self.compute_batch([stashed[user] for user in users],
+                                        [aggregated[user] for user in users])
+            packet.update(izip(users, values))
+        else:
+            for user, count in aggregated.iteritems():
+                if user in stashed:
+                    # With previously collected data compute value to send.
+                    packet[user] = self.compute(stashed[user], count)
 
         self.stashed_data = self.aggregated
         self.aggregated = {}
@@ -48,6 +183,294 @@ class NumbersManager:
         return packet
 
 
+class InternedNumbersManager (object):
+    """Collect user counts as NumbersManager does, with array-backed storage.
+
+    Each user name is interned to a dense integer slot the first time it is
+    seen. Current and previous counts live in preallocated typed arrays, and
+    the slots touched since the last packet are tracked with a dirty bitmap
+    (plus the list of those slots, to avoid scanning the whole bitmap).
+
+    Users without data for ttl packets are forgotten, if given, and their
+    slots reused (idle users are looked for every ttl packets). Up to
+    max_users users are tracked, if given, beyond that the policy (see
+    POLICIES) says what to do with new users. With "lru", and "sample" for
+    the sampled users, the least recently updated users are forgotten, in
+    batches of max_users / 16.
+    """
+
+    def __init__(self, capacity=1024, ttl=None, max_users=None,
+                 policy=POLICY_LRU, sample=0.01):
+        if policy not in POLICIES:
+            raise ValueError('Policy "%s" not known.' % policy)
+        self.ttl = ttl
+        self.max_users = max_users
+        self.policy = policy
+        self.sample = sample
+        self.compute = None
+        self.compute_batch = None
+        # User name to slot, and slot to user name (None for free slots).
+        self._slots = {}
+        self._names = []
+        self._free = []
+        # Number of the packet being aggregated, and the packet each slot
+        # was last aggregated for.
+        self._packet = 1
+        self._seen = array(COUNT_TYPECODE, [0]) * capacity
+        # Counts aggregated since the last packet, and counts of the previous
+        # packet, indexed by slot.
+        self._current = array(COUNT_TYPECODE, [0]) * capacity
+        self._previous = array(COUNT_TYPECODE, [0]) * capacity
+        # Slots aggregated since the last packet (the dirty bitmap), and slots
+        # aggregated for the previous packet.
+        self._dirty = bytearray(capacity)
+        self._stashed = bytearray(capacity)
+        self._touched = []
+        self._stashed_slots = []
+
+    def _intern(self, user):
+        "Return a new slot for user, growing the storage if needed."
+        if self._free:
+            slot = self._free.pop()
+            self._names[slot] = user
+            self._slots[user] = slot
+            return slot
+        slot = len(self._names)
+        if slot == len(self._current):
+            # Double the capacity.
+            self._current.extend(array(COUNT_TYPECODE, [0]) * slot)
+            self._previous.extend(array(COUNT_TYPECODE, [0]) * slot)
+            self._seen.extend(array(COUNT_TYPECODE, [0]) * slot)
+            self._dirty.extend(bytearray(slot))
+            self._stashed.extend(bytearray(slot))
+        self._slots[user] = slot
+        self._names.append(user)
+        return slot
+
+    def _evict(self, slots, reason):
+        "Forget the users of slots, none of them aggregated for this packet."
+        names, stashed = self._names, self._stashed
+        for slot in slots:
+            del self._slots[names[slot]]
+            names[slot] = None
+            # Left in _stashed_slots, cleared on the next packet.
+            stashed[slot] = 0
+        self._free.extend(slots)
+        USERS_EVICTED.labels(reason).inc(len(slots))
+
+    def _make_room(self):
+        "Return whether a new user can be tracked, forgetting others first."
+        if self.policy == POLICY_REJECT:
+            return False
+        if self.policy == POLICY_SAMPLE and random.random() >= self.sample:
+            return False
+        seen, packet = self._seen, self._packet
+        # Users aggregated for this packet are kept.
+        candidates = [slot for slot in self._slots.itervalues()
+                      if seen[slot] < packet]
+        if not candidates:
+            return False
+        self._evict(heapq.nsmallest(max(1, self.max_users // 16),
+                                    candidates, key=seen.__getitem__), 'lru')
+        return True
+
+    @property
+    def aggregated(self):
+        "Mapping from user name to the count aggregated since last packet."
+        names, current = self._names, self._current
+        return dict((names[slot], current[slot]) for slot in self._touched)
+
+    @property
+    def stashed_data(self):
+        "Mapping from user name to the count used for the previous packet."
+        names, previous, stashed = self._names, self._previous, self._stashed
+        return dict((names[slot], previous[slot])
+                    for slot in self._stashed_slots if stashed[slot])
+
+    def aggregate_user_data(self, user, count):
+        """Aggregate data as a (user, count) pair.
+
+        Repeated entries (different counts for the same user) are possible, but
+        only the latest is retained.
+        """
+        slot = self._slots.get(user)
+        if slot is None:
+            if (self.max_users is not None
+                    and len(self._slots) >= self.max_users
+                    and not self._make_room()):
+                RECORDS_REJECTED.inc()
+                return
+            slot = self._intern(user)
+        self._current[slot] = count
+        self._seen[slot] = self._packet
+        if not self._dirty[slot]:
+            self._dirty[slot] = 1
+            self._touched.append(slot)
+
+    def aggregate_batch(self, records):
+        """Aggregate data as an iterable of (user, count) pairs.
+
+        Same as calling aggregate_user_data() for each pair, in order.
+        """
+        for user, count in records:
+            self.aggregate_user_data(user, count)
+
+    def get_data_packet(self):
+        """Return the data packet, as NumbersManager.get_data_packet() does."""
+        names = self._names
+        current, previous = self._current, self._previous
+        dirty, stashed = self._dirty, self._stashed
+        touched = self._touched
+
+        # Only aggregated users will be in the packet.
+        packet = DataPacket.fromkeys([names[slot] for slot in touched], 0)
+        # With previously collected data compute values to send.
+        slots = [slot for slot in touched if stashed[slot]]
+        if self.compute_batch is not None:
+            values = self.compute_batch([previous[slot] for slot in slots],
+                                        [current[slot] for slot in slots])
+            packet.update(izip([names[slot] for slot in slots], values))
+        else:
+            for slot in slots:
+                packet[names[slot]] = self.compute(previous[slot],
+                                                   current[slot])
+
+        # Aggregated counts become the previous ones.
+        for slot in self._stashed_slots:
+            stashed[slot] = 0
+        for slot in touched:
+            previous[slot] = current[slot]
+            stashed[slot] = 1
+            dirty[slot] = 0
+        self._stashed_slots = touched
+        self._touched = []
+
+        if self.ttl and self._packet % self.ttl == 0:
+            idle = self._packet - self.ttl
+            seen = self._seen
+            self._evict([slot for slot in self._slots.itervalues()
+                         if seen[slot] <= idle], 'ttl')
+        self._packet += 1
+
+        return packet
+
+
+class _Shard (object):
+    "The counts of the users of a shard, and the lock guarding them."
+
+    __slots__ = ('lock', 'aggregated', 'stashed')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aggregated = {}
+        self.stashed = {}
+
+
+class ShardedNumbersManager (object):
+    """Collect user counts as NumbersManager does, partitioned in shards by
+    the hash of the user name, so many OS threads can aggregate at once.
+
+    Each shard double buffers: writers update its aggregated dict under the
+    shard lock, and taking a packet swaps that dict for an empty one under
+    the same lock. Locks are only held for a dict update, or a swap, so
+    taking a packet never waits for writers (nor they for it) longer, and no
+    write is lost: it lands either before the swap, or after it.
+
+    Packets (and pop_aggregated()) are to be taken from one thread only.
+    """
+
+    def __init__(self, shards=16):
+        self.compute = None
+        self.compute_batch = None
+        self._shards = [_Shard() for _ in xrange(shards)]
+
+    def _shard(self, user):
+        return self._shards[hash(user) % len(self._shards)]
+
+    @property
+    def aggregated(self):
+        "Mapping from user name to the count aggregated since last packet."
+        aggregated = {}
+        for shard in self._shards:
+            with shard.lock:
+                aggregated.update(shard.aggregated)
+        return aggregated
+
+    @property
+    def stashed_data(self):
+        "Mapping from user name to the count used for the previous packet."
+        stashed = {}
+        for shard in self._shards:
+            stashed.update(shard.stashed)
+        return stashed
+
+    def aggregate_user_data(self, user, count):
+        """Aggregate data as a (user, count) pair.
+
+        Repeated entries (different counts for the same user) are possible, but
+        only the latest is retained.
+        """
+        shard = self._shard(user)
+        with shard.lock:
+            shard.aggregated[user] = count
+
+    def aggregate_batch(self, records):
+        """Aggregate data as an iterable of (user, count) pairs.
+
+        Same as calling aggregate_user_data() for each pair, in order, taking
+        each shard lock once.
+        """
+        shards = self._shards
+        size = len(shards)
+        batches = [[] for _ in xrange(size)]
+        for record in records:
+            batches[hash(record[0]) % size].append(record)
+        for shard, batch in izip(shards, batches):
+            if batch:
+                with shard.lock:
+                    shard.aggregated.update(batch)
+
+    def _swap(self, shard):
+        "Return the counts aggregated in a shard, leaving it empty."
+        with shard.lock:
+            aggregated = shard.aggregated
+            shard.aggregated = {}
+        return aggregated
+
+    def pop_aggregated(self):
+        """Return the data aggregated so far, as a user to count mapping, and
+        drop it without computing any value.
+        """
+        aggregated = {}
+        for shard in self._shards:
+            aggregated.update(self._swap(shard))
+        return aggregated
+
+    def get_data_packet(self):
+        """Return the data packet, as NumbersManager.get_data_packet() does."""
+        packet = DataPacket()
+        users, old_counts, new_counts = [], [], []
+        for shard in self._shards:
+            aggregated = self._swap(shard)
+            # Only aggregated users will be in the packet.
+            packet.update(dict.fromkeys(aggregated, 0))
+            stashed = shard.stashed
+            for user, count in aggregated.iteritems():
+                if user in stashed:
+                    users.append(user)
+                    old_counts.append(stashed[user])
+                    new_counts.append(count)
+            shard.stashed = aggregated
+        # With previously collected data compute values to send.
+        if self.compute_batch is not None:
+            packet.update(izip(users, self.compute_batch(old_counts,
+                                                         new_counts)))
+        else:
+            compute = self.compute
+            packet.update(izip(users, map(compute, old_counts, new_counts)))
+        return packet
+
+
 ###############################################################################
 
 class NumbersPusher:
@@ -55,54 +478,207 @@ class NumbersPusher:
 
     logger = logging.getLogger('push.pusher')
 
-    def __init__(self, manager, interval=1):
-        """Takes a data manager and a push interval (defaults to 1 second)."""
+    def __init__(self, manager, interval=1, windows=DEFAULT_WINDOWS):
+        """Takes a data manager and a push interval (defaults to 1 second).
+
+        Upstreams may ask for rolling windows of the values (see the "series"
+        option of PushStrategy), windows are (name, seconds) pairs.
+        """
         self.manager = manager
         self.interval = interval
+        self.windows = windows
+        # Created once an upstream asks for them.
+        self.timeseries = None
+        self.leaderboard = None
+        # Set with set_groups().
+        self.groups = None
+        # Seconds between the last two packets taken, to compute values.
+        self.elapsed = interval
         self.running = False
         # Will delegate pushing data to the push-strategy objects.
         self._pushers = {}
+        # Filters of the upstreams, shared by the ones with the same view.
+        self._filters = {}
         # Complete the numbers manager by providing it with a compute()
         self.manager.compute = self._build_computer()
+        self.manager.compute_batch = self._build_batch_computer()
 
     def _build_computer(self):
         def compute(old_count, new_count):
             # Approximate the "kpm" (keys per minute).
-            value = int(round((new_count - old_count) * 60 / self.interval))
+            value = int(round((new_count - old_count) * 60 / self.elapsed))
             if value < 0:
                 return 0
             return value
         return compute
 
+    def _build_batch_computer(self):
+        """Build a compute() taking sequences of old and new counts, returning
+        the list of values.
+
+        Values are the same compute() would return for each pair. NumPy is
+        used when installed, else (or for deltas too large for 64 bit
+        integers once multiplied) compute() is called per pair.
+        """
+        compute = self._build_computer()
+        if numpy is None:
+            def compute_batch(old_counts, new_counts):
+                return map(compute, old_counts, new_counts)
+            return compute_batch
+
+        # Largest delta whose kpm fits an int64.
+        max_delta = 0x7FFFFFFFFFFFFFFF // 60
+
+        def compute_batch(old_counts, new_counts):
+            interval = self.elapsed
+            # Counts are non-negative int64, so are their differences.
+            deltas = (numpy.asarray(new_counts, dtype=numpy.int64)
+                      - numpy.asarray(old_counts, dtype=numpy.int64))
+            if deltas.size and numpy.abs(deltas).max() > max_delta:
+                return map(compute, old_counts, new_counts)
+            deltas *= 60
+            if isinstance(interval, (int, long)):
+                # Integer intervals make for (flooring) integer divisions.
+                values = deltas // interval
+            else:
+                rates = deltas / float(interval)
+                # Round half away from zero, as round() does. Negative values
+                # are clamped below, so only the positive half matters.
+                values = numpy.floor(rates)
+                values += (rates - values) >= 0.5
+            numpy.clip(values, 0, None, out=values)
+            return values.astype(numpy.int64).tolist()
+        return compute_batch
+
     def stop(self):
         self.logger.info("Stoping the pusher event loop.")
         self.running = False
 
+    def close(self):
+        "Stop the pusher, and release the resources of every upstream."
+        self.stop()
+        for pusher in self._pushers.values():
+            pusher.close()
+
     def start(self):
         "Loop to collect data and call _push()"
         gevent.spawn(self.collect_and_push)
 
     def collect_and_push(self):
         self.running = True
+        # Ticks are aligned to absolute deadlines, so the time taken to
+        # compute and push the data does not make them drift.
+        self._last_tick = monotonic()
+        next_tick = self._last_tick + self.interval
         while self.running:
-            gevent.sleep(self.interval)
-            data_packet = self.manager.get_data_packet()
-            self._push(data_packet)
+            gevent.sleep(max(0, next_tick - monotonic()))
+            self._tick()
+            next_tick += self.interval
+            late = monotonic() - next_tick
+            if late > 0:
+                # Skip the ticks already missed.
+                missed = int(late // self.interval) + 1
+                self.logger.warn("Overrun, %s ticks skipped.", missed)
+                TICK_OVERRUNS.inc(missed)
+                next_tick += missed * self.interval
+
+    def _tick(self):
+        "Take a data packet, and push it."
+        now = monotonic()
+        self.elapsed = now - self._last_tick
+        self._last_tick = now
+        data_packet = self.manager.get_data_packet()
+        PACKET_SECONDS.observe(monotonic() - now)
+        TICK_USERS.observe(len(data_packet))
+        data_packet.timestamp = time.time()
+        data_packet.elapsed = self.elapsed
+        if self.timeseries is not None:
+            self.timeseries.add(data_packet)
+            data_packet.timeseries = self.timeseries
+        if self.leaderboard is not None:
+            self.leaderboard.update(data_packet)
+            data_packet.leaderboard = self.leaderboard
+        if self.groups is not None and any(
+                pusher.level == PushStrategy.LEVEL_GROUP
+                for pusher in self._pushers.itervalues()):
+            data_packet.groups = self.groups.rollup(data_packet)
+        self._push(data_packet, wait=False)
 
-    def _push(self, data):
-        # Delegate to the configured push strategies.
+    def _push(self, data, wait=True):
+        """Delegate to the configured push strategies, concurrently.
+
+        Each gets its view of data (see PushStrategy.view()), built once for
+        the ones sharing it. If wait is true, wait for the pushes to finish
+        (for up to an interval).
+        """
         self.logger.debug("Calling push() data.")
-        for pusher in self._pushers.values():
-            pusher.push(data)
+        views = {}
+        running = []
+        for name, pusher in self._pushers.items():
+            try:
+                view = pusher.view(data, views)
+            except Exception:
+                # Skip the upstream this once, the others still get theirs.
+                self.logger.exception('View of upstream "%s" failed.', name)
+                continue
+            running.append(pusher.dispatch(view))
+        if wait:
+            gevent.joinall(running, timeout=self.interval)
 
     def add_upstream(self, name, strategy, *args, **kwargs):
-        self.logger.debug('Adding pusher "%s", of type "%s"'
-                          % (name, strategy))
-        self._pushers[name] = PushStrategy(strategy, *args, **kwargs)
+        self.logger.debug('Adding pusher "%s", of type "%s"',
+                          name, strategy)
+        # Checked first, not to leave a strategy holding resources behind.
+        series = kwargs.get('series')
+        if series and series is not True:
+            unknown = set(series) - set(window for window, _ in self.windows)
+            if unknown:
+                raise ValueError('Windows %s not known.'
+                                 % ', '.join(sorted(unknown)))
+        pusher = PushStrategy(strategy, *args, **kwargs)
+        pusher.name = name
+        if pusher.series:
+            if self.timeseries is None:
+                self.timeseries = TimeSeriesStore(self.interval, self.windows)
+        if pusher.top:
+            self.track_top(pusher.top)
+        if pusher.filter is not None:
+            key = pusher.view_key()
+            pusher.filter = self._filters.setdefault(key, pusher.filter)
+        self._pushers[name] = pusher
+
+    def track_top(self, k, sketch_capacity=None):
+        """Rank (at least) the top k users of each packet, and track the
+        heavy hitters with a sketch of sketch_capacity users, if given.
+        Return the Leaderboard.
+        """
+        if self.leaderboard is None:
+            self.leaderboard = Leaderboard(k, sketch_capacity)
+        else:
+            self.leaderboard.k = max(k, self.leaderboard.k)
+            if sketch_capacity and self.leaderboard.sketch is None:
+                self.leaderboard = Leaderboard(self.leaderboard.k,
+                                               sketch_capacity)
+        return self.leaderboard
+
+    def set_groups(self, groups):
+        """Compute the statistics of groups of users for each packet, for the
+        upstreams pushing them (see the "level" option of PushStrategy).
+        Groups map group names to lists of users, None stops computing them.
+        """
+        self.groups = GroupRollup(groups) if groups is not None else None
 
     def remove_upstream(self, name):
-        self.logger.debug('Removing pusher "%s"' % name)
-        del self._pushers[name]
+        self.logger.debug('Removing pusher "%s"', name)
+        self._pushers.pop(name).close()
+        PUSH_SECONDS.remove(name)
+        used = set(pusher.view_key() for pusher in self._pushers.itervalues())
+        for key in [key for key in self._filters if key not in used]:
+            del self._filters[key]
+
+
+class PushError (Exception):
+    "A push failed, for the reason in the message."
 
 
 class PushStrategy (object):
@@ -117,10 +693,113 @@ class PushStrategy (object):
     PUSH_TO_STDOUT = 'stdout'
     PUSH_TO_FILE = 'file'
     PUSH_TO_HTTP = 'http'
-    PUSH_TYPES = [PUSH_TEST, PUSH_TO_STDOUT, PUSH_TO_FILE, PUSH_TO_HTTP]
+    PUSH_TO_HTTP_POOL = 'http-pool'
+    PUSH_TO_BUFFERED_FILE = 'buffered-file'
+    PUSH_TO_ARCHIVE = 'archive'
+    PUSH_TYPES = [PUSH_TEST, PUSH_TO_STDOUT, PUSH_TO_FILE, PUSH_TO_HTTP,
+                  PUSH_TO_HTTP_POOL, PUSH_TO_BUFFERED_FILE, PUSH_TO_ARCHIVE]
+
+    ENCODING_IDENTITY = 'identity'
+    ENCODING_GZIP = 'gzip'
+    ENCODING_ZSTD = 'zstd'
+    ENCODINGS = [ENCODING_IDENTITY, ENCODING_GZIP, ENCODING_ZSTD]
+    # Negotiate an option with upstream.
+    AUTO = 'auto'
+
+    # What is pushed: the values of users, or a statistic of their groups.
+    LEVEL_USER = 'user'
+    LEVEL_GROUP = 'group'
+    LEVELS = [LEVEL_USER, LEVEL_GROUP]
+
+    # What to do with data to push while a previous push is still running.
+    OVERRUN_SKIP = 'skip'           # Drop the new data.
+    OVERRUN_COALESCE = 'coalesce'   # Keep the newest data only.
+    OVERRUN_QUEUE = 'queue'         # Keep up to QUEUE_SIZE data, oldest out.
+    OVERRUN_POLICIES = [OVERRUN_SKIP, OVERRUN_COALESCE, OVERRUN_QUEUE]
+    QUEUE_SIZE = 8
+
+    # Spool defaults: size cap (bytes), data pushed at once, and the first
+    # and longest waits (seconds) after a failed push of spooled data.
+    SPOOL_BYTES = 64 * 1024 * 1024
+    SPOOL_BATCH = 16
+    SPOOL_BACKOFF = 1
+    SPOOL_MAX_BACKOFF = 60
 
     def __init__(self, strategy, *args, **kwargs):
+        """Takes the strategy type, and its options.
+
+        Options common to every strategy are "deadline", the time (in
+        seconds) a single push is allowed to take before being interrupted,
+        and "overrun", the policy for data to push while a previous push is
+        still running (see OVERRUN_POLICIES).
+
+        With "series", true or a list of window names, the strategies that
+        support it ("http" and "http-pool") also push the rolling window
+        statistics of each user (see NumbersPusher).
+
+        With "level" set to "group", a statistic of each group of users is
+        pushed instead of the values of users, keyed by group name: the
+        "group_stat" ("sum", the default, "mean" or "max"). Groups are set in
+        the pusher (see NumbersPusher.set_groups()).
+
+        With "top", a number of users (or groups), only the ones with the
+        highest values are pushed.
+
+        The users (or groups) pushed can be filtered, by name with "allow"
+        and "deny" (lists of names), "allow_regex" and "deny_regex" (regular
+        expressions), and "sample" (the fraction of names to keep, always the
+        same ones), and by value with "drop_zeros" and "min_change" (the
+        change since the value this upstream last accepted, for a name to be
+        pushed again, not for "http-pool", see its "delta" option instead).
+        See PacketFilter and ChangeFilter.
+
+        With "spool", a directory, data whose push failed is kept there (up
+        to "spool_bytes") and pushed again in the background, up to
+        "spool_batch" at a time, backing off while pushes keep failing. Live
+        pushes go on meanwhile, so spooled data is usually pushed after newer
+        data: strategies tell when data was taken by its timestamp.
+        """
         self.logger = logging.getLogger('push.strategy.%s' % strategy)
+        # Name of the upstream, for the metrics.
+        self.name = strategy
+        self.deadline = kwargs.pop('deadline', None)
+        self.overrun = kwargs.pop('overrun', self.OVERRUN_SKIP)
+        if self.overrun not in self.OVERRUN_POLICIES:
+            raise ValueError('Overrun policy "%s" not known.' % self.overrun)
+        # True, or the names of the windows wanted.
+        self.series = kwargs.pop('series', False)
+        self.level = kwargs.pop('level', self.LEVEL_USER)
+        if self.level not in self.LEVELS:
+            raise ValueError('Level "%s" not known.' % self.level)
+        self.group_stat = kwargs.pop('group_stat', group_stats.STAT_SUM)
+        if self.group_stat not in group_stats.STATS:
+            raise ValueError('Group statistic "%s" not known.'
+                             % self.group_stat)
+        if (strategy == PushStrategy.PUSH_TO_ARCHIVE
+                and self.level == self.LEVEL_GROUP
+                and self.group_stat == group_stats.STAT_MEAN):
+            raise ValueError('Strategy "%s" only takes integer values, not '
+                             'group means.' % strategy)
+        self.top = kwargs.pop('top', None)
+        self.filter = PacketFilter.from_options(kwargs)
+        self.changes = ChangeFilter.from_options(kwargs)
+        spool_directory = kwargs.pop('spool', None)
+        spool_bytes = kwargs.pop('spool_bytes', self.SPOOL_BYTES)
+        self.spool_batch = kwargs.pop('spool_batch', self.SPOOL_BATCH)
+        if spool_directory and strategy == PushStrategy.PUSH_TO_HTTP_POOL:
+            raise ValueError('Strategy "%s" pushes in the background, its '
+                             'failures cannot be spooled.' % strategy)
+        if self.changes and strategy == PushStrategy.PUSH_TO_HTTP_POOL:
+            raise ValueError('Strategy "%s" pushes in the background, what '
+                             'upstream accepted is not known to filter by '
+                             '"min_change".' % strategy)
+        # The greenlet running push(), and the data waiting for it.
+        self._running = None
+        self._backlog = []
+        # Strategies holding resources replace this to release them.
+        self.close = lambda: None
+        # Strategies pushing in the background time the pushes themselves.
+        self._timed = True
         if strategy == PushStrategy.PUSH_TEST:
             self.push = self._test_push(*args, **kwargs)
         elif strategy == PushStrategy.PUSH_TO_STDOUT:
@@ -129,14 +808,174 @@ class PushStrategy (object):
             self.push = self._push_to_file(*args, **kwargs)
         elif strategy == PushStrategy.PUSH_TO_HTTP:
             self.push = self._push_to_HTTP(*args, **kwargs)
+        elif strategy == PushStrategy.PUSH_TO_HTTP_POOL:
+            self.push = self._push_to_HTTP_pool(*args, **kwargs)
+        elif strategy == PushStrategy.PUSH_TO_BUFFERED_FILE:
+            self.push = self._push_to_buffered_file(*args, **kwargs)
+        elif strategy == PushStrategy.PUSH_TO_ARCHIVE:
+            self.push = self._push_to_archive(*args, **kwargs)
         else:
             raise ValueError('Strategy "%s" not known.' % strategy)
+        self.spool = None
+        if spool_directory:
+            self._start_spool(spool_directory, spool_bytes)
+
+    def _start_spool(self, directory, max_bytes):
+        "Keep failed pushes in a spool, and drain it in the background."
+        from spool import Spool
+        self.spool = Spool(directory, max_bytes)
+        # Set when there is spooled data to push.
+        self._spooled = gevent.event.Event()
+        if not self.spool.empty():
+            self._spooled.set()
+        drainer = gevent.spawn(self._drain_spool)
+        close = self.close
+
+        def _close():
+            drainer.kill()
+            self.spool.close()
+            close()
+        self.close = _close
+
+    def dispatch(self, data):
+        """Call push() with data in a greenlet of its own, and return it.
+
+        If a previous push is still running, data is handled according to the
+        overrun policy, and the running greenlet is returned.
+        """
+        if self._running is None or self._running.ready():
+            self._running = gevent.spawn(self._push_all, data)
+        elif self.overrun == self.OVERRUN_SKIP:
+            self.logger.warn("Push skipped, previous push still running.")
+        elif self.overrun == self.OVERRUN_COALESCE:
+            self._backlog[:] = [data]
+        else:
+            self._backlog.append(data)
+            if len(self._backlog) > self.QUEUE_SIZE:
+                self.logger.warn("Push dropped, too many pushes queued.")
+                del self._backlog[0]
+        return self._running
+
+    def view_key(self):
+        "Return what identifies the view of data this strategy pushes."
+        return (self.level,
+                self.group_stat if self.level == self.LEVEL_GROUP else None,
+                self.filter.definition if self.filter is not None else None)
+
+    def view(self, data, views):
+        """Return the view of a data packet this strategy pushes: the users,
+        or a statistic of the groups (see "level"), filtered. Views are
+        cached in the views dict, shared by the strategies pushing a packet.
+        """
+        if self.level == self.LEVEL_USER and self.filter is None:
+            return data
+        key = self.view_key()
+        view = views.get(key)
+        if view is None:
+            view = data
+            if self.level == self.LEVEL_GROUP:
+                view = group_packet(data, self.group_stat)
+            if self.filter is not None:
+                view = self.filter.apply(view)
+            views[key] = view
+        return view
+
+    def _push_all(self, data):
+        "Push data, then any data in the backlog, each within the deadline."
+        while True:
+            if self.top:
+                data = top_packet(data, self.top)
+            accepted = None
+            if self.changes is not None:
+                data, accepted = self.changes.apply(data)
+            if self._push_once(data):
+                if accepted is not None:
+                    self.changes.acknowledge(accepted)
+            elif self.spool is not None:
+                self.spool.append(json.dumps(
+                    [getattr(data, 'timestamp', None),
+                     getattr(data, 'elapsed', None), data]))
+                self._spooled.set()
+            if not self._backlog:
+                break
+            data = self._backlog.pop(0)
+
+    def _push_once(self, data):
+        "Push data within the deadline, and return whether it succeeded."
+        timeout = gevent.Timeout(self.deadline)
+        timeout.start()
+        start = monotonic()
+        try:
+            self.push(data)
+        except gevent.Timeout as e:
+            if e is not timeout:
+                raise
+            self.logger.error("Push interrupted, deadline of %s seconds "
+                              "exceeded." % self.deadline)
+        except PushError as e:
+            self.logger.error(str(e))
+        except Exception:
+            self.logger.exception("Push failed.")
+        else:
+            return True
+        finally:
+            timeout.cancel()
+            if self._timed:
+                PUSH_SECONDS.labels(self.name).observe(monotonic() - start)
+        return False
+
+    def _drain_spool(self):
+        "Push the spooled data again, in order, until the spool is empty."
+        backoff = self.SPOOL_BACKOFF
+        while True:
+            self._spooled.wait()
+            try:
+                records = self.spool.read(self.spool_batch)
+            except Exception:
+                # Keep draining, the spool may be appended to again.
+                self.logger.exception("Spooled data unreadable.")
+                records = None
+            if not records:
+                self._spooled.clear()
+                continue
+            pushed = None
+            for record, position in records:
+                try:
+                    timestamp, elapsed, data = json.loads(record)
+                    packet = DataPacket(data)
+                except (TypeError, ValueError):
+                    self.logger.error("Dropping a bad spooled record.")
+                    pushed = position
+                    continue
+                packet.timestamp, packet.elapsed = timestamp, elapsed
+                if not self._push_once(packet):
+                    break
+                pushed = position
+            if pushed is not None:
+                self.spool.consume(pushed)
+            if pushed == records[-1][1]:
+                backoff = self.SPOOL_BACKOFF
+            else:
+                self.logger.info("Pushing spooled data again in %s seconds.",
+                                 backoff)
+                gevent.sleep(backoff)
+                backoff = min(backoff * 2, self.SPOOL_MAX_BACKOFF)
+
+    def _series_of(self, data):
+        """Return the window statistics of the users in data, by user, if
+        asked for (with the "series" option) and in data, else None.
+        """
+        timeseries = getattr(data, 'timeseries', None)
+        if not self.series or timeseries is None:
+            return None
+        names = None if self.series is True else self.series
+        return timeseries.summary(data, names)
 
     def _test_push(self, **kwargs):
         def _push(data):
             self.logger.debug("Pushing data.")
             self.pushed.append(data)
-            self.logger.debug("Current pushed data: %s" % self.pushed)
+            self.logger.debug("Current pushed data: %s", self.pushed)
         self.logger.info("Test pushing: "
                          "data is accumulated in self.pushed list.")
         # Allow to test pushing to RAM.
@@ -162,6 +1001,37 @@ class PushStrategy (object):
         self.logger.info("Pushing to file %s." % file_name)
         return _push
 
+    def _push_to_buffered_file(self, file_name, **options):
+        """Write data as JSON encoded lines, as the "file" strategy does, to a
+        file kept open. See BufferedFileWriter for the options.
+        """
+        writer = BufferedFileWriter(file_name, **options)
+
+        def _push(data):
+            writer.write("%s\n" % json.dumps(data))
+
+        self.close = writer.close
+        self.logger.info("Pushing to file %s, buffered." % file_name)
+        return _push
+
+    def _push_to_archive(self, file_name):
+        """Write data to a binary columnar archive, see the archive module
+        for its format, and ArchiveReader to read it back.
+
+        Values are stored as integers, so the "mean" group statistic, a
+        float, is not accepted.
+        """
+        from archive import ArchiveWriter
+        writer = ArchiveWriter(file_name)
+
+        def _push(data):
+            timestamp = data.timestamp if data.timestamp else time.time()
+            writer.write(timestamp, data)
+
+        self.close = writer.close
+        self.logger.info("Pushing to archive %s." % file_name)
+        return _push
+
     def _push_to_HTTP(self, base_URL):
         """Push POSTing to a HTTP API.
 
@@ -172,6 +1042,10 @@ class PushStrategy (object):
 
         Each end point should accept a single integer as data payload, and
         return a status code of 202 Accepted.
+
+        The time the data was taken at (a UNIX timestamp) is sent in the
+        X-Key-Counter-Timestamp header, as data may be pushed late (see the
+        "spool" option).
         """
         import requests
         import requests.exceptions
@@ -186,10 +1060,168 @@ class PushStrategy (object):
         def _push(data):
             packet = [{'username': user, 'count': value}
                       for user, value in data.items()]
-            req = None
+            series = self._series_of(data)
+            if series is not None:
+                for row in packet:
+                    row['series'] = series[row['username']]
+            post_headers = headers
+            timestamp = getattr(data, 'timestamp', None)
+            if timestamp is not None:
+                post_headers = dict(headers)
+                post_headers['x-key-counter-timestamp'] = repr(timestamp)
             try:
                 req = requests.post(url, data=json.dumps(packet),
-                                    headers=headers, timeout=POST_TIMEOUT)
+                                    headers=post_headers, timeout=POST_TIMEOUT)
+            except requests.exceptions.ConnectionError:
+                raise PushError("Connection error. Either %s is not the "
+                                "correct base URL, or upstream is not "
+                                "behaving as expected." % base_url)
+            except requests.exceptions.Timeout:
+                raise PushError("Push timeout. Upstream is taking too "
+                                "long to process the data push.")
+            if req.status_code != requests.codes.accepted:
+                raise PushError("Push not completed. Upstream is not "
+                                "responding as expected.")
+        self.logger.info("Pushing to HTTP endpoint at %s" % url)
+        return _push
+
+    def _push_to_HTTP_pool(self, base_URL, pool_size=2, encoding='identity',
+                           timeout=3, delta=False, snapshot_every=60):
+        """Push POSTing to a HTTP API, as the "http" strategy does, reusing
+        keep-alive connections.
+
+        POSTs are made by a pool of pool_size threads, sharing a pool of as
+        many connections, so pushing never waits for upstream. Up to
+        pool_size pushes can wait for a thread, newer ones are dropped.
+
+        With delta, only the users whose value changed since the last push
+        upstream accepted are POSTed (with a null count for users no longer
+        in the data, and leaving out new users with a zero count), and a
+        full snapshot every snapshot_every pushes. The X-Key-Counter-Push
+        header of each POST tells which one it is ("delta" or "full"). Deltas
+        build on each other, so with delta (or "auto"), POSTs are made one
+        at a time, in order.
+
+        Bodies are encoded as encoding says ("identity", "gzip", or "zstd" if
+        the zstandard module is installed). If encoding and/or delta are
+        "auto", upstream is asked with an OPTIONS request first: it accepts
+        the encodings listed in its Accept-Encoding header, and deltas if it
+        sends a X-Key-Counter-Delta header.
+
+        The time the data was taken at is sent in the X-Key-Counter-Timestamp
+        header, as the "http" strategy does.
+
+        The push time metric is the time each POST takes, not the (instant)
+        handing of the data to the threads.
+        """
+        import requests
+        import requests.adapters
+        import requests.exceptions
+        from gevent.threadpool import ThreadPool
+        import threading
+        if encoding not in self.ENCODINGS + [self.AUTO]:
+            raise ValueError('Encoding "%s" not known.' % encoding)
+        if encoding == self.ENCODING_ZSTD and zstandard is None:
+            raise ValueError('Encoding "zstd" needs the zstandard module.')
+        if delta not in (True, False, self.AUTO):
+            raise ValueError('Delta "%s" not known.' % delta)
+        # No trailing slash on the base URL.
+        base_url = base_URL.rstrip('/')
+        url = "%s/counts/" % base_url
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['content-type'] = 'application/json'
+        # Deltas (maybe negotiated) are POSTed by a single thread, in order.
+        threads = ThreadPool(1 if delta else pool_size)
+        # Results of the POSTs not yet completed.
+        pending = []
+        # Options in use, None until negotiated with upstream.
+        settings = {
+            'encoding': None if encoding == self.AUTO else encoding,
+            'delta': None if delta == self.AUTO else delta,
+        }
+        # Values upstream has, as of the last accepted push, and the number
+        # of pushes so far. Shared by the threads.
+        state = {'acked': None, 'pushes': 0}
+        lock = threading.Lock()
+
+        def _negotiate():
+            try:
+                req = session.options(url, timeout=timeout)
+            except requests.exceptions.RequestException:
+                # Not negotiated, try again on the next push.
+                return
+            offered, delta_offered = [], False
+            if req.ok:
+                offered = [item.split(';')[0].strip().lower() for item in
+                           req.headers.get('accept-encoding', '').split(',')]
+                delta_offered = 'x-key-counter-delta' in req.headers
+            if settings['encoding'] is None:
+                settings['encoding'] = self.ENCODING_IDENTITY
+                for preferred in (self.ENCODING_ZSTD, self.ENCODING_GZIP):
+                    if preferred in offered and (
+                            preferred != self.ENCODING_ZSTD or zstandard):
+                        settings['encoding'] = preferred
+                        break
+            if settings['delta'] is None:
+                settings['delta'] = delta_offered
+            self.logger.info("Negotiated encoding %s, delta %s.",
+                             settings['encoding'], settings['delta'])
+
+        def _rows(data):
+            "Return the rows to POST, and whether they are a full snapshot."
+            with lock:
+                acked = state['acked']
+                full = (not settings['delta'] or acked is None
+                        or state['pushes'] % snapshot_every == 0)
+                state['pushes'] += 1
+                if full:
+                    return data.items(), True
+                # New users count as zero.
+                rows = [(user, value) for user, value in data.iteritems()
+                        if value != acked.get(user, 0)]
+                rows.extend((user, None) for user in acked
+                            if user not in data)
+                return rows, False
+
+        def _acknowledge(rows, full):
+            with lock:
+                if full:
+                    state['acked'] = dict(rows)
+                elif state['acked'] is not None:
+                    for user, value in rows:
+                        if value is None:
+                            state['acked'].pop(user, None)
+                        else:
+                            state['acked'][user] = value
+
+        def _post(data, series):
+            if None in settings.values():
+                _negotiate()
+            rows, full = _rows(data)
+            packet = [{'username': user, 'count': value}
+                      for user, value in rows]
+            if series is not None:
+                for row in packet:
+                    if row['count'] is not None:
+                        row['series'] = series[row['username']]
+            body = json.dumps(packet)
+            headers = {'x-key-counter-push': 'full' if full else 'delta'}
+            timestamp = getattr(data, 'timestamp', None)
+            if timestamp is not None:
+                headers['x-key-counter-timestamp'] = repr(timestamp)
+            body_encoding = settings['encoding'] or self.ENCODING_IDENTITY
+            if body_encoding != self.ENCODING_IDENTITY:
+                headers['content-encoding'] = body_encoding
+                body = COMPRESSORS[body_encoding](body)
+            start = monotonic()
+            try:
+                req = session.post(url, data=body, headers=headers,
+                                   timeout=timeout)
             except requests.exceptions.ConnectionError:
                 self.logger.error("Connection error. Either %s is not the "
                                   "correct base URL, or upstream is not "
@@ -197,10 +1229,43 @@ class PushStrategy (object):
             except requests.exceptions.Timeout:
                 self.logger.error("Push timeout. Upstream is taking too "
                                   "long to process the data push.")
-            if req and req.status_code != requests.codes.accepted:
-                self.logger.error("Push not completed. Upstream is not "
-                                  "responding as expected.")
-        self.logger.info("Pushing to HTTP endpoint at %s" % url)
+            else:
+                if req.status_code == requests.codes.accepted:
+                    _acknowledge(rows, full)
+                elif req.status_code == requests.codes.unsupported_media:
+                    self.logger.error("Push not accepted, renegotiating.")
+                    if encoding == self.AUTO:
+                        settings['encoding'] = None
+                    if delta == self.AUTO:
+                        settings['delta'] = None
+                else:
+                    self.logger.error("Push not completed. Upstream is not "
+                                      "responding as expected.")
+            finally:
+                with lock:
+                    PUSH_SECONDS.labels(self.name).observe(
+                        monotonic() - start)
+
+        def _push(data):
+            pending[:] = [result for result in pending if not result.ready()]
+            if len(pending) >= 2 * pool_size:
+                self.logger.error("Push dropped. Upstream is not keeping up "
+                                  "with the pushed data.")
+                return
+            # Computed here, the store is not to be read from other threads.
+            series = self._series_of(data)
+            pending.append(threads.spawn(_post, data, series))
+
+        def _close():
+            # Let pending POSTs finish (each bound by the timeout) first.
+            threads.join()
+            threads.kill()
+            session.close()
+
+        self.close = _close
+        self._timed = False
+        self.logger.info("Pushing to HTTP endpoint at %s, with %s "
+                         "connections" % (url, pool_size))
         return _push
 
 
@@ -211,18 +1276,171 @@ class NumbersServer(DatagramServer):
     logger = logging.getLogger('network')
 
     def __init__(self, port, manager, *args, **kwargs):
+        """Takes the port to listen at and a data manager.
+
+        Passing reuse_port=True allows several servers (in different
+        processes) to listen at the same port, with the kernel balancing
+        datagrams between them. Pass rcvbuf to set the socket receive buffer
+        size, in bytes.
+        """
+        self.reuse_port = kwargs.pop('reuse_port', False)
+        self.rcvbuf = kwargs.pop('rcvbuf', None)
         address = ":%s" % port
         super(NumbersServer, self).__init__(address, *args, **kwargs)
         self.manager = manager
 
+    def init_socket(self):
+        if not hasattr(self, 'socket') and self.reuse_port:
+            sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind(self.address)
+            self.socket = sock
+        super(NumbersServer, self).init_socket()
+        if self.rcvbuf:
+            set_rcvbuf(self.socket, self.rcvbuf, self.logger)
+
     def handle(self, data, address):
+        # Either a single (user, count) record or a batch of them, see the
+        # protocol module for the supported payloads.
+        DATAGRAMS_RECEIVED.inc()
         try:
-            data = json.loads(data)
-            user = data['user']
-            value = long(data['count'])
-        except (ValueError, TypeError):
-            # ValueError due to bad JSON data,
-            # TypeError due to bad number.
+            records = protocol.decode(data)
+        except ValueError:
+            DATAGRAMS_REJECTED.inc()
             self.logger.warn('bad data ignored.')
         else:
-            self.manager.aggregate_user_data(user, value)
+            self.manager.aggregate_batch(records)
+
+
+class BufferedFileWriter (object):
+    """Write to a file kept open, with buffering.
+
+    Buffered data is flushed every flush_ticks writes and/or every
+    flush_seconds (checked on write), and always when closed. On flush, data
+    is also synced to disk if fsync is true.
+
+    The file is rotated once larger than max_bytes, and/or every
+    rotate_seconds, keeping up to backups old files (named file_name.1 being
+    the newest). If the file is rotated, or removed, by someone else, it is
+    reopened on the next flush, or write after CHECK_SECONDS since the last
+    check, whichever comes first.
+    """
+
+    logger = logging.getLogger('push.file')
+    # Seconds between checks for the file being moved, on write.
+    CHECK_SECONDS = 1
+
+    def __init__(self, file_name, flush_ticks=None, flush_seconds=None,
+                 fsync=False, max_bytes=None, rotate_seconds=None, backups=5,
+                 buffer_size=64 * 1024):
+        self.file_name = file_name
+        self.flush_ticks = flush_ticks
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.file_name, 'a', self.buffer_size)
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._opened = self._flushed = self._checked = monotonic()
+        self._writes = 0
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        now = monotonic()
+        if now - self._checked >= self.CHECK_SECONDS:
+            self._reopen_if_moved()
+        self._file.write(data)
+        self._writes += 1
+
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self.rotate()
+        elif self.rotate_seconds and now - self._opened >= self.rotate_seconds:
+            self.rotate()
+        elif self.flush_ticks and self._writes >= self.flush_ticks:
+            self.flush()
+        elif (self.flush_seconds
+              and now - self._flushed >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        "Flush (and maybe sync) the buffered data, reopen the file if moved."
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._flushed = monotonic()
+        self._writes = 0
+        self._reopen_if_moved()
+
+    def _reopen_if_moved(self):
+        "Reopen the file if it was moved, or removed, by someone else."
+        self._checked = monotonic()
+        try:
+            moved = os.stat(self.file_name).st_ino != self._inode
+        except OSError:
+            moved = True
+        if moved:
+            self.logger.info("File %s moved, reopening.", self.file_name)
+            # Data buffered so far goes to the moved file.
+            self._file.close()
+            self._open()
+
+    def rotate(self):
+        "Close the file, shift the backup files, and open a new one."
+        self._close_file()
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%s" % (self.file_name, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%s" % (self.file_name, i + 1))
+        if not os.path.exists(self.file_name):
+            # Moved by someone else already.
+            pass
+        elif self.backups:
+            os.rename(self.file_name, "%s.1" % self.file_name)
+        else:
+            os.remove(self.file_name)
+        self._open()
+
+    def close(self):
+        "Flush, sync, and close the file."
+        if self._file is not None:
+            self._close_file()
+            self._file = None
+
+    def _close_file(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def gzip_compress(data):
+    "Return data compressed in the gzip format."
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def zstd_compress(data):
+    "Return data compressed in the zstd format."
+    return zstandard.ZstdCompressor().compress(data)
+
+# Compress functions, by HTTP content encoding.
+COMPRESSORS = {
+    PushStrategy.ENCODING_GZIP: gzip_compress,
+    PushStrategy.ENCODING_ZSTD: zstd_compress,
+}
+
+
+def set_rcvbuf(sock, size, logger):
+    "Set the receive buffer size of sock, logging if not fully granted."
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    # The kernel doubles the requested size, and caps it to rmem_max.
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if actual < size:
+        logger.warn("Receive buffer set to %s bytes, %s requested "
+                    "(see net.core.rmem_max)." % (actual, size))
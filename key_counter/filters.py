@@ -0,0 +1,169 @@
+"""Filters of the rows of data packets, per upstream.
+
+A packet filter keeps the users (or groups) of a packet that are allowed (by
+name, or by a regular expression), not denied, and, optionally, that have a
+non-zero value, and fall in a deterministic sample (by a hash of the name, so
+a user is always in or out). It holds no state of the packets filtered, so
+upstreams with the same definition share a single filter.
+
+A change filter keeps the rows whose value changed by at least some amount
+since an upstream accepted them (names new to it are always kept). As that
+depends on the pushes of the upstream, each one has a change filter of its
+own.
+
+Filters are built once, from the options of an upstream (see OPTIONS).
+"""
+import zlib
+import re
+
+# Upstream options defining a packet filter, and a change filter.
+OPTIONS = ('allow', 'deny', 'allow_regex', 'deny_regex', 'drop_zeros',
+           'sample')
+CHANGE_OPTION = 'min_change'
+
+
+def _names(option, names):
+    if names is None:
+        return None
+    if not isinstance(names, list) or not all(
+            isinstance(name, basestring) for name in names):
+        raise ValueError('"%s" must be a list of names.' % option)
+    return frozenset(names)
+
+
+def _regex(option, pattern):
+    if pattern is None:
+        return None
+    try:
+        return re.compile(pattern)
+    except (re.error, TypeError) as e:
+        raise ValueError('"%s" is not a valid regular expression: %s'
+                         % (option, e))
+
+
+def in_sample(name, fraction):
+    "Return whether a name falls in a sample of fraction of every name."
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xFFFFFFFF) < fraction * 0x100000000
+
+
+class PacketFilter (object):
+    "Keep the rows of data packets matching a definition."
+
+    def __init__(self, allow=None, deny=None, allow_regex=None,
+                 deny_regex=None, drop_zeros=False, sample=None):
+        """Takes the names to keep (all if not given), the names to drop,
+        regular expressions (matched from the start) for names to keep and to
+        drop, whether to drop zero values, and the fraction (in (0, 1]) of
+        names to sample.
+        """
+        if sample is not None and not (isinstance(sample, (int, float))
+                                       and 0 < sample <= 1):
+            raise ValueError('"sample" must be a fraction in (0, 1].')
+        self.allow = _names('allow', allow)
+        self.deny = _names('deny', deny) or frozenset()
+        self.allow_regex = _regex('allow_regex', allow_regex)
+        self.deny_regex = _regex('deny_regex', deny_regex)
+        # Filters with the same definition keep the same rows.
+        self.definition = (
+            tuple(sorted(allow)) if allow is not None else None,
+            tuple(sorted(self.deny)), allow_regex, deny_regex,
+            bool(drop_zeros), sample)
+        self.drop_zeros = drop_zeros
+        self.sample = sample
+        self._by_name = (self.allow is not None or self.deny
+                         or self.allow_regex is not None
+                         or self.deny_regex is not None
+                         or sample is not None)
+        # Whether each name seen is kept, but for the value conditions.
+        self._names = {}
+
+    @classmethod
+    def from_options(cls, options):
+        """Pop the filter options from a dict of upstream options, and return
+        their filter, or None if there are none.
+        """
+        given = dict((option, options.pop(option)) for option in OPTIONS
+                     if option in options)
+        if not given:
+            return None
+        return cls(**given)
+
+    def _admits(self, name):
+        "Return whether a name is kept, by the name conditions."
+        admitted = self._names.get(name)
+        if admitted is None:
+            admitted = (
+                (self.allow is None or name in self.allow)
+                and name not in self.deny
+                and (self.allow_regex is None
+                     or self.allow_regex.match(name) is not None)
+                and (self.deny_regex is None
+                     or self.deny_regex.match(name) is None)
+                and (self.sample is None or in_sample(name, self.sample)))
+            if len(self._names) > 1024 * 1024:
+                self._names.clear()
+            self._names[name] = admitted
+        return admitted
+
+    def apply(self, data):
+        "Return the rows of a data packet the filter keeps, as a data packet."
+        rows = data.iteritems()
+        if self._by_name:
+            admits = self._admits
+            rows = [(name, value) for name, value in rows if admits(name)]
+        if self.drop_zeros:
+            rows = [(name, value) for name, value in rows if value != 0]
+        return _packet(data, rows)
+
+
+class ChangeFilter (object):
+    "Keep the rows whose value changed since an upstream accepted them."
+
+    def __init__(self, min_change):
+        "Takes the change a value needs to be kept again."
+        if not (isinstance(min_change, (int, long, float))
+                and min_change >= 0):
+            raise ValueError('"min_change" must be a non-negative number.')
+        self.min_change = min_change
+        # Values accepted last, by name.
+        self.accepted = {}
+
+    @classmethod
+    def from_options(cls, options):
+        """Pop the change option from a dict of upstream options, and return
+        its filter, or None if there is none.
+        """
+        if CHANGE_OPTION not in options:
+            return None
+        return cls(options.pop(CHANGE_OPTION))
+
+    def apply(self, data):
+        """Return the rows of a data packet the filter keeps, as a data
+        packet, and the values accepted once it is pushed, to pass to
+        acknowledge() then.
+        """
+        accepted, min_change = self.accepted, self.min_change
+        # Names missing from the packet are forgotten.
+        pending = {}
+        changed = []
+        for name, value in data.iteritems():
+            last = accepted.get(name)
+            if last is None or abs(value - last) >= min_change:
+                changed.append((name, value))
+                last = value
+            pending[name] = last
+        return _packet(data, changed), pending
+
+    def acknowledge(self, pending):
+        "Take the values apply() returned as accepted, once pushed."
+        self.accepted = pending
+
+
+def _packet(data, rows):
+    "Return rows as a data packet like data, with its stamps."
+    packet = data.__class__(rows)
+    if hasattr(data, '__dict__'):
+        packet.__dict__.update(data.__dict__)
+    return packet
@@ -0,0 +1,78 @@
+"""Rollups of the values of users, by group (as teams).
+
+Groups are defined as a mapping from group name to the list of its users. A
+user may be in many groups, or in none. The statistics of each group (the
+sum, mean and maximum of the values of its users in a packet) are computed in
+a single pass over the packet, however many upstreams want them.
+"""
+
+# Statistics computed for each group.
+STAT_SUM = 'sum'
+STAT_MEAN = 'mean'
+STAT_MAX = 'max'
+STATS = [STAT_SUM, STAT_MEAN, STAT_MAX]
+
+
+def validate_groups(groups):
+    "Raise ValueError unless groups maps group names to lists of users."
+    if not isinstance(groups, dict):
+        raise ValueError('groups must map group names to lists of users.')
+    for group, users in groups.iteritems():
+        if not isinstance(users, list) or not all(
+                isinstance(user, basestring) for user in users):
+            raise ValueError('users of group "%s" must be a list of names.'
+                             % group)
+
+
+class GroupRollup (object):
+    "The statistics of the users of each group, per packet."
+
+    def __init__(self, groups):
+        "Takes a mapping from group name to the list of its users."
+        validate_groups(groups)
+        self.groups = groups
+        # User to the names of its groups.
+        self._membership = {}
+        for group, users in groups.iteritems():
+            for user in set(users):
+                self._membership.setdefault(user, []).append(group)
+
+    def rollup(self, packet):
+        """Return the statistics of the groups with users in a packet, a user
+        to value mapping, as a mapping from group name to its "sum", "mean",
+        "max" and number of "users".
+        """
+        membership = self._membership
+        # Group to [sum, users, max].
+        totals = {}
+        for user, value in packet.iteritems():
+            groups = membership.get(user)
+            if groups is None:
+                continue
+            for group in groups:
+                total = totals.get(group)
+                if total is None:
+                    totals[group] = [value, 1, value]
+                    continue
+                total[0] += value
+                total[1] += 1
+                if value > total[2]:
+                    total[2] = value
+        return dict((group, {STAT_SUM: total, STAT_MEAN: total / float(users),
+                             STAT_MAX: peak, 'users': users})
+                    for group, (total, users, peak) in totals.iteritems())
+
+
+def group_packet(data, stat):
+    """Return the stat of each group in a data packet (see
+    NumbersPusher.set_groups()), as a data packet keyed by group name. The
+    packet is empty if data has no group statistics.
+    """
+    groups = getattr(data, 'groups', None) or {}
+    packet = data.__class__((group, stats[stat])
+                            for group, stats in groups.iteritems())
+    # Keep the stamps of the packet, not its per user data.
+    for stamp in ('timestamp', 'elapsed'):
+        if hasattr(data, stamp):
+            setattr(packet, stamp, getattr(data, stamp))
+    return packet
@@ -0,0 +1,134 @@
+"""The users with the highest values, per tick and over time.
+
+Leaderboard keeps the top K users of the last packet, found with a bounded
+heap as each packet is taken, and optionally the heavy hitters since start
+(the users with the highest sum of values), estimated with a space-saving
+sketch of fixed size, however many users there are.
+"""
+from operator import itemgetter
+import heapq
+
+
+class SpaceSaving (object):
+    """A space-saving sketch of weighted counts, tracking capacity users.
+
+    Counts of tracked users are overestimated by at most their error, and
+    any user whose true count is larger than the smallest tracked count is
+    tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # User to [count, error].
+        self.counts = {}
+        # (count, user) pairs, some outdated, for the smallest count.
+        self._heap = []
+
+    def update(self, user, weight):
+        counts, heap = self.counts, self._heap
+        entry = counts.get(user)
+        if entry is not None:
+            entry[0] += weight
+        elif len(counts) < self.capacity:
+            entry = counts[user] = [weight, 0]
+        else:
+            # Replace the user with the smallest count.
+            while True:
+                smallest, evicted = heapq.heappop(heap)
+                evicted_entry = counts.get(evicted)
+                if evicted_entry is not None and evicted_entry[0] == smallest:
+                    break
+            del counts[evicted]
+            entry = counts[user] = [smallest + weight, smallest]
+        heapq.heappush(heap, (entry[0], user))
+        if len(heap) > 4 * self.capacity:
+            # Drop the outdated pairs.
+            self._heap = [(count, tracked) for tracked, (count, _)
+                          in counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def top(self, n):
+        "Return the (user, count, error) of the n users with highest counts."
+        return [(user, count, error) for user, (count, error) in
+                heapq.nlargest(n, self.counts.iteritems(),
+                               key=lambda item: item[1][0])]
+
+
+###############################################################################
+
+class Leaderboard (object):
+    "The top k users of the last packet, and the heavy hitters over time."
+
+    def __init__(self, k, sketch_capacity=None):
+        """Takes the number of users to keep for the last packet, and the size
+        of the heavy hitters sketch (none if not given).
+        """
+        self.k = k
+        self.sketch = SpaceSaving(sketch_capacity) if sketch_capacity else None
+        # The last packet, and its top k (user, value) pairs.
+        self.ranked = None
+        self.current = []
+
+    def update(self, packet):
+        "Rank the users of a packet, a user to value mapping."
+        self.ranked = packet
+        self.current = heapq.nlargest(self.k, packet.iteritems(),
+                                      key=itemgetter(1))
+        if self.sketch is not None:
+            update = self.sketch.update
+            for user, value in packet.iteritems():
+                if value > 0:
+                    update(user, value)
+
+    def top(self, n=None):
+        "Return the (user, value) pairs of the top n users of the last packet."
+        return self.current[:n]
+
+    def heavy_hitters(self, n=None):
+        """Return the (user, sum, error) of the n users with the highest sum
+        of values so far. Sums are overestimated by at most their error.
+        """
+        if self.sketch is None:
+            return []
+        return self.sketch.top(n or self.sketch.capacity)
+
+
+def top_packet(data, n):
+    """Return the top n users of a data packet, as a data packet. The ranking
+    of the pusher is used if the packet has it.
+    """
+    leaderboard = getattr(data, 'leaderboard', None)
+    if (leaderboard is not None and leaderboard.ranked is data
+            and leaderboard.k >= n):
+        ranked = leaderboard.top(n)
+    else:
+        ranked = heapq.nlargest(n, data.iteritems(), key=itemgetter(1))
+    top = data.__class__(ranked)
+    if hasattr(data, '__dict__'):
+        # Keep the stamps of the packet.
+        top.__dict__.update(data.__dict__)
+    return top
+
+
+def query_routes(leaderboard):
+    """Return the routes of the query API of a leaderboard, for a
+    MetricsServer: "/top" and "/heavy-hitters", both taking the number of
+    users as "n" (as in /top?n=10).
+    """
+    def _count(params, default):
+        n = int(params.get('n', [default])[0])
+        if n < 1:
+            raise ValueError('n must be positive.')
+        return n
+
+    def top(params):
+        return [{'username': user, 'count': value}
+                for user, value in leaderboard.top(_count(params,
+                                                          leaderboard.k))]
+
+    def heavy_hitters(params):
+        return [{'username': user, 'sum': total, 'error': error}
+                for user, total, error in leaderboard.heavy_hitters(
+                    _count(params, leaderboard.k))]
+
+    return {'/top': top, '/heavy-hitters': heavy_hitters}
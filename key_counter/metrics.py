@@ -0,0 +1,202 @@
+"""Counters and histograms for instrumenting the hot paths, and an HTTP
+endpoint exposing them in the Prometheus text format.
+
+Updating a metric is just an addition (and a bisect, for histograms): all
+formatting happens when the endpoint is scraped.
+"""
+from gevent.pywsgi import WSGIServer
+import urlparse
+import bisect
+import json
+
+import logging
+logger = logging.getLogger('metrics')
+
+# Default histogram buckets, for durations in seconds.
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (name, value.replace('\\', r'\\')
+                            .replace('"', r'\"').replace('\n', r'\n'))
+               for name, value in labels)
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+###############################################################################
+
+class Counter (object):
+    "A value that only goes up."
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram (object):
+    "Counts of observed values, per bucket, and their sum."
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket, plus the values larger than every bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield ('%s_bucket' % name,
+                   labels + (('le', _format_number(bound)),), cumulative)
+        yield '%s_sum' % name, labels, self.sum
+        yield '%s_count' % name, labels, cumulative
+
+
+class Family (object):
+    """A metric, possibly split by the value of a label.
+
+    Without a label, the family is used as the metric itself.
+    """
+
+    def __init__(self, name, kind, help, label=None, **options):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label = label
+        self.options = options
+        self._children = {}
+        if label is None:
+            metric = self._make()
+            self._children[None] = metric
+            # Expose the metric's methods on the family.
+            for method in ('inc', 'observe'):
+                if hasattr(metric, method):
+                    setattr(self, method, getattr(metric, method))
+
+    def _make(self):
+        if self.kind == 'counter':
+            return Counter()
+        return Histogram(**self.options)
+
+    def labels(self, value):
+        "Return the metric for a label value, creating it if needed."
+        metric = self._children.get(value)
+        if metric is None:
+            metric = self._children[value] = self._make()
+        return metric
+
+    def remove(self, value):
+        "Forget the metric for a label value."
+        self._children.pop(value, None)
+
+    def get(self, value=None):
+        "Return the metric for a label value (None if without label)."
+        return self._children.get(value)
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for value, metric in sorted(self._children.items()):
+            labels = () if value is None else ((self.label, value),)
+            for name, sample_labels, number in metric.samples(self.name,
+                                                              labels):
+                lines.append('%s%s %s' % (name, _format_labels(sample_labels),
+                                          _format_number(number)))
+        return '\n'.join(lines)
+
+
+class Registry (object):
+    "A set of metric families, by name."
+
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, name, kind, help, label, **options):
+        family = self._families.get(name)
+        if family is None:
+            family = Family(name, kind, help, label, **options)
+            self._families[name] = family
+        elif family.kind != kind:
+            raise ValueError('Metric "%s" is already a %s.'
+                             % (name, family.kind))
+        return family
+
+    def counter(self, name, help, label=None):
+        "Return the counter family name, creating it if needed."
+        return self._family(name, 'counter', help, label)
+
+    def histogram(self, name, help, label=None, buckets=SECONDS_BUCKETS):
+        "Return the histogram family name, creating it if needed."
+        return self._family(name, 'histogram', help, label, buckets=buckets)
+
+    def exposition(self):
+        "Return every metric in the Prometheus text format."
+        return ''.join('%s\n' % self._families[name].exposition()
+                       for name in sorted(self._families))
+
+REGISTRY = Registry()
+
+
+###############################################################################
+
+class MetricsServer (object):
+    """Serve the metrics of a registry at /metrics, over HTTP.
+
+    Other paths can be served with routes, mapping each path to a function
+    taking the query parameters (as by urlparse.parse_qs) and returning the
+    response, to be JSON encoded. Functions raise ValueError for bad
+    parameters.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY,
+                 routes=None):
+        self.registry = registry
+        self.routes = routes or {}
+        self.server = WSGIServer((host, port), self.application, log=None)
+
+    def application(self, environ, start_response):
+        path = environ['PATH_INFO']
+        content_type = 'application/json'
+        if path == '/metrics':
+            status = '200 OK'
+            body = self.registry.exposition()
+            content_type = 'text/plain; version=0.0.4'
+        elif path in self.routes:
+            params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            try:
+                status, body = '200 OK', self.routes[path](params)
+            except ValueError as e:
+                status, body = '400 Bad Request', {'error': str(e)}
+            body = json.dumps(body)
+        else:
+            status, body = '404 Not Found', 'Not found.\n'
+            content_type = 'text/plain'
+        start_response(status, [('Content-Type', content_type),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def start(self):
+        self.server.start()
+        logger.info("Serving metrics at http://%s:%s/metrics"
+                    % self.server.address)
+
+    def stop(self):
+        self.server.stop()
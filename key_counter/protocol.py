@@ -0,0 +1,178 @@
+"""Wire formats for the key counts sent to a NumbersServer.
+
+Three payloads are understood, all carried by a single UDP datagram:
+
+The original single record, a JSON object:
+
+    {"user": (string), "count": (number)}
+
+A versioned JSON batch, carrying many records at once:
+
+    {"version": 1, "counts": [[(string), (number)], ...]}
+
+A compact binary batch. A header with a magic, the version and the number of
+records, followed by each record as a length-prefixed UTF-8 username and a
+fixed-width unsigned counter (all in network byte order):
+
+    "KC" | version (1 byte) | records (2 bytes)
+    name length (1 byte) | name (UTF-8) | count (8 bytes)
+    ...
+"""
+import json
+import struct
+
+VERSION = 1
+
+BINARY_MAGIC = 'KC'
+_HEADER = struct.Struct('!2sBH')
+_NAME_LENGTH = struct.Struct('!B')
+_COUNT = struct.Struct('!Q')
+
+# Largest number of records the binary header can announce.
+MAX_BINARY_RECORDS = 0xFFFF
+# Largest encoded username the binary format can carry.
+MAX_NAME_LENGTH = 0xFF
+# Largest count the binary format can carry.
+MAX_COUNT = 0xFFFFFFFFFFFFFFFF
+# Largest count decoded, as managers keep counts as signed 64 bit integers.
+MAX_DECODED_COUNT = 0x7FFFFFFFFFFFFFFF
+
+
+###############################################################################
+
+def encode_single(user, count):
+    "Encode a single (user, count) record as in the original JSON format."
+    return json.dumps({'user': user, 'count': count})
+
+
+def encode_json_batch(records):
+    "Encode an iterable of (user, count) pairs as a JSON batch."
+    return json.dumps({'version': VERSION,
+                       'counts': [[user, count] for user, count in records]})
+
+
+def encode_binary_batch(records):
+    """Encode an iterable of (user, count) pairs as a binary batch.
+
+    Raise ValueError if the records do not fit the binary format.
+    """
+    chunks = []
+    for user, count in records:
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        if len(user) > MAX_NAME_LENGTH:
+            raise ValueError('username too long for a binary batch.')
+        if not 0 <= count <= MAX_COUNT:
+            raise ValueError('count %s out of range for a binary batch.'
+                             % count)
+        chunks.append(_NAME_LENGTH.pack(len(user)))
+        chunks.append(user)
+        chunks.append(_COUNT.pack(count))
+    records_count = len(chunks) // 3
+    if records_count > MAX_BINARY_RECORDS:
+        raise ValueError('too many records for a binary batch.')
+    return (_HEADER.pack(BINARY_MAGIC, VERSION, records_count)
+            + ''.join(chunks))
+
+
+def binary_record_size(user):
+    "Return the number of bytes a record for user takes in a binary batch."
+    if isinstance(user, unicode):
+        user = user.encode('utf-8')
+    return _NAME_LENGTH.size + len(user) + _COUNT.size
+
+
+def encode_binary_batches(records, max_size):
+    """Encode an iterable of (user, count) pairs as binary batches of up to
+    max_size bytes each, and return the list of them.
+
+    Raise ValueError if a record does not fit the binary format, or a batch.
+    """
+    batches = []
+    batch = []
+    size = _HEADER.size
+    for user, count in records:
+        record_size = binary_record_size(user)
+        if _HEADER.size + record_size > max_size:
+            raise ValueError('record too large for a batch of %s bytes.'
+                             % max_size)
+        if size + record_size > max_size or len(batch) == MAX_BINARY_RECORDS:
+            batches.append(encode_binary_batch(batch))
+            batch = []
+            size = _HEADER.size
+        batch.append((user, count))
+        size += record_size
+    if batch:
+        batches.append(encode_binary_batch(batch))
+    return batches
+
+
+###############################################################################
+
+def decode(data):
+    """Return the list of (user, count) pairs carried by a datagram.
+
+    Any of the supported payloads is accepted. Raise ValueError for
+    malformed, or unsupported, data.
+    """
+    if data[:2] == BINARY_MAGIC:
+        return _decode_binary(data)
+    return _decode_json(data)
+
+
+def _count(value):
+    "Return a decoded count as a long, or raise ValueError if out of range."
+    count = long(value)
+    if not 0 <= count <= MAX_DECODED_COUNT:
+        raise ValueError('count %s out of range.' % count)
+    return count
+
+
+def _user(value):
+    "Return a decoded username, or raise ValueError if not a string."
+    if not isinstance(value, basestring):
+        raise ValueError('username is not a string.')
+    return value
+
+
+def _decode_json(data):
+    try:
+        message = json.loads(data)
+        if 'version' not in message:
+            return [(_user(message['user']), _count(message['count']))]
+        if message['version'] != VERSION:
+            raise ValueError('unsupported batch version %s.'
+                             % message['version'])
+        return [(_user(user), _count(count))
+                for user, count in message['counts']]
+    except (KeyError, TypeError, AttributeError):
+        # KeyError due to missing entries, TypeError due to a bad number or
+        # record, AttributeError due to a JSON value other than an object.
+        raise ValueError('malformed JSON payload.')
+
+
+def _decode_binary(data):
+    try:
+        _, version, records_count = _HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError('unsupported batch version %s.' % version)
+        records = []
+        offset = _HEADER.size
+        for _ in xrange(records_count):
+            length, = _NAME_LENGTH.unpack_from(data, offset)
+            offset += _NAME_LENGTH.size
+            user = data[offset:offset + length]
+            if len(user) != length:
+                raise ValueError('truncated username.')
+            user = user.decode('utf-8')
+            offset += length
+            count, = _COUNT.unpack_from(data, offset)
+            offset += _COUNT.size
+            if count > MAX_DECODED_COUNT:
+                raise ValueError('count %s out of range.' % count)
+            records.append((user, count))
+    except struct.error:
+        raise ValueError('truncated binary payload.')
+    except UnicodeDecodeError:
+        raise ValueError('username is not valid UTF-8.')
+    return records
@@ -0,0 +1,197 @@
+"""Bulk receive engine for key counts.
+
+gevent's DatagramServer reads a single datagram per wakeup, and dispatches it
+on its own. The BulkNumbersServer here drains the socket instead: with
+recvmmsg(2) (through ctypes) where available, else with a tight non-blocking
+recv_into() loop over preallocated buffers. Received datagrams are decoded and
+handed to the manager as a single batch.
+"""
+from gevent.socket import wait_read
+import ctypes
+import ctypes.util
+import gevent
+import socket
+import errno
+
+import protocol
+from core import (SO_REUSEPORT, set_rcvbuf, DATAGRAMS_RECEIVED,
+                  DATAGRAMS_REJECTED)
+
+import logging
+
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+
+
+###############################################################################
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    "Return the recvmmsg() function of libc, or None if not available."
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                         ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+
+class MultipleReceiver (object):
+    "Read up to batch datagrams per recvmmsg() call."
+
+    def __init__(self, sock, batch, buffer_size):
+        self.fd = sock.fileno()
+        self.batch = batch
+        self._buffers = [ctypes.create_string_buffer(buffer_size)
+                         for _ in range(batch)]
+        self._iovecs = (_iovec * batch)()
+        self._headers = (_mmsghdr * batch)()
+        for i, buf in enumerate(self._buffers):
+            self._iovecs[i].iov_base = ctypes.addressof(buf)
+            self._iovecs[i].iov_len = buffer_size
+            self._headers[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._headers[i].msg_hdr.msg_iovlen = 1
+
+    def drain(self):
+        "Return a list of the datagrams ready to be read, possibly empty."
+        received = _recvmmsg(self.fd, self._headers, self.batch,
+                             MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in _RETRY_ERRNOS:
+                return []
+            raise socket.error(error, 'recvmmsg() failed.')
+        headers, buffers = self._headers, self._buffers
+        return [ctypes.string_at(buffers[i], headers[i].msg_len)
+                for i in xrange(received)
+                if not headers[i].msg_hdr.msg_flags & MSG_TRUNC]
+
+
+class SingleReceiver (object):
+    "Read up to batch datagrams, one recv_into() call each."
+
+    def __init__(self, sock, batch, buffer_size):
+        self.sock = sock
+        self._buffers = [bytearray(buffer_size) for _ in range(batch)]
+
+    def drain(self):
+        "Return a list of the datagrams ready to be read, possibly empty."
+        datagrams = []
+        recv_into = self.sock.recv_into
+        for buf in self._buffers:
+            try:
+                size = recv_into(buf)
+            except socket.error as e:
+                if e.args[0] in _RETRY_ERRNOS:
+                    break
+                raise
+            datagrams.append(str(buf[:size]))
+        return datagrams
+
+
+###############################################################################
+
+class BulkNumbersServer (object):
+    """Persistent server capable of receiving key counts in bulk.
+
+    A replacement for NumbersServer, under bursty load it takes far fewer
+    wakeups and system calls per datagram.
+    """
+    logger = logging.getLogger('network')
+
+    def __init__(self, port, manager, batch=64, buffer_size=8192,
+                 rcvbuf=None, reuse_port=False, recvmmsg=True):
+        """Takes the port to listen at and a data manager.
+
+        Up to batch datagrams of buffer_size bytes are read at once. The
+        socket receive buffer size is set to rcvbuf if given. Pass
+        recvmmsg=False to never use recvmmsg().
+        """
+        self.port = port
+        self.manager = manager
+        self.batch = batch
+        self.buffer_size = buffer_size
+        self.rcvbuf = rcvbuf
+        self.reuse_port = reuse_port
+        self.use_recvmmsg = recvmmsg and _recvmmsg is not None
+        self.socket = None
+        self._loop = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.rcvbuf:
+            set_rcvbuf(sock, self.rcvbuf, self.logger)
+        sock.bind(('', self.port))
+        sock.setblocking(0)
+        self.socket = sock
+
+        if self.use_recvmmsg:
+            receiver = MultipleReceiver(sock, self.batch, self.buffer_size)
+        else:
+            receiver = SingleReceiver(sock, self.batch, self.buffer_size)
+        self._loop = gevent.spawn(self.receive_loop, receiver)
+
+    def serve_forever(self):
+        if self._loop is None:
+            self.start()
+        self._loop.join()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.kill()
+            self._loop = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def receive_loop(self, receiver):
+        fd = self.socket.fileno()
+        while True:
+            wait_read(fd)
+            datagrams = receiver.drain()
+            while datagrams:
+                self.handle_many(datagrams)
+                if len(datagrams) < self.batch:
+                    break
+                # Full batches keep coming, let the other greenlets run.
+                gevent.sleep(0)
+                datagrams = receiver.drain()
+
+    def handle_many(self, datagrams):
+        records = []
+        DATAGRAMS_RECEIVED.inc(len(datagrams))
+        for data in datagrams:
+            try:
+                records.extend(protocol.decode(data))
+            except ValueError:
+                DATAGRAMS_REJECTED.inc()
+                self.logger.warn('bad data ignored.')
+        self.manager.aggregate_batch(records)
@@ -0,0 +1,119 @@
+"""Relay key counts from nearby clients to a central NumbersServer.
+
+A relay accepts the datagrams clients would send to the central server (any
+of the protocol payloads), keeps the latest count of each user, and forwards
+them every interval as binary batches. The central server then receives a
+few datagrams per relay and interval, instead of one per user and send.
+"""
+from gevent import socket
+import gevent
+
+from core import NumbersManager, NumbersServer
+from clock import monotonic
+import protocol
+import metrics
+
+import logging
+
+# Largest datagram forwarded, so batches are not fragmented on Ethernet.
+MAX_DATAGRAM = 1472
+
+DATAGRAMS_FORWARDED = metrics.REGISTRY.counter(
+    'key_counter_relay_datagrams_forwarded_total',
+    'Datagrams forwarded upstream by the relay.')
+
+
+###############################################################################
+
+class NumbersRelay (object):
+    "Aggregate key counts locally, and forward them upstream in batches."
+
+    logger = logging.getLogger('network.relay')
+
+    def __init__(self, port, upstream, interval=1, max_datagram=MAX_DATAGRAM,
+                 server_class=NumbersServer, **server_kwargs):
+        """Takes the port to listen at, the upstream (host, port) address, and
+        the forward interval (defaults to 1 second).
+
+        The datagrams forwarded are up to max_datagram bytes. Clients are
+        received by a server_class server, built with the other keyword
+        arguments.
+        """
+        self.upstream = upstream
+        self.interval = interval
+        self.max_datagram = max_datagram
+        self.manager = NumbersManager()
+        self.server = server_class(port, self.manager, **server_kwargs)
+        self.running = False
+        self._socket = None
+
+    def start(self):
+        "Start receiving, and forwarding every interval."
+        self._socket = socket.socket(type=socket.SOCK_DGRAM)
+        self._socket.connect(self.upstream)
+        self.server.start()
+        self.running = True
+        gevent.spawn(self._forward_loop)
+
+    def stop(self):
+        "Stop receiving, and forward what was received so far."
+        self.running = False
+        self.server.stop()
+        if self._socket is not None:
+            self.forward()
+            self._socket.close()
+            self._socket = None
+
+    def _forward_loop(self):
+        # Aligned to absolute deadlines, as NumbersPusher ticks are.
+        next_tick = monotonic() + self.interval
+        while self.running:
+            gevent.sleep(max(0, next_tick - monotonic()))
+            if not self.running:
+                break
+            try:
+                self.forward()
+            except Exception:
+                # Keep forwarding the counts received next.
+                self.logger.exception("Forward failed.")
+            next_tick += self.interval
+            late = monotonic() - next_tick
+            if late > 0:
+                next_tick += (int(late // self.interval) + 1) * self.interval
+
+    def forward(self):
+        "Send the counts received since the last forward upstream."
+        aggregated = self.manager.pop_aggregated()
+        if not aggregated:
+            return
+        records = []
+        datagrams = []
+        for user, count in aggregated.iteritems():
+            if not isinstance(user, basestring):
+                self.logger.warn("User %r is not a name, not forwarded.",
+                                 user)
+                continue
+            if not 0 <= count <= protocol.MAX_COUNT:
+                self.logger.warn("Count %s of %r out of range, not "
+                                 "forwarded.", count, user)
+                continue
+            name = user.encode('utf-8') if isinstance(user, unicode) else user
+            if len(name) > protocol.MAX_NAME_LENGTH:
+                # Too long a name for a binary batch.
+                datagrams.append(protocol.encode_single(user, count))
+            else:
+                records.append((user, count))
+        datagrams.extend(protocol.encode_binary_batches(records,
+                                                        self.max_datagram))
+        for datagram in datagrams:
+            try:
+                self._socket.send(datagram)
+            except socket.error as e:
+                # Upstream unreachable. Counts are cumulative, the next ones
+                # received make up for these.
+                self.logger.error("Forward to %s:%s failed: %s",
+                                  self.upstream[0], self.upstream[1], e)
+                return
+            DATAGRAMS_FORWARDED.inc()
+        self.logger.debug("Forwarded %s users in %s datagrams.",
+                          len(aggregated), len(datagrams))
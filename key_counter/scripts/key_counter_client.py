@@ -1,9 +1,10 @@
-from multiprocessing import Process, Value
+from multiprocessing import Process, Value, Event
+import subprocess
 import argparse
 import socket
 import time
 import json
-import sh
+import os
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -12,40 +13,87 @@ logger = logging.getLogger(__file__)
 
 ###############################################################################
 
-def send_count(server_addr, server_port, user, value):
-    sock = socket.socket(type=socket.SOCK_DGRAM)
-    data = {'user': user, 'count': value}
-    message = json.dumps(data)
-    sock.connect((server_addr, server_port))
-    sock.send(message)
+class CountSender (object):
+    """Send the count of a user to the server, through a socket connected
+    once. Only the count is encoded on each send.
+    """
+
+    def __init__(self, server_addr, server_port, user):
+        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.sock.connect((server_addr, server_port))
+        # Same payload as json.dumps({'user': user, 'count': value}).
+        self.prefix = '{"user": %s, "count": ' % json.dumps(user)
+
+    def send(self, value):
+        try:
+            self.sock.send('%s%d}' % (self.prefix, value))
+        except socket.error as e:
+            # Nobody listening (yet), the next count makes up for this one.
+            logger.warn("Send failed: %s" % e)
 
 
 ###############################################################################
 
-def publish_count(counter, interval, send_count):
+# Seconds between checks for an interrupt, while waiting for changes.
+WAIT_TIMEOUT = 60
+
+
+def publish_count(counter, changed, interval, send_count):
     """Use send_count() to send the data to server.
 
-    Data is sent at "interval", but only if new data is collected.
+    Data is sent as soon as the counter changes (signalled by the changed
+    event), but at most once every "interval".
     """
     current_value = counter.value
     try:
         while True:
-            time.sleep(interval)
+            # A timeout keeps the wait interruptible.
+            if not changed.wait(WAIT_TIMEOUT):
+                continue
+            changed.clear()
+            sent = time.time()
             if counter.value != current_value:
                 current_value = counter.value
                 send_count(current_value)
+            time.sleep(max(0, sent + interval - time.time()))
     except KeyboardInterrupt:
         logger.info("Stoping send-counter process.")
 
 
 ###############################################################################
 
-def key_counter(counter, keyboard_id):
-    def incr_counter(line):
-        if "press" in line:
-            counter.value += 1
+# Marker of a key press in the "xinput test" output ("key press   38").
+PRESS = "press"
+# Bytes read from xinput at once.
+READ_SIZE = 4096
+
+
+def count_presses(stream, counter, changed):
+    """Read the "xinput test" output from the stream (a file descriptor) in
+    blocks, and add the presses of each block to the counter at once.
+    """
+    # End of the previous block, in case a marker spans two blocks. Shorter
+    # than the marker, so no marker is counted twice.
+    tail = ''
+    while True:
+        block = os.read(stream, READ_SIZE)
+        if not block:
+            break
+        data = tail + block
+        presses = data.count(PRESS)
+        tail = data[-(len(PRESS) - 1):]
+        if presses:
+            with counter.get_lock():
+                counter.value += presses
+            changed.set()
+
+
+def key_counter(counter, changed, keyboard_id):
+    xinput = subprocess.Popen(['xinput', 'test', str(keyboard_id)],
+                              stdout=subprocess.PIPE)
     try:
-        sh.xinput('test', keyboard_id, _out=incr_counter).wait()
+        count_presses(xinput.stdout.fileno(), counter, changed)
+        xinput.wait()
     except KeyboardInterrupt:
         logger.info("Stopping key-counter process.")
 
@@ -77,13 +125,14 @@ if __name__ == '__main__':
         args.interval = INTERVAL
 
     # Specify the processing functions.
-    def send_data(value):
-        return send_count(args.server, args.port, args.user, value)
+    sender = CountSender(args.server, args.port, args.user)
 
     # Setup shared data structures.
     counter = Value('L', 0)
+    changed = Event()
 
     logger.info("Sending data to %s:%s" % (args.server, args.port))
-    Process(target=key_counter, args=(counter, args.keyboard_id)).start()
-    Process(target=publish_count, args=(counter, args.interval,
-                                        send_data)).start()
+    Process(target=key_counter,
+            args=(counter, changed, args.keyboard_id)).start()
+    Process(target=publish_count, args=(counter, changed, args.interval,
+                                        sender.send)).start()
@@ -0,0 +1,68 @@
+from gevent import monkey
+monkey.patch_all(thread=False)
+
+import gevent
+import argparse
+import key_counter.core
+import key_counter.relay
+import key_counter.receive
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('relay')
+
+###############################################################################
+
+CONNECTION_PORT = 55555
+INTERVAL = 1.0  # seconds
+ENGINE_GEVENT = 'gevent'
+ENGINE_BULK = 'bulk'
+
+if __name__ == '__main__':
+
+    # Parse the arguments for the upstream server, ports and interval.
+    parser = argparse.ArgumentParser(
+        description=("Receive key counts from clients, and forward them to a "
+                     "server in batches."))
+    parser.add_argument("server", help="server hostname or address")
+    parser.add_argument(
+        "-p", "--port", type=int, default=CONNECTION_PORT,
+        help=("server port (defaults to %s)" % CONNECTION_PORT))
+    parser.add_argument(
+        "-l", "--listen-port", type=int, default=CONNECTION_PORT,
+        help=("port to receive clients at (defaults to %s)"
+              % CONNECTION_PORT))
+    parser.add_argument(
+        "-i", "--interval", type=float, default=INTERVAL,
+        help=("forwarding interval, in seconds (defaults to %s)" % INTERVAL))
+    parser.add_argument(
+        "--max-datagram", type=int, default=key_counter.relay.MAX_DATAGRAM,
+        help=("largest datagram forwarded, in bytes (defaults to %s)"
+              % key_counter.relay.MAX_DATAGRAM))
+    parser.add_argument(
+        "-e", "--engine", choices=[ENGINE_GEVENT, ENGINE_BULK],
+        default=ENGINE_GEVENT,
+        help=("how to receive client data: a datagram at a time, or draining "
+              "the socket in bulk (defaults to %s)" % ENGINE_GEVENT))
+    parser.add_argument(
+        "--rcvbuf", type=int,
+        help="socket receive buffer size, in bytes (defaults to the system's)")
+    args = parser.parse_args()
+
+    if args.engine == ENGINE_BULK:
+        server_class = key_counter.receive.BulkNumbersServer
+    else:
+        server_class = key_counter.core.NumbersServer
+    relay = key_counter.relay.NumbersRelay(
+        args.listen_port, (args.server, args.port), args.interval,
+        max_datagram=args.max_datagram, server_class=server_class,
+        rcvbuf=args.rcvbuf)
+
+    logger.info("Relaying user data from *:%s to %s:%s"
+                % (args.listen_port, args.server, args.port))
+    relay.start()
+    try:
+        gevent.wait()
+    except KeyboardInterrupt:
+        logger.info('Closing connections.')
+        relay.stop()
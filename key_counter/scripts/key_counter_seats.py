@@ -0,0 +1,151 @@
+"""Count the keys of many keyboards, each for its own user, in one process.
+
+Keyboards are read as evdev devices (/dev/input/event*, see "ls -l
+/dev/input/by-path" or "cat /proc/bus/input/devices" to find them), so the
+user running this needs read access to them, usually by being in the "input"
+group. The counts of every user are sent together, as one binary batch.
+"""
+import argparse
+import select
+import socket
+import struct
+import errno
+import os
+
+from key_counter.clock import monotonic
+from key_counter import protocol
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__file__)
+
+# struct input_event, from linux/input.h: a timeval, type, code and value.
+INPUT_EVENT = struct.Struct('llHHi')
+EV_KEY = 1
+# Value of a key event on press (0 is release, 2 is auto-repeat).
+KEY_PRESS = 1
+# Events read per device at once.
+READ_EVENTS = 64
+
+
+###############################################################################
+
+class Seats (object):
+    "Count key presses on many input devices, by user."
+
+    def __init__(self, devices):
+        "Takes a list of (device path, user) pairs."
+        self.counts = {}
+        self._users = {}
+        self._files = {}
+        self._poll = select.epoll()
+        for path, user in devices:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            self._files[fd] = path
+            self._users[fd] = user
+            self.counts.setdefault(user, 0)
+            self._poll.register(fd, select.EPOLLIN)
+
+    def wait(self, timeout):
+        "Count the presses of the devices ready within timeout seconds."
+        try:
+            ready = self._poll.poll(timeout)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        for fd, _ in ready:
+            self._read(fd)
+
+    def _read(self, fd):
+        try:
+            data = os.read(fd, INPUT_EVENT.size * READ_EVENTS)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            # Most likely unplugged (ENODEV).
+            logger.error("Stopped reading %s: %s" % (self._files[fd], e))
+            self._poll.unregister(fd)
+            os.close(fd)
+            del self._files[fd]
+            return
+        presses = 0
+        for offset in xrange(0, len(data) - INPUT_EVENT.size + 1,
+                             INPUT_EVENT.size):
+            _, _, kind, _, value = INPUT_EVENT.unpack_from(data, offset)
+            if kind == EV_KEY and value == KEY_PRESS:
+                presses += 1
+        if presses:
+            self.counts[self._users[fd]] += presses
+
+    def close(self):
+        for fd in self._files:
+            os.close(fd)
+        self._poll.close()
+
+
+###############################################################################
+
+def publish_counts(seats, interval, sock):
+    """Send the counts of the users whose count changed, as one batch, every
+    "interval".
+    """
+    sent = dict(seats.counts)
+    next_publish = monotonic() + interval
+    try:
+        while True:
+            seats.wait(max(0, next_publish - monotonic()))
+            if monotonic() < next_publish:
+                continue
+            next_publish += interval
+            changed = [(user, count) for user, count in seats.counts.items()
+                       if count != sent[user]]
+            if not changed:
+                continue
+            try:
+                sock.send(protocol.encode_binary_batch(changed))
+            except socket.error as e:
+                logger.warn("Send failed: %s" % e)
+                continue
+            sent.update(changed)
+    except KeyboardInterrupt:
+        logger.info("Stopping the seats process.")
+
+
+###############################################################################
+
+CONNECTION_PORT = 55555
+INTERVAL = 2.0  # seconds
+
+if __name__ == '__main__':
+
+    # Parse the arguments for devices, users, host and port.
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("server", help="server hostname or address")
+    parser.add_argument(
+        "seats", nargs='+', metavar='DEVICE=USER',
+        help="an input device, and the username to associate its data to")
+    parser.add_argument(
+        "-p", "--port", type=int, default=CONNECTION_PORT,
+        help=("server port (defaults to %s)" % CONNECTION_PORT))
+    parser.add_argument(
+        "-i", "--interval", type=float, default=INTERVAL,
+        help=("publishing interval, in seconds (defaults to %s)" % INTERVAL))
+    args = parser.parse_args()
+
+    devices = []
+    for seat in args.seats:
+        path, separator, user = seat.partition('=')
+        if not separator or not user:
+            parser.error('"%s" is not a DEVICE=USER pair.' % seat)
+        devices.append((path, user.decode('utf-8')))
+
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.connect((args.server, args.port))
+    seats = Seats(devices)
+    logger.info("Sending data of %s users to %s:%s"
+                % (len(seats.counts), args.server, args.port))
+    try:
+        publish_counts(seats, args.interval, sock)
+    finally:
+        seats.close()
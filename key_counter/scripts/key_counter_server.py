@@ -1,7 +1,16 @@
+from gevent import monkey
+# Cooperative sockets, so that pushes to slow upstreams run concurrently.
+# Threads are left alone, some push strategies use real ones.
+monkey.patch_all(thread=False)
+
 import gevent
 import argparse
 import key_counter.core
 import key_counter.config
+import key_counter.workers
+import key_counter.receive
+import key_counter.metrics
+import key_counter.leaderboard
 
 ###############################################################################
 
@@ -43,6 +52,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'DEBUG',
         },
+        'metrics': {
+            'handlers': ['console'],
+            'level': 'DEBUG',
+        },
     }
 }
 import logging
@@ -54,6 +67,13 @@ logger = logging.getLogger('server')
 
 CONNECTION_PORT = 55555
 PUSH_INTERVAL = 3.0  # seconds
+STORAGE_DICT = 'dict'
+STORAGE_ARRAY = 'array'
+STORAGE_SHARDED = 'sharded'
+ENGINE_GEVENT = 'gevent'
+ENGINE_BULK = 'bulk'
+# Users tracked for heavy hitters, per top user asked for.
+HEAVY_HITTERS_FACTOR = 10
 
 if __name__ == '__main__':
 
@@ -69,6 +89,48 @@ if __name__ == '__main__':
         "-i", "--interval", type=float,
         help=("publishing interval, in seconds (defaults to %s)"
               % PUSH_INTERVAL))
+    parser.add_argument(
+        "-s", "--storage",
+        choices=[STORAGE_DICT, STORAGE_ARRAY, STORAGE_SHARDED],
+        default=STORAGE_DICT,
+        help=("how to store user counts: plain dicts, interned users and "
+              "typed arrays for large user counts, or dicts sharded by user "
+              "for ingest from many threads (defaults to %s)"
+              % STORAGE_DICT))
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1,
+        help=("number of processes receiving user data at the same port "
+              "(defaults to 1)"))
+    parser.add_argument(
+        "-e", "--engine", choices=[ENGINE_GEVENT, ENGINE_BULK],
+        default=ENGINE_GEVENT,
+        help=("how to receive user data: a datagram at a time, or draining "
+              "the socket in bulk (defaults to %s)" % ENGINE_GEVENT))
+    parser.add_argument(
+        "--rcvbuf", type=int,
+        help="socket receive buffer size, in bytes (defaults to the system's)")
+    parser.add_argument(
+        "--max-users", type=int,
+        help="most users tracked (defaults to no limit)")
+    parser.add_argument(
+        "--policy", choices=key_counter.core.POLICIES,
+        help=("what to do with new users beyond --max-users: reject them, "
+              "sample them, or forget the least recently updated users "
+              "(array storage only, its default; reject is the default of "
+              "the dict storage)"))
+    parser.add_argument(
+        "--ttl", type=float,
+        help=("seconds without data before a user is forgotten (array "
+              "storage only, defaults to never)"))
+    parser.add_argument(
+        "-m", "--metrics-port", type=int,
+        help=("serve metrics, in the Prometheus text format, at "
+              "http://localhost:PORT/metrics (datagram counts are missing "
+              "with several workers)"))
+    parser.add_argument(
+        "-t", "--top", type=int,
+        help=("rank the top TOP users, and the heavy hitters, answered at "
+              "/top and /heavy-hitters by the metrics server"))
     args = parser.parse_args()
     if not args.port:
         args.port = CONNECTION_PORT
@@ -76,9 +138,52 @@ if __name__ == '__main__':
         args.interval = PUSH_INTERVAL
 
     # Initialize core components.
-    manager = key_counter.core.NumbersManager()
-    server = key_counter.core.NumbersServer(args.port, manager)
+    bounds = {'max_users': args.max_users}
+    if args.policy:
+        bounds['policy'] = args.policy
+    if args.storage == STORAGE_ARRAY:
+        if args.ttl:
+            # In packets.
+            bounds['ttl'] = max(1, int(round(args.ttl / args.interval)))
+        manager = key_counter.core.InternedNumbersManager(**bounds)
+    elif args.ttl:
+        parser.error("--ttl needs the array storage.")
+    elif args.storage == STORAGE_SHARDED:
+        if args.max_users or args.policy:
+            parser.error("--max-users needs the dict or array storage.")
+        manager = key_counter.core.ShardedNumbersManager()
+    elif args.policy == key_counter.core.POLICY_LRU:
+        parser.error("--policy lru needs the array storage.")
+    else:
+        manager = key_counter.core.NumbersManager(**bounds)
+    if args.engine == ENGINE_BULK:
+        server_class = key_counter.receive.BulkNumbersServer
+    else:
+        server_class = key_counter.core.NumbersServer
+    workers = None
+    server = None
+    if args.workers > 1:
+        # Fork before anything else runs, workers inherit every greenlet.
+        workers = key_counter.workers.IngestWorkers(
+            args.port, args.workers, server_class=server_class,
+            timeout=args.interval, rcvbuf=args.rcvbuf)
+        workers.start()
+        manager = key_counter.workers.WorkersNumbersManager(manager, workers)
+    else:
+        server = server_class(args.port, manager, rcvbuf=args.rcvbuf)
     pusher = key_counter.core.NumbersPusher(manager, args.interval)
+    metrics_server = None
+    if args.metrics_port:
+        routes = {}
+        if args.top:
+            leaderboard = pusher.track_top(
+                args.top, sketch_capacity=args.top * HEAVY_HITTERS_FACTOR)
+            routes = key_counter.leaderboard.query_routes(leaderboard)
+        metrics_server = key_counter.metrics.MetricsServer(
+            args.metrics_port, routes=routes)
+        metrics_server.start()
+    elif args.top:
+        parser.error("--top needs --metrics-port.")
 
     # Initialize the configuration components.
     config_manager = key_counter.config.ConfigManager(pusher)
@@ -97,11 +202,19 @@ if __name__ == '__main__':
 
     try:
         logger.info("Receiving user data at *:%s" % args.port)
-        server.serve_forever()
+        if workers:
+            gevent.wait()
+        else:
+            server.serve_forever()
     except KeyboardInterrupt:
         logger.info('Closing connections.')
         file_config_manager.stop_watching()
-        pusher.stop()
-        server.stop()
+        pusher.close()
+        if metrics_server:
+            metrics_server.stop()
+        if workers:
+            workers.stop()
+        else:
+            server.stop()
         # Cushion wait.
         gevent.sleep(1)
@@ -0,0 +1,197 @@
+"""A bounded, on-disk queue of records, for pushes to retry later.
+
+Records are appended to segment files in a directory, each one a length (4
+bytes, little-endian) followed by the record. Segments are named after their
+sequence number, and a new one is started once the last is larger than
+segment_bytes. Records are read through memory maps of the segments, and
+consuming them moves a read position, saved to the "position" file. Fully
+consumed segments are removed.
+
+Once the spool is larger than max_bytes, its oldest segments are removed,
+consumed or not.
+"""
+import struct
+import mmap
+import os
+
+import logging
+
+_LENGTH = struct.Struct('<I')
+SEGMENT_SUFFIX = '.seg'
+POSITION_FILE = 'position'
+
+
+def _map(file_name):
+    "Memory-map a whole file for reading, or return '' if it is empty."
+    with open(file_name, 'rb') as mapped:
+        if os.fstat(mapped.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _complete_end(data):
+    "Return the offset where the complete records of a segment end."
+    offset = 0
+    while offset + _LENGTH.size <= len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        if offset + _LENGTH.size + length > len(data):
+            break
+        offset += _LENGTH.size + length
+    return offset
+
+
+###############################################################################
+
+class Spool (object):
+    "A bounded queue of records, kept in a directory."
+
+    logger = logging.getLogger('push.spool')
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024,
+                 segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        # Read position, as a segment and an offset in it.
+        self._position = self._load_position()
+        while self._segments and self._segments[0] < self._position[0]:
+            os.remove(self._segment_name(self._segments.pop(0)))
+        if not self._segments:
+            self._segments.append(self._position[0])
+        # The segment being read, memory-mapped.
+        self._map = ''
+        self._mapped = None
+        self._open_tail()
+        self._size = sum(os.path.getsize(self._segment_name(segment))
+                         for segment in self._segments)
+
+    def _segment_name(self, segment):
+        return os.path.join(self.directory,
+                            '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as saved:
+                segment, offset = saved.read().split()
+                return int(segment), int(offset)
+        except (IOError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def _save_position(self):
+        name = os.path.join(self.directory, POSITION_FILE)
+        with open(name + '.new', 'w') as saved:
+            saved.write('%s %s' % self._position)
+        os.rename(name + '.new', name)
+
+    def _open_tail(self):
+        "Open the last segment to append, dropping any partial record."
+        name = self._segment_name(self._segments[-1])
+        self._tail = open(name, 'ab')
+        data = _map(name)
+        end = _complete_end(data)
+        if end < len(data):
+            self.logger.warn("Dropping a partial record in %s." % name)
+            self._tail.truncate(end)
+            # Truncating does not move the position appends are told at.
+            self._tail.seek(end)
+        if data:
+            data.close()
+
+    def __len__(self):
+        "The number of bytes in the spool, consumed or not."
+        return self._size
+
+    def empty(self):
+        "Return whether every record was consumed."
+        return (self._position[0] == self._segments[-1]
+                and self._position[1] >= self._tail.tell())
+
+    def append(self, record):
+        "Add a record (a string) at the end of the queue."
+        if self._tail.tell() >= self.segment_bytes:
+            self._tail.close()
+            self._segments.append(self._segments[-1] + 1)
+            self._open_tail()
+        self._tail.write(_LENGTH.pack(len(record)))
+        self._tail.write(record)
+        self._tail.flush()
+        self._size += _LENGTH.size + len(record)
+        while self._size > self.max_bytes and len(self._segments) > 1:
+            self._evict()
+
+    def _evict(self):
+        "Remove the oldest segment."
+        segment = self._segments.pop(0)
+        name = self._segment_name(segment)
+        size = os.path.getsize(name)
+        if self._position[0] == segment:
+            self.logger.warn("Spool full, %s bytes of records dropped."
+                             % (size - self._position[1]))
+            self._position = (self._segments[0], 0)
+            self._save_position()
+        if self._mapped == segment:
+            self._unmap()
+        os.remove(name)
+        self._size -= size
+
+    def _unmap(self):
+        if self._map:
+            self._map.close()
+        self._map = ''
+        self._mapped = None
+
+    def _segment_data(self, segment, needed):
+        "Return the mapped data of a segment, at least needed bytes long."
+        if self._mapped != segment or len(self._map) < needed:
+            # Not mapped, or mapped before the segment grew.
+            self._unmap()
+            self._map = _map(self._segment_name(segment))
+            self._mapped = segment
+        return self._map
+
+    def read(self, count):
+        """Return up to count (record, position) pairs from the read position.
+        Pass a position to consume() to consume the records up to it.
+        """
+        records = []
+        segment, offset = self._position
+        while len(records) < count:
+            if segment == self._segments[-1]:
+                end = self._tail.tell()
+            else:
+                end = os.path.getsize(self._segment_name(segment))
+            if offset >= end:
+                if segment == self._segments[-1]:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            data = self._segment_data(segment, end)
+            length, = _LENGTH.unpack_from(data, offset)
+            start = offset + _LENGTH.size
+            offset = start + length
+            records.append((data[start:offset], (segment, offset)))
+        return records
+
+    def consume(self, position):
+        "Consume the records up to a position returned by read()."
+        if position[0] < self._segments[0]:
+            # Evicted meanwhile.
+            return
+        self._position = position
+        while self._segments[0] < position[0]:
+            segment = self._segments.pop(0)
+            if self._mapped == segment:
+                self._unmap()
+            name = self._segment_name(segment)
+            self._size -= os.path.getsize(name)
+            os.remove(name)
+        self._save_position()
+
+    def close(self):
+        self._unmap()
+        self._tail.close()
@@ -0,0 +1,255 @@
+"""Load generator and throughput benchmark for the ingest to push pipeline.
+
+Simulated clients, in processes of their own, send key counts over loopback
+UDP to a NumbersServer, whose NumbersManager is drained by a NumbersPusher
+into a "test" upstream. Reports received datagrams per second, drop rate,
+tick latency percentiles, CPU time and memory of the server process.
+
+Results can be saved as a JSON baseline, and compared against one:
+
+    python -m key_counter.tests.benchmark --clients 8 --rate 2000 \\
+        --users 10000 --duration 10 --output baseline.json
+    python -m key_counter.tests.benchmark ... --baseline baseline.json
+"""
+from multiprocessing import Process, Value
+import argparse
+import resource
+import socket
+import json
+import time
+import sys
+
+import gevent
+from key_counter import core
+from key_counter import protocol
+from key_counter import receive
+
+import logging
+logging.basicConfig()
+logger = logging.getLogger('benchmark')
+
+FORMATS = {
+    'single': lambda records: protocol.encode_single(*records[0]),
+    'json': protocol.encode_json_batch,
+    'binary': protocol.encode_binary_batch,
+}
+
+# Results where higher is better, the others are better lower.
+HIGHER_IS_BETTER = ['datagrams_per_second', 'records_per_second']
+
+
+###############################################################################
+
+def send_load(port, client, clients, users, rate, batch, encoding, duration,
+              sent):
+    """Send datagrams at rate per second for duration seconds, each with batch
+    records of the users of this client. Count them in sent.
+    """
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', port))
+    encode = FORMATS[encoding]
+    names = ['user %s' % i for i in xrange(client, users, clients)]
+    counts = [0] * len(names)
+    position = 0
+    start = time.time()
+    datagrams = 0
+    while True:
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+        # Send whatever is due, then wait for the next datagram.
+        due = int(elapsed * rate) - datagrams
+        if due <= 0:
+            time.sleep(1.0 / rate)
+            continue
+        for _ in xrange(due):
+            records = []
+            for _ in xrange(batch):
+                counts[position] += 1
+                records.append((names[position], counts[position]))
+                position = (position + 1) % len(names)
+            try:
+                sock.send(encode(records))
+            except socket.error:
+                # Loopback sends fail, instead of dropping, when full.
+                pass
+            datagrams += 1
+    sent.value = datagrams
+
+
+def percentile(values, fraction):
+    "Return the nearest-rank percentile of a list of values."
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, int(round(fraction * len(ordered))) - 1)
+    return ordered[rank]
+
+
+def current_rss():
+    "Return the resident set size of this process, in kilobytes."
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+###############################################################################
+
+def run(args):
+    "Run the benchmark, and return the results as a dict."
+    if args.storage == 'array':
+        manager = core.InternedNumbersManager()
+    else:
+        manager = core.NumbersManager()
+
+    # Count the records the manager gets.
+    received = {'records': 0}
+    aggregate_batch = manager.aggregate_batch
+
+    def counting_aggregate_batch(records):
+        if not isinstance(records, list):
+            records = list(records)
+        received['records'] += len(records)
+        aggregate_batch(records)
+    manager.aggregate_batch = counting_aggregate_batch
+
+    if args.engine == 'bulk':
+        server = receive.BulkNumbersServer(args.port, manager,
+                                           rcvbuf=args.rcvbuf)
+    else:
+        server = core.NumbersServer(args.port, manager, rcvbuf=args.rcvbuf)
+    pusher = core.NumbersPusher(manager, args.interval)
+    pusher.add_upstream('benchmark', 'test')
+
+    # Time each tick.
+    tick_latencies = []
+    tick = pusher._tick
+
+    def timed_tick():
+        start = time.time()
+        tick()
+        tick_latencies.append(time.time() - start)
+    pusher._tick = timed_tick
+
+    server.start()
+    senders = []
+    for client in range(args.clients):
+        sent = Value('L', 0)
+        sender = Process(target=send_load, args=(
+            args.port, client, args.clients, args.users, args.rate,
+            args.batch, args.format, args.duration, sent))
+        senders.append((sender, sent))
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    pusher.start()
+    for sender, _ in senders:
+        sender.start()
+    gevent.sleep(args.duration)
+    # Let the last datagrams in.
+    gevent.sleep(args.interval)
+    pusher.stop()
+    server.stop()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    for sender, _ in senders:
+        sender.join()
+
+    sent_datagrams = sum(sent.value for _, sent in senders)
+    sent_records = sent_datagrams * args.batch
+    records = received['records']
+    cpu = ((usage_after.ru_utime - usage_before.ru_utime)
+           + (usage_after.ru_stime - usage_before.ru_stime))
+    return {
+        'sent_datagrams': sent_datagrams,
+        'received_records': records,
+        'datagrams_per_second': records / float(args.batch) / args.duration,
+        'records_per_second': records / args.duration,
+        'drop_rate': (1 - records / float(sent_records)
+                      if sent_records else 0.0),
+        'ticks': len(tick_latencies),
+        'tick_latency_p50': percentile(tick_latencies, 0.5),
+        'tick_latency_p90': percentile(tick_latencies, 0.9),
+        'tick_latency_p99': percentile(tick_latencies, 0.99),
+        'tick_latency_max': max(tick_latencies) if tick_latencies else None,
+        'cpu_seconds': cpu,
+        'cpu_per_record_us': cpu / records * 1e6 if records else None,
+        'rss_kb': current_rss(),
+        'max_rss_kb': usage_after.ru_maxrss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    "Return a list of the results worse than the baseline by tolerance."
+    regressions = []
+    for key, value in results.items():
+        reference = baseline.get(key)
+        if key in ('sent_datagrams', 'received_records', 'ticks'):
+            continue
+        if not isinstance(value, (int, long, float)) or not reference:
+            continue
+        if key in HIGHER_IS_BETTER:
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance)
+        if worse:
+            regressions.append((key, reference, value))
+    return regressions
+
+
+###############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--clients", type=int, default=4,
+                        help="number of sending processes (defaults to 4)")
+    parser.add_argument("--rate", type=int, default=1000,
+                        help="datagrams per second, per client "
+                             "(defaults to 1000)")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="number of distinct users (defaults to 1000)")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="records per datagram (defaults to 1)")
+    parser.add_argument("--format", choices=sorted(FORMATS),
+                        default='single',
+                        help="datagram payload (defaults to single)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to send for (defaults to 10)")
+    parser.add_argument("--interval", type=float, default=1,
+                        help="push interval, in seconds (defaults to 1)")
+    parser.add_argument("--engine", choices=['gevent', 'bulk'],
+                        default='gevent')
+    parser.add_argument("--storage", choices=['dict', 'array'],
+                        default='dict')
+    parser.add_argument("--rcvbuf", type=int)
+    parser.add_argument("--port", type=int, default=55955)
+    parser.add_argument("--output", help="save the results to this file")
+    parser.add_argument("--baseline",
+                        help="compare the results with this saved file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change tolerated against the baseline "
+                             "(defaults to 0.1)")
+    args = parser.parse_args()
+    if args.format == 'single':
+        args.batch = 1
+
+    config = dict((key, value) for key, value in vars(args).items()
+                  if key not in ('output', 'baseline', 'tolerance'))
+    results = run(args)
+    report = {'config': config, 'results': results,
+              'python': sys.version.split()[0], 'time': time.time()}
+    print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != config:
+            logger.warn("Baseline ran with a different configuration.")
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for key, reference, value in regressions:
+            logger.error("Regression in %s: %s, was %s."
+                         % (key, value, reference))
+        if regressions:
+            sys.exit(1)
@@ -148,3 +148,71 @@ class Integration (unittest.TestCase):
         logger.info("removing the test config file.")
         import os
         os.remove(FILE)
+
+
+class IngestWorkersIntegration (unittest.TestCase):
+
+    PORT = 55655
+
+    def setUp(self):
+        from key_counter import workers
+        self.workers = workers.IngestWorkers(self.PORT, 3, timeout=0.5)
+        self.workers.start()
+        self.manager = workers.WorkersNumbersManager(core.NumbersManager(),
+                                                     self.workers)
+        self.pusher = core.NumbersPusher(self.manager, interval=1)
+        # Let the workers bind the port.
+        gevent.sleep(0.3)
+
+    def tearDown(self):
+        self.workers.stop()
+
+    def _send(self, records_by_client):
+        import socket
+        from key_counter import protocol
+        for records in records_by_client:
+            sock = socket.socket(type=socket.SOCK_DGRAM)
+            for user, count in records:
+                sock.sendto(protocol.encode_single(user, count),
+                            ('127.0.0.1', self.PORT))
+            sock.close()
+        gevent.sleep(0.3)
+
+    def test_collect(self):
+        self.assertEqual({}, self.manager.get_data_packet())
+        self._send([[('moe', 1), ('moe', 2)], [('larry', 5)],
+                    [('curly', 9)], [('shemp', 1)]])
+        self.assertEqual({'moe': 0, 'larry': 0, 'curly': 0, 'shemp': 0},
+                         self.manager.get_data_packet())
+        self._send([[('moe', 3), ('moe', 4)], [('larry', 6)]])
+        # Last write wins, as with a single manager.
+        self.assertEqual({'moe': 120, 'larry': 60},
+                         self.manager.get_data_packet())
+        self.assertEqual({}, self.manager.get_data_packet())
+
+    def test_collect_spread_client(self):
+        # A new socket per send, as the clients do: counts of a user land on
+        # several workers, the highest one is kept.
+        self._send([[('moe', count)] for count in range(1, 31)])
+        self.manager.get_data_packet()
+        self.assertEqual({'moe': 30}, self.manager.manager.stashed_data)
+
+    def test_collect_dead_worker(self):
+        import signal
+        import os
+        os.kill(self.workers._pids[0], signal.SIGKILL)
+        os.waitpid(self.workers._pids[0], 0)
+        self.assertEqual({}, self.manager.get_data_packet())
+        self.assertEqual(2, len(self.workers._pids))
+
+    def test_collect_stuck_worker(self):
+        import signal
+        import time
+        import os
+        stuck = self.workers._pids[0]
+        os.kill(stuck, signal.SIGSTOP)
+        start = time.time()
+        self.assertEqual({}, self.manager.get_data_packet())
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(2, len(self.workers._pids))
+        self.assertTrue(stuck not in self.workers._pids)
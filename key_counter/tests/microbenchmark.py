@@ -0,0 +1,149 @@
+"""Microbenchmarks for the NumbersManager aggregate and packet hot paths.
+
+For each manager implementation, and each user count, a number of ticks is
+run: the tick's updates go through aggregate_user_data(), then the packet is
+taken with get_data_packet(). The time and allocations per tick are reported:
+peak bytes allocated where tracemalloc is available, else the net number of
+objects (tracked by the garbage collector) allocated.
+
+Each tick updates every user once, plus a ratio of repeated updates (to users
+already updated in the tick). A ratio of the users were in the previous tick
+(stashed), the rest are users never seen before.
+
+    python -m key_counter.tests.microbenchmark --users 1000 10000 100000 \\
+        --repeat 0 0.5 --stashed 1 0.5 --output micro.json
+"""
+import argparse
+import random
+import json
+import time
+import gc
+
+from key_counter import core
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc, objects are counted instead.
+    tracemalloc = None
+
+MANAGERS = {
+    'dict': core.NumbersManager,
+    'array': core.InternedNumbersManager,
+    'sharded': core.ShardedNumbersManager,
+}
+
+
+###############################################################################
+
+def make_ticks(users, repeat, stashed, ticks, seed=0):
+    "Return the list of records (user, count pairs) of each tick."
+    rng = random.Random(seed)
+    next_user = users
+    active = ['user %s' % i for i in xrange(users)]
+    counts = {}
+    all_records = []
+    for _ in xrange(ticks + 1):
+        records = []
+        for user in active:
+            counts[user] = counts.get(user, 0) + rng.randint(0, 20)
+            records.append((user, counts[user]))
+        for _ in xrange(int(users * repeat)):
+            user = active[rng.randrange(users)]
+            counts[user] += rng.randint(0, 5)
+            records.append((user, counts[user]))
+        all_records.append(records)
+        # Replace the users not to be stashed with never seen ones.
+        kept = int(users * stashed)
+        fresh = ['user %s' % i for i in xrange(next_user,
+                                                next_user + users - kept)]
+        next_user += users - kept
+        rng.shuffle(active)
+        active = active[:kept] + fresh
+    return all_records
+
+
+def measure(manager_class, ticks_records):
+    """Run the ticks, return the list of (aggregate seconds, packet seconds,
+    allocations) of each, excluding the first (warm up) tick.
+    """
+    manager = manager_class()
+    core.NumbersPusher(manager, 1)
+    results = []
+    for records in ticks_records:
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            # Without collections, the count only grows with allocations.
+            gc.disable()
+            objects = gc.get_count()[0]
+        start = time.time()
+        aggregate = manager.aggregate_user_data
+        for user, count in records:
+            aggregate(user, count)
+        aggregated = time.time()
+        manager.get_data_packet()
+        packed = time.time()
+        if tracemalloc:
+            allocated = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            allocated = gc.get_count()[0] - objects
+            gc.enable()
+        results.append((aggregated - start, packed - aggregated, allocated))
+    return results[1:]
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+###############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--managers", nargs='+', choices=sorted(MANAGERS),
+                        default=sorted(MANAGERS))
+    parser.add_argument("--users", nargs='+', type=int,
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", nargs='+', type=float, default=[0.0],
+                        help="ratios of repeated updates per tick")
+    parser.add_argument("--stashed", nargs='+', type=float, default=[1.0],
+                        help="ratios of users in the previous tick")
+    parser.add_argument("--ticks", type=int, default=5,
+                        help="ticks measured per run (defaults to 5)")
+    parser.add_argument("--output", help="save the results to this file")
+    args = parser.parse_args()
+
+    allocated_unit = 'alloc KiB' if tracemalloc else 'alloc objs'
+    print ("%-7s %9s %6s %7s %12s %12s %12s"
+           % ('impl', 'users', 'repeat', 'stashed', 'aggregate ms',
+              'packet ms', allocated_unit))
+    runs = []
+    for users in args.users:
+        for repeat in args.repeat:
+            for stashed in args.stashed:
+                ticks = make_ticks(users, repeat, stashed, args.ticks)
+                for name in args.managers:
+                    results = measure(MANAGERS[name], ticks)
+                    run = {
+                        'manager': name, 'users': users, 'repeat': repeat,
+                        'stashed': stashed,
+                        'aggregate_seconds': mean([r[0] for r in results]),
+                        'packet_seconds': mean([r[1] for r in results]),
+                    }
+                    allocated = mean([r[2] for r in results])
+                    if tracemalloc:
+                        run['allocated_bytes'] = allocated
+                        allocated /= 1024.0
+                    else:
+                        run['allocated_objects'] = allocated
+                    runs.append(run)
+                    print ("%-7s %9s %6s %7s %12.2f %12.2f %12.0f"
+                           % (name, users, repeat, stashed,
+                              run['aggregate_seconds'] * 1000,
+                              run['packet_seconds'] * 1000, allocated))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(runs, output, indent=2, sort_keys=True)
@@ -1,8 +1,20 @@
 import unittest
 import json
+import os
 import gevent
+import gevent.socket
 from key_counter import core
 from key_counter import config
+from key_counter import protocol
+from key_counter import receive
+from key_counter import archive
+from key_counter import metrics
+from key_counter import relay
+from key_counter import spool
+from key_counter import timeseries
+from key_counter import leaderboard
+from key_counter import groups
+from key_counter import filters
 
 import logging
 logging.basicConfig()
@@ -94,6 +106,248 @@ class NumbersManagerTestCase(unittest.TestCase):
     def test_compute_inverse_counts(self):
         self.assertEqual(0, self.manager.compute(15, 10))
 
+    def test_aggregate_batch(self):
+        self.manager.aggregate_batch([('moe', 11), ('larry', 22),
+                                      ('moe', 33)])
+        self.assertEqual(2, len(self.manager.aggregated))
+        # Last entry wins, as with aggregate_user_data().
+        self.assertEqual(33, self.manager.aggregated['moe'])
+
+
+class NumbersManagerBoundsTestCase(unittest.TestCase):
+
+    def test_max_users_reject(self):
+        manager = core.NumbersManager(max_users=2)
+        rejected = core.RECORDS_REJECTED.get().value
+        manager.aggregate_batch([('moe', 1), ('larry', 2), ('curly', 3),
+                                 ('moe', 4)])
+        self.assertEqual({'moe': 4, 'larry': 2}, manager.aggregated)
+        self.assertEqual(rejected + 1, core.RECORDS_REJECTED.get().value)
+        # The cap is per packet.
+        manager.get_data_packet()
+        manager.aggregate_user_data('curly', 3)
+        self.assertEqual({'curly': 3}, manager.aggregated)
+
+    def test_max_users_sample(self):
+        manager = core.NumbersManager(max_users=1, policy='sample',
+                                      sample=0.5)
+        manager.aggregate_batch(('user %s' % i, i) for i in range(1000))
+        self.assertTrue(300 < len(manager.aggregated) < 700)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, core.NumbersManager, policy='lru')
+
+
+class InternedNumbersManagerTestCase(NumbersManagerTestCase):
+
+    def setUp(self):
+        self.manager = core.InternedNumbersManager(capacity=2)
+
+        # Use a pusher to build the kpm compute function
+        pusher = core.NumbersPusher(self.manager, 5)
+        self.manager.compute = pusher._build_computer()
+
+    def test_grows_capacity(self):
+        for i in range(10):
+            self.manager.aggregate_user_data('user %s' % i, i)
+        self.assertEqual(10, len(self.manager.get_data_packet()))
+        for i in range(10):
+            self.manager.aggregate_user_data('user %s' % i, i + 1)
+        packet = self.manager.get_data_packet()
+        self.assertEqual(set([12]), set(packet.values()))
+
+    def test_stash_only_previous_packet(self):
+        self.manager.aggregate_user_data('moe', 11)
+        self.manager.get_data_packet()
+        self.manager.aggregate_user_data('larry', 22)
+        self.manager.get_data_packet()
+        # Moe was not in the previous packet, so it has no value now.
+        self.assertEqual({'larry': 22}, self.manager.stashed_data)
+        self.manager.aggregate_user_data('moe', 16)
+        self.assertEqual({'moe': 0}, self.manager.get_data_packet())
+
+    def test_same_packets_as_dict_manager(self):
+        reference = core.NumbersManager()
+        reference.compute = self.manager.compute
+        ticks = [[('moe', 1), ('larry', 5)],
+                 [('moe', 3), ('moe', 4), ('curly', 9)],
+                 [('larry', 8), ('curly', 12)],
+                 [],
+                 [('moe', 10), ('larry', 7), ('curly', 20)]]
+        for records in ticks:
+            self.manager.aggregate_batch(records)
+            reference.aggregate_batch(records)
+            self.assertEqual(reference.get_data_packet(),
+                             self.manager.get_data_packet())
+
+    def test_ttl(self):
+        manager = core.InternedNumbersManager(ttl=2)
+        manager.compute = self.manager.compute
+        evicted = core.USERS_EVICTED.labels('ttl').value
+        manager.aggregate_batch([('moe', 1), ('larry', 1)])
+        manager.get_data_packet()
+        for count in range(2, 5):
+            manager.aggregate_user_data('larry', count)
+            manager.get_data_packet()
+        # Moe had no data for 3 packets, checked on the 4th.
+        self.assertEqual(['larry'], sorted(manager._slots))
+        self.assertEqual(evicted + 1, core.USERS_EVICTED.labels('ttl').value)
+        # Its slot is reused.
+        manager.aggregate_user_data('curly', 1)
+        self.assertEqual(2, len(manager._names))
+        self.assertEqual({'curly': 0}, manager.get_data_packet())
+
+    def test_max_users_lru(self):
+        manager = core.InternedNumbersManager(max_users=16)
+        manager.compute = self.manager.compute
+        for i in range(16):
+            manager.aggregate_user_data('user %s' % i, i)
+            manager.get_data_packet()
+        manager.aggregate_user_data('user 15', 30)
+        manager.aggregate_user_data('moe', 1)
+        # The least recently updated user made room.
+        self.assertNotIn('user 0', manager._slots)
+        self.assertEqual(16, len(manager._slots))
+        self.assertEqual({'user 15': 180, 'moe': 0},
+                         manager.get_data_packet())
+        self.assertEqual({'user 15': 30, 'moe': 1}, manager.stashed_data)
+
+    def test_max_users_reject_interned(self):
+        manager = core.InternedNumbersManager(max_users=2, policy='reject')
+        manager.aggregate_batch([('moe', 1), ('larry', 2)])
+        manager.get_data_packet()
+        manager.aggregate_user_data('curly', 3)
+        self.assertEqual({}, manager.aggregated)
+
+    def test_max_users_all_current(self):
+        # Users aggregated for the packet being taken are never forgotten.
+        manager = core.InternedNumbersManager(max_users=2)
+        manager.aggregate_batch([('moe', 1), ('larry', 2), ('curly', 3)])
+        self.assertEqual({'moe': 1, 'larry': 2}, manager.aggregated)
+
+
+class ShardedNumbersManagerTestCase(NumbersManagerTestCase):
+
+    def setUp(self):
+        self.manager = core.ShardedNumbersManager(shards=4)
+
+        # Use a pusher to build the kpm compute function
+        pusher = core.NumbersPusher(self.manager, 5)
+        self.manager.compute = pusher._build_computer()
+
+    def test_same_packets_as_dict_manager(self):
+        reference = core.NumbersManager()
+        reference.compute = self.manager.compute
+        ticks = [[('user %s' % i, i) for i in range(20)],
+                 [('user %s' % i, 2 * i) for i in range(0, 20, 2)],
+                 [('user %s' % i, 3 * i) for i in range(20)] + [('moe', 1)],
+                 []]
+        for records in ticks:
+            self.manager.aggregate_batch(records)
+            reference.aggregate_batch(records)
+            self.assertEqual(reference.get_data_packet(),
+                             self.manager.get_data_packet())
+
+    def test_batch_compute(self):
+        pusher = core.NumbersPusher(self.manager, 5)
+        self.manager.aggregate_batch([('moe', 1), ('larry', 2)])
+        self.manager.get_data_packet()
+        self.manager.aggregate_batch([('moe', 6), ('curly', 2)])
+        self.assertEqual({'moe': 60, 'curly': 0},
+                         self.manager.get_data_packet())
+        self.assertIsNotNone(pusher.manager.compute_batch)
+
+    def test_concurrent_threads(self):
+        import threading
+        writers, writes = 4, 2000
+
+        def write(writer):
+            for count in xrange(1, writes + 1):
+                self.manager.aggregate_batch(
+                    [('user %s-%s' % (writer, count % 7), count)])
+        threads = [threading.Thread(target=write, args=(writer,))
+                   for writer in range(writers)]
+        for thread in threads:
+            thread.start()
+        popped = []
+        while any(thread.is_alive() for thread in threads):
+            popped.append(self.manager.pop_aggregated())
+        for thread in threads:
+            thread.join()
+        popped.append(self.manager.pop_aggregated())
+        # No write is lost: the last count of each user is popped last.
+        latest = {}
+        for aggregated in popped:
+            for user, count in aggregated.items():
+                self.assertTrue(count > latest.get(user, 0))
+                latest[user] = count
+        expected = dict(('user %s-%s' % (writer, count % 7), count)
+                        for writer in range(writers)
+                        for count in xrange(writes - 6, writes + 1))
+        self.assertEqual(expected, latest)
+
+
+class WorkersMergeTestCase(unittest.TestCase):
+
+    def test_merge(self):
+        from key_counter import workers
+        partials = [{'moe': 3, 'larry': 1}, {'moe': 7}, {'moe': 5, 'curly': 2}]
+        expected = {'moe': 7, 'larry': 1, 'curly': 2}
+        self.assertEqual(expected, workers.merge(partials))
+        self.assertEqual(expected, workers.merge(reversed(partials)))
+        self.assertEqual({}, workers.merge([]))
+
+
+class BatchComputeTestCase(unittest.TestCase):
+
+    OLD = [0, 10, 15, 1, 7, 100, 3, 0]
+    NEW = [0, 15, 10, 2, 8, 137, 3, 2 ** 40]
+
+    def _check_same_as_compute(self, interval):
+        pusher = core.NumbersPusher(core.NumbersManager(), interval)
+        compute = pusher._build_computer()
+        compute_batch = pusher._build_batch_computer()
+        expected = [compute(old, new) for old, new in zip(self.OLD, self.NEW)]
+        self.assertEqual(expected, compute_batch(self.OLD, self.NEW))
+
+    def test_integer_interval(self):
+        for interval in (1, 3, 5, 7):
+            self._check_same_as_compute(interval)
+
+    def test_float_interval(self):
+        for interval in (0.1, 0.3, 0.7, 1.5, 2.0, 24.0, 120.0):
+            self._check_same_as_compute(interval)
+
+    def test_large_deltas(self):
+        old, new = [0, 5, 2 ** 62], [2 ** 62, 7, 0]
+        for interval in (1, 0.7):
+            pusher = core.NumbersPusher(core.NumbersManager(), interval)
+            compute = pusher._build_computer()
+            self.assertEqual(map(compute, old, new),
+                             pusher._build_batch_computer()(old, new))
+
+    def test_empty(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 3)
+        self.assertEqual([], pusher._build_batch_computer()([], []))
+
+    def test_without_numpy(self):
+        numpy, core.numpy = core.numpy, None
+        try:
+            self._check_same_as_compute(3)
+            self._check_same_as_compute(0.7)
+        finally:
+            core.numpy = numpy
+
+    def test_manager_without_batch(self):
+        manager = core.NumbersManager()
+        pusher = core.NumbersPusher(manager, 5)
+        manager.compute_batch = None
+        manager.aggregate_user_data('moe', 11)
+        manager.get_data_packet()
+        manager.aggregate_user_data('moe', 15)
+        self.assertEqual({'moe': pusher._build_computer()(11, 15)},
+                         manager.get_data_packet())
+
 
 ###############################################################################
 
@@ -135,6 +389,37 @@ class NumbersPusherTestCase(unittest.TestCase):
         self.assertEqual(packet, self.pusher._pushers['tests'].pushed[0])
         self.pusher.stop()
 
+    def test_push_loop_stamps_packets(self):
+        self.pusher.start()
+        gevent.sleep(0.25)
+        self.pusher.stop()
+        pushed = self.pusher._pushers['tests'].pushed
+        self.assertEqual(2, len(pushed))
+        for packet in pushed:
+            self.assertAlmostEqual(0.1, packet.elapsed, delta=0.05)
+        self.assertAlmostEqual(0.1, pushed[1].timestamp - pushed[0].timestamp,
+                               delta=0.05)
+
+    def test_push_loop_does_not_drift(self):
+        get_data_packet = self.pusher.manager.get_data_packet
+
+        def slow_get_data_packet():
+            gevent.sleep(0.05)
+            return get_data_packet()
+        self.pusher.manager.get_data_packet = slow_get_data_packet
+        self.pusher.start()
+        gevent.sleep(0.52)
+        self.pusher.stop()
+        # Sleeping an interval after each tick would have made 3 ticks.
+        self.assertEqual(4, len(self.pusher._pushers['tests'].pushed))
+
+    def test_compute_with_elapsed_time(self):
+        compute = self.pusher._build_computer()
+        compute_batch = self.pusher._build_batch_computer()
+        self.pusher.elapsed = 2.0
+        self.assertEqual(30, compute(0, 1))
+        self.assertEqual([30, 0], compute_batch([0, 5], [1, 5]))
+
     def test_push_empty_packet(self):
         packet = self.pusher.manager.get_data_packet()
         self.pusher._push(packet)
@@ -165,6 +450,1321 @@ class NumbersPusherTestCase(unittest.TestCase):
         self.assertTrue(swaped)
 
 
+class TimeSeriesTestCase(unittest.TestCase):
+
+    WINDOWS = (('short', 3), ('long', 8))
+
+    def _expected(self, values, length):
+        "Window statistics, computed from the whole history."
+        window = values[-length:]
+        return sum(window) / float(len(window)), max(window)
+
+    def test_rolling_windows(self):
+        import random
+        rng = random.Random(0)
+        store = timeseries.TimeSeriesStore(1, self.WINDOWS)
+        history = {'moe': [], 'larry': []}
+        for tick in range(40):
+            packet = {}
+            for user in history:
+                # Gaps, short and long, count as zeros.
+                if tick > 0 and (rng.random() < 0.3 or 20 <= tick < 30):
+                    history[user].append(0)
+                    continue
+                packet[user] = rng.randint(0, 300)
+                history[user].append(packet[user])
+            store.add(packet)
+            for user, values in history.items():
+                stats = store.stats(user)
+                for name, length in self.WINDOWS:
+                    mean, peak = self._expected(values, length)
+                    self.assertAlmostEqual(mean, stats[name]['mean'])
+                    self.assertEqual(peak, stats[name]['peak'])
+
+    def test_percentiles(self):
+        store = timeseries.TimeSeriesStore(1, (('window', 100),))
+        for value in range(100):
+            store.add({'moe': value})
+        stats = store.stats('moe')['window']
+        # The upper bound of the bucket of each percentile.
+        self.assertEqual((60, 100, 100),
+                         (stats['p50'], stats['p90'], stats['p99']))
+
+    def test_new_user_and_names(self):
+        store = timeseries.TimeSeriesStore(1, self.WINDOWS)
+        store.add({'moe': 10})
+        store.add({'moe': 10, 'larry': 40})
+        # Windows only hold the ticks since the first value.
+        self.assertEqual({'long': {'mean': 40.0, 'peak': 40, 'p50': 40,
+                                   'p90': 40, 'p99': 40}},
+                         store.stats('larry', ['long']))
+        self.assertIsNone(store.stats('curly'))
+
+    def test_forget_idle_users(self):
+        store = timeseries.TimeSeriesStore(1, self.WINDOWS)
+        store.add({'moe': 10})
+        for _ in range(20):
+            store.add({'larry': 1})
+        self.assertEqual(1, len(store))
+
+    def test_pusher_series(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1, self.WINDOWS)
+        pusher.add_upstream('plain', 'test')
+        self.assertIsNone(pusher.timeseries)
+        self.assertRaises(ValueError, pusher.add_upstream, 'bad', 'test',
+                          series=['1d'])
+        # Nothing is opened for an upstream rejected.
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        archive = os.path.join(directory, 'archive')
+        try:
+            self.assertRaises(ValueError, pusher.add_upstream, 'bad',
+                              'archive', archive, series=['1d'])
+            self.assertFalse(os.path.exists(archive))
+        finally:
+            shutil.rmtree(directory)
+        pusher.add_upstream('series', 'test', series=['short'])
+        pusher._last_tick = 0
+        for count in (0, 1, 2):
+            pusher.manager.aggregate_user_data('moe', count)
+            pusher._tick()
+        gevent.sleep(0)
+        packet = pusher._pushers['series'].pushed[-1]
+        self.assertIs(pusher.timeseries, packet.timeseries)
+        self.assertEqual(3, pusher.timeseries.tick)
+
+
+class GroupsTestCase(unittest.TestCase):
+
+    GROUPS = {'stooges': ['moe', 'larry', 'curly'],
+              'brothers': ['moe', 'shemp']}
+
+    def test_rollup(self):
+        rollup = groups.GroupRollup(self.GROUPS)
+        stats = rollup.rollup({'moe': 10, 'larry': 30, 'shemp': 5,
+                               'nobody': 99})
+        self.assertEqual({'sum': 40, 'mean': 20.0, 'max': 30, 'users': 2},
+                         stats['stooges'])
+        self.assertEqual({'sum': 15, 'mean': 7.5, 'max': 10, 'users': 2},
+                         stats['brothers'])
+        self.assertEqual({}, rollup.rollup({'nobody': 1}))
+        self.assertRaises(ValueError, groups.GroupRollup, ['moe'])
+
+    def test_group_packet(self):
+        packet = core.DataPacket(moe=10, larry=30)
+        packet.timestamp = 42.0
+        packet.groups = groups.GroupRollup(self.GROUPS).rollup(packet)
+        grouped = groups.group_packet(packet, 'mean')
+        self.assertEqual({'stooges': 20.0, 'brothers': 10.0}, grouped)
+        self.assertEqual(42.0, grouped.timestamp)
+        self.assertEqual({}, groups.group_packet(core.DataPacket(moe=1),
+                                                 'sum'))
+
+    def test_push_groups(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1)
+        pusher.set_groups(self.GROUPS)
+        pusher.add_upstream('teams', 'test', level='group', top=1)
+        pusher.add_upstream('users', 'test')
+        pusher.manager.compute = lambda old, new: new - old
+        pusher.manager.compute_batch = None
+        for tick in range(2):
+            pusher.manager.aggregate_batch([('moe', tick), ('curly', tick),
+                                            ('shemp', 5 * tick)])
+            pusher._last_tick = 0
+            pusher._tick()
+            gevent.sleep(0)
+        self.assertEqual({'brothers': 6}, pusher._pushers['teams'].pushed[-1])
+        self.assertEqual({'moe': 1, 'curly': 1, 'shemp': 5},
+                         pusher._pushers['users'].pushed[-1])
+        self.assertRaises(ValueError, pusher.add_upstream, 'bad', 'test',
+                          level='team')
+        self.assertRaises(ValueError, pusher.add_upstream, 'bad', 'test',
+                          level='group', group_stat='median')
+        self.assertRaises(ValueError, pusher.add_upstream, 'bad', 'archive',
+                          'unused.kca', level='group', group_stat='mean')
+        self.assertFalse(os.path.exists('unused.kca'))
+
+
+class FiltersTestCase(unittest.TestCase):
+
+    def test_names(self):
+        packet = core.DataPacket(moe=1, larry=2, curly=3, shemp=4)
+        packet.timestamp = 42.0
+        kept = filters.PacketFilter(allow=['moe', 'larry', 'curly'],
+                                    deny=['larry']).apply(packet)
+        self.assertEqual({'moe': 1, 'curly': 3}, kept)
+        self.assertEqual(42.0, kept.timestamp)
+        kept = filters.PacketFilter(allow_regex='[ms]',
+                                    deny_regex='.*p$').apply(packet)
+        self.assertEqual({'moe': 1}, kept)
+        self.assertEqual(packet, filters.PacketFilter().apply(packet))
+
+    def test_sample(self):
+        users = dict((u'user %s' % i, 1) for i in range(10000))
+        sample = filters.PacketFilter(sample=0.1)
+        kept = sample.apply(users)
+        self.assertTrue(800 < len(kept) < 1200)
+        # The same users, by any filter.
+        self.assertEqual(kept, filters.PacketFilter(sample=0.1).apply(users))
+        self.assertEqual(users, filters.PacketFilter(sample=1).apply(users))
+
+    def test_values(self):
+        drop_zeros = filters.PacketFilter(drop_zeros=True)
+        self.assertEqual({'moe': 1}, drop_zeros.apply({'moe': 1, 'larry': 0}))
+        changes = filters.ChangeFilter(10)
+
+        def push(data, accepted=True):
+            packet, pending = changes.apply(data)
+            if accepted:
+                changes.acknowledge(pending)
+            return packet
+        self.assertEqual({'moe': 50, 'larry': 0},
+                         push({'moe': 50, 'larry': 0}))
+        self.assertEqual({'larry': 10}, push({'moe': 59, 'larry': 10}))
+        # Compared to the value last kept, not the last one.
+        self.assertEqual({'moe': 60}, push({'moe': 60, 'larry': 19}))
+        # Not accepted, so pushed again.
+        self.assertEqual({'moe': 70}, push({'moe': 70}, accepted=False))
+        self.assertEqual({'moe': 70}, push({'moe': 70}))
+        # Users missing from a packet are forgotten.
+        push({'larry': 19})
+        self.assertEqual({'moe': 70}, push({'moe': 70}))
+
+    def test_shared_filters(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1)
+        pusher.add_upstream('first', 'test', drop_zeros=True)
+        pusher.add_upstream('second', 'test', min_change=2, drop_zeros=True)
+        pusher.add_upstream('all', 'test')
+        first, second = pusher._pushers['first'], pusher._pushers['second']
+        self.assertIs(first.filter, second.filter)
+        applied = []
+        apply = first.filter.apply
+        first.filter.apply = lambda data: applied.append(data) or apply(data)
+        pusher._push(core.DataPacket(moe=1, larry=0))
+        pusher._push(core.DataPacket(moe=2, larry=5))
+        self.assertEqual(2, len(applied))
+        self.assertEqual([{'moe': 1}, {'moe': 2, 'larry': 5}], first.pushed)
+        self.assertEqual([{'moe': 1}, {'larry': 5}], second.pushed)
+        self.assertEqual({'moe': 2, 'larry': 5},
+                         pusher._pushers['all'].pushed[-1])
+        pusher.remove_upstream('first')
+        self.assertEqual(1, len(pusher._filters))
+        pusher.remove_upstream('second')
+        self.assertEqual({}, pusher._filters)
+
+    def test_view_error(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1)
+        pusher.add_upstream('users', 'test', allow_regex='^u')
+        pusher.add_upstream('all', 'test')
+        # Names are strings once decoded, anything else is a bug upstream.
+        pusher._push(core.DataPacket([(5, 1), ('user', 2)]))
+        pusher._push(core.DataPacket(user=3))
+        self.assertEqual([{'user': 3}], pusher._pushers['users'].pushed)
+        self.assertEqual(2, len(pusher._pushers['all'].pushed))
+
+    def test_change_filter_per_upstream(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1)
+        pusher.add_upstream('a', 'test', min_change=5)
+        pusher._push(core.DataPacket(moe=10, larry=3))
+        # A new upstream gets every user first.
+        pusher.add_upstream('b', 'test', min_change=5)
+        pusher._push(core.DataPacket(moe=10, larry=3))
+        self.assertEqual([{'moe': 10, 'larry': 3}, {}],
+                         pusher._pushers['a'].pushed)
+        self.assertEqual([{'moe': 10, 'larry': 3}],
+                         pusher._pushers['b'].pushed)
+        # Failed pushes are not taken as accepted.
+        failing = pusher._pushers['b']
+        push = failing.push
+
+        def fail(data):
+            raise core.PushError('upstream down')
+        failing.push = fail
+        pusher._push(core.DataPacket(moe=20, larry=3))
+        failing.push = push
+        pusher._push(core.DataPacket(moe=20, larry=3))
+        self.assertEqual({'moe': 20}, failing.pushed[-1])
+        self.assertRaises(ValueError, pusher.add_upstream, 'pool',
+                          'http-pool', 'http://127.0.0.1/', min_change=5)
+
+
+class LeaderboardTestCase(unittest.TestCase):
+
+    def test_top(self):
+        board = leaderboard.Leaderboard(2)
+        board.update({'moe': 10, 'larry': 30, 'curly': 20})
+        self.assertEqual([('larry', 30), ('curly', 20)], board.top())
+        self.assertEqual([('larry', 30)], board.top(1))
+        board.update({'moe': 50})
+        self.assertEqual([('moe', 50)], board.top())
+        self.assertEqual([], board.heavy_hitters())
+
+    def test_heavy_hitters(self):
+        import random
+        rng = random.Random(0)
+        board = leaderboard.Leaderboard(3, sketch_capacity=20)
+        totals = {}
+        for _ in range(50):
+            # A few heavy users, and a long tail.
+            packet = dict(('heavy %s' % i, rng.randint(50, 100))
+                          for i in range(3))
+            packet.update(('user %s' % rng.randint(0, 1000), rng.randint(0, 5))
+                          for _ in range(30))
+            for user, value in packet.items():
+                totals[user] = totals.get(user, 0) + value
+            board.update(packet)
+        hitters = board.heavy_hitters(3)
+        self.assertEqual(['heavy 0', 'heavy 1', 'heavy 2'],
+                         sorted(user for user, _, _ in hitters))
+        for user, total, error in hitters:
+            self.assertTrue(total - error <= totals[user] <= total)
+        self.assertTrue(len(board.sketch.counts) <= 20)
+
+    def test_top_packet(self):
+        packet = core.DataPacket(moe=10, larry=30, curly=20)
+        packet.timestamp = 42.0
+        top = leaderboard.top_packet(packet, 2)
+        self.assertEqual({'larry': 30, 'curly': 20}, top)
+        self.assertEqual(42.0, top.timestamp)
+        self.assertEqual({'larry': 30},
+                         leaderboard.top_packet({'moe': 1, 'larry': 30}, 1))
+
+    def test_push_top(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), 1)
+        pusher.add_upstream('top', 'test', top=1)
+        pusher.add_upstream('all', 'test')
+        pusher.manager.compute = lambda old, new: new - old
+        pusher.manager.compute_batch = None
+        for tick in range(2):
+            pusher.manager.aggregate_batch([('moe', tick),
+                                            ('larry', 5 * tick)])
+            pusher._last_tick = 0
+            pusher._tick()
+            gevent.sleep(0)
+        self.assertEqual({'larry': 5}, pusher._pushers['top'].pushed[-1])
+        self.assertEqual({'moe': 1, 'larry': 5},
+                         pusher._pushers['all'].pushed[-1])
+        self.assertEqual([('larry', 5)], pusher.leaderboard.top())
+
+    def test_query_routes(self):
+        board = leaderboard.Leaderboard(2, sketch_capacity=10)
+        board.update({'moe': 10, 'larry': 30, 'curly': 20})
+        routes = leaderboard.query_routes(board)
+        self.assertEqual([{'username': 'larry', 'count': 30}],
+                         routes['/top']({'n': ['1']}))
+        self.assertEqual(2, len(routes['/top']({})))
+        self.assertEqual([{'username': 'larry', 'sum': 30, 'error': 0}],
+                         routes['/heavy-hitters']({'n': ['1']}))
+        self.assertRaises(ValueError, routes['/top'], {'n': ['none']})
+        self.assertRaises(ValueError, routes['/top'], {'n': ['0']})
+
+
+class HTTPPoolPushTestCase(unittest.TestCase):
+
+    PORT = 55855
+
+    def setUp(self):
+        from gevent.pywsgi import WSGIServer
+        self.received = []
+        # X-Key-Counter-Push header of each POST, and the OPTIONS response.
+        self.modes = []
+        # X-Key-Counter-Timestamp header of each POST.
+        self.timestamps = []
+        self.options = []
+        self.offered = []
+        # Seconds each POST takes, and the most POSTs handled at once.
+        self.delay = 0
+        self.handling = self.most_handling = 0
+        self.server = WSGIServer(('127.0.0.1', self.PORT), self._app,
+                                 log=None)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _app(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'OPTIONS':
+            self.options.append(environ['PATH_INFO'])
+            start_response('200 OK', self.offered)
+            return ['']
+        body = environ['wsgi.input'].read()
+        self.handling += 1
+        self.most_handling = max(self.most_handling, self.handling)
+        gevent.sleep(self.delay)
+        self.handling -= 1
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            import zlib
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.received.append((environ['PATH_INFO'], json.loads(body)))
+        self.modes.append((environ.get('HTTP_X_KEY_COUNTER_PUSH'),
+                           environ.get('HTTP_CONTENT_ENCODING')))
+        self.timestamps.append(environ.get('HTTP_X_KEY_COUNTER_TIMESTAMP'))
+        start_response('202 Accepted', [])
+        return ['Accepted']
+
+    def _wait_received(self, count):
+        for _ in range(50):
+            if len(self.received) >= count:
+                break
+            gevent.sleep(0.02)
+
+    def _check_push(self, **options):
+        strategy = core.PushStrategy(
+            'http-pool', 'http://127.0.0.1:%s/' % self.PORT, **options)
+        try:
+            strategy.push({'moe': 60})
+            strategy.push({'moe': 120, 'larry': 0})
+            self._wait_received(2)
+        finally:
+            strategy.close()
+        self.assertEqual(2, len(self.received))
+        rows = sorted((row['username'], row['count'])
+                      for _, packet in self.received for row in packet)
+        self.assertEqual([('larry', 0), ('moe', 60), ('moe', 120)], rows)
+        self.assertEqual(['/counts/', '/counts/'],
+                         [path for path, _ in self.received])
+
+    def test_push(self):
+        self._check_push()
+
+    def test_push_gzip(self):
+        self._check_push(encoding='gzip', pool_size=1)
+
+    def test_bad_encoding(self):
+        self.assertRaises(ValueError, core.PushStrategy, 'http-pool',
+                          'http://127.0.0.1/', encoding='brotli')
+        if core.zstandard is None:
+            self.assertRaises(ValueError, core.PushStrategy, 'http-pool',
+                              'http://127.0.0.1/', encoding='zstd')
+
+    def test_bad_delta(self):
+        self.assertRaises(ValueError, core.PushStrategy, 'http-pool',
+                          'http://127.0.0.1/', delta='sometimes')
+
+    def _push_in_turn(self, packets, **options):
+        "Push each packet once the previous one was received."
+        strategy = core.PushStrategy(
+            'http-pool', 'http://127.0.0.1:%s/' % self.PORT, pool_size=1,
+            **options)
+        try:
+            for i, packet in enumerate(packets):
+                strategy.push(packet)
+                self._wait_received(i + 1)
+                # Let the acknowledgement in.
+                gevent.sleep(0.02)
+        finally:
+            strategy.close()
+        return [sorted((row['username'], row['count']) for row in packet)
+                for _, packet in self.received]
+
+    def test_push_delta(self):
+        rows = self._push_in_turn([
+            {'moe': 60, 'larry': 0},
+            {'moe': 60, 'larry': 30, 'curly': 0},
+            {'larry': 30, 'curly': 10},
+            {'larry': 30, 'curly': 10},
+        ], delta=True, snapshot_every=3)
+        self.assertEqual([
+            [('larry', 0), ('moe', 60)],
+            [('larry', 30)],
+            [('curly', 10), ('moe', None)],
+            [('curly', 10), ('larry', 30)],
+        ], rows)
+        self.assertEqual(['full', 'delta', 'delta', 'full'],
+                         [mode for mode, _ in self.modes])
+
+    def test_push_delta_in_order(self):
+        self.delay = 0.05
+        strategy = core.PushStrategy(
+            'http-pool', 'http://127.0.0.1:%s/' % self.PORT, pool_size=2,
+            delta=True)
+        try:
+            strategy.push({'moe': 1})
+            strategy.push({'moe': 2})
+            strategy.push({'moe': 3})
+            self._wait_received(3)
+        finally:
+            strategy.close()
+        self.assertEqual(1, self.most_handling)
+        self.assertEqual([[{'username': 'moe', 'count': count}]
+                          for count in (1, 2, 3)],
+                         [packet for _, packet in self.received])
+        self.assertEqual(['full', 'delta', 'delta'],
+                         [mode for mode, _ in self.modes])
+
+    def test_push_timestamp(self):
+        strategy = core.PushStrategy(
+            'http-pool', 'http://127.0.0.1:%s/' % self.PORT)
+        data = core.DataPacket({'moe': 60})
+        data.timestamp = 1500000000.25
+        try:
+            strategy.push(data)
+            strategy.push({'moe': 120})
+            self._wait_received(2)
+        finally:
+            strategy.close()
+        self.assertEqual(['1500000000.25', None], sorted(self.timestamps,
+                                                         reverse=True))
+
+    def test_push_seconds(self):
+        # The time of the POST is observed, not that of the handing over.
+        self.delay = 0.1
+        strategy = core.PushStrategy(
+            'http-pool', 'http://127.0.0.1:%s/' % self.PORT)
+        strategy.name = 'pooled'
+        try:
+            self.assertTrue(strategy._push_once({'moe': 1}))
+            self._wait_received(1)
+        finally:
+            strategy.close()
+        seconds = core.PUSH_SECONDS.get('pooled')
+        core.PUSH_SECONDS.remove('pooled')
+        self.assertEqual(1, sum(seconds.counts))
+        self.assertTrue(seconds.sum >= 0.1)
+
+    def test_negotiate(self):
+        self.offered = [('Accept-Encoding', 'br, gzip;q=0.5'),
+                        ('X-Key-Counter-Delta', '1')]
+        rows = self._push_in_turn([{'moe': 60}, {'moe': 60, 'larry': 5}],
+                                  encoding='auto', delta='auto')
+        self.assertEqual([[('moe', 60)], [('larry', 5)]], rows)
+        self.assertEqual([('full', 'gzip'), ('delta', 'gzip')], self.modes)
+        self.assertEqual(['/counts/'], self.options)
+
+    def test_push_series(self):
+        store = timeseries.TimeSeriesStore(1, (('1m', 60),))
+        for value in (60, 120):
+            # Stored as it is pushed, as the pusher does.
+            packet = core.DataPacket(moe=value)
+            store.add(packet)
+            packet.timeseries = store
+            self._push_in_turn([packet], series=True)
+        series = [row['series']['1m'] for _, packet in self.received
+                  for row in packet]
+        self.assertEqual([60.0, 90.0], [window['mean'] for window in series])
+        self.assertEqual([60, 120], [window['peak'] for window in series])
+
+    def test_negotiate_nothing(self):
+        rows = self._push_in_turn([{'moe': 60}, {'moe': 60}],
+                                  encoding='auto', delta='auto')
+        self.assertEqual([[('moe', 60)], [('moe', 60)]], rows)
+        self.assertEqual([('full', None), ('full', None)], self.modes)
+
+
+class DispatchTestCase(unittest.TestCase):
+
+    def _slow_strategy(self, delay, **options):
+        strategy = core.PushStrategy('test', **options)
+
+        def push(data):
+            gevent.sleep(delay)
+            strategy.pushed.append(data)
+        strategy.push = push
+        return strategy
+
+    def test_concurrent_upstreams(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), interval=0.1)
+        pusher.add_upstream('fast', 'test')
+        pusher._pushers['slow'] = self._slow_strategy(10)
+        pusher._push({'moe': 1}, wait=False)
+        gevent.sleep(0)
+        self.assertEqual([{'moe': 1}], pusher._pushers['fast'].pushed)
+        self.assertEqual([], pusher._pushers['slow'].pushed)
+        pusher.remove_upstream('slow')
+
+    def test_wait_bound_by_interval(self):
+        pusher = core.NumbersPusher(core.NumbersManager(), interval=0.05)
+        pusher._pushers['slow'] = self._slow_strategy(10)
+        running = pusher._pushers['slow'].dispatch({})
+        pusher._push({'moe': 1})
+        self.assertFalse(running.ready())
+        running.kill()
+
+    def test_deadline(self):
+        strategy = self._slow_strategy(10, deadline=0.05)
+        running = strategy.dispatch({'moe': 1})
+        running.join(timeout=1)
+        self.assertTrue(running.ready())
+        self.assertEqual([], strategy.pushed)
+
+    def test_failing_push(self):
+        strategy = core.PushStrategy('test')
+
+        def push(data):
+            raise RuntimeError('broken upstream')
+        strategy.push = push
+        running = strategy.dispatch({'moe': 1})
+        running.join()
+        self.assertTrue(running.successful())
+
+    def _overrun(self, overrun):
+        strategy = self._slow_strategy(0.05, overrun=overrun)
+        for i in range(strategy.QUEUE_SIZE + 3):
+            running = strategy.dispatch({'moe': i})
+        running.join()
+        return [data['moe'] for data in strategy.pushed]
+
+    def test_overrun_skip(self):
+        self.assertEqual([0], self._overrun('skip'))
+
+    def test_overrun_coalesce(self):
+        last = core.PushStrategy.QUEUE_SIZE + 2
+        self.assertEqual([0, last], self._overrun('coalesce'))
+
+    def test_overrun_queue(self):
+        size = core.PushStrategy.QUEUE_SIZE
+        self.assertEqual([0] + range(3, size + 3), self._overrun('queue'))
+
+    def test_bad_overrun(self):
+        self.assertRaises(ValueError, core.PushStrategy, 'test',
+                          overrun='panic')
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.spool_directory = os.path.join(self.directory, 'spool')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _spool(self, **options):
+        return spool.Spool(self.spool_directory, **options)
+
+    def test_read_and_consume(self):
+        queue = self._spool(segment_bytes=20)
+        self.assertTrue(queue.empty())
+        for i in range(10):
+            queue.append('record %s' % i)
+        self.assertFalse(queue.empty())
+        records = queue.read(4)
+        self.assertEqual(['record %s' % i for i in range(4)],
+                         [record for record, _ in records])
+        # Not consumed, read again.
+        self.assertEqual(records, queue.read(4))
+        queue.consume(records[-1][1])
+        records = queue.read(100)
+        self.assertEqual(['record %s' % i for i in range(4, 10)],
+                         [record for record, _ in records])
+        queue.consume(records[-1][1])
+        self.assertTrue(queue.empty())
+        self.assertEqual([], queue.read(1))
+        # Consumed segments are removed.
+        self.assertEqual(1, len([name for name in os.listdir(
+            self.spool_directory) if name.endswith(spool.SEGMENT_SUFFIX)]))
+        queue.close()
+
+    def test_reopen(self):
+        queue = self._spool(segment_bytes=20)
+        for i in range(5):
+            queue.append('record %s' % i)
+        queue.consume(queue.read(2)[-1][1])
+        queue.close()
+        # A partial record, from an interrupted append.
+        segments = sorted(os.listdir(self.spool_directory))
+        with open(os.path.join(self.spool_directory,
+                               segments[-2]), 'ab') as segment:
+            segment.write('\x10\x00\x00\x00rec')
+        queue = self._spool(segment_bytes=20)
+        queue.append('record 5')
+        self.assertEqual(['record %s' % i for i in range(2, 6)],
+                         [record for record, _ in queue.read(100)])
+        queue.close()
+
+    def test_reopen_torn(self):
+        queue = self._spool()
+        queue.append('record 0')
+        queue.close()
+        segment_name, = [name for name in os.listdir(self.spool_directory)
+                         if name.endswith(spool.SEGMENT_SUFFIX)]
+        with open(os.path.join(self.spool_directory,
+                               segment_name), 'ab') as segment:
+            segment.write('\x10\x00\x00\x00rec')
+        # Read right away, before any append.
+        queue = self._spool()
+        self.assertFalse(queue.empty())
+        self.assertEqual(['record 0'],
+                         [record for record, _ in queue.read(100)])
+        queue.consume(queue.read(1)[-1][1])
+        self.assertTrue(queue.empty())
+        queue.close()
+
+    def test_bad_record_skipped(self):
+        queue = self._spool()
+        queue.append('not json')
+        queue.close()
+        strategy = self._failing_strategy(0)
+        strategy.dispatch({'moe': 1}).join()
+        strategy.spool.append(json.dumps([None, None, {'moe': 2}]))
+        strategy._spooled.set()
+        gevent.sleep(0.05)
+        self.assertEqual([{'moe': 1}, {'moe': 2}], strategy.pushed)
+        self.assertTrue(strategy.spool.empty())
+        strategy.close()
+
+    def test_evict_oldest(self):
+        queue = self._spool(segment_bytes=24, max_bytes=60)
+        for i in range(10):
+            queue.append('record %s' % i)
+        self.assertTrue(len(queue) <= 60)
+        records = [record for record, _ in queue.read(100)]
+        self.assertEqual(['record %s' % i for i in range(6, 10)], records)
+        queue.close()
+
+    def _failing_strategy(self, failures, **options):
+        strategy = core.PushStrategy(
+            'test', spool=self.spool_directory, **options)
+        strategy.SPOOL_BACKOFF = 0.01
+        strategy.attempts = 0
+
+        def push(data):
+            strategy.attempts += 1
+            if strategy.attempts <= failures:
+                raise core.PushError('upstream down')
+            strategy.pushed.append(data)
+        strategy.push = push
+        return strategy
+
+    def test_push_strategy(self):
+        strategy = self._failing_strategy(3, spool_batch=2)
+        for i in range(3):
+            packet = core.DataPacket(moe=i)
+            packet.timestamp = 1000.0 + i
+            strategy.dispatch(packet).join()
+        # The first live pushes failed, and were pushed again after the
+        # last one, with their timestamps.
+        for _ in range(50):
+            if len(strategy.pushed) == 3:
+                break
+            gevent.sleep(0.02)
+        self.assertEqual([{'moe': 2}, {'moe': 0}, {'moe': 1}],
+                         strategy.pushed)
+        self.assertEqual([1002.0, 1000.0, 1001.0],
+                         [data.timestamp for data in strategy.pushed])
+        self.assertTrue(strategy.spool.empty())
+        strategy.close()
+
+    def test_push_strategy_reopened(self):
+        strategy = self._failing_strategy(10)
+        strategy.SPOOL_BACKOFF = 10
+        strategy.dispatch({'moe': 1}).join()
+        strategy.close()
+        strategy = self._failing_strategy(0)
+        gevent.sleep(0.05)
+        self.assertEqual([{'moe': 1}], strategy.pushed)
+        strategy.close()
+
+    def test_http_pool_not_spooled(self):
+        self.assertRaises(ValueError, core.PushStrategy, 'http-pool',
+                          'http://127.0.0.1/', spool=self.spool_directory)
+
+
+class BufferedFilePushTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'pushed.log')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _lines(self, file_name=None):
+        with open(file_name or self.file_name) as pushed:
+            return [json.loads(line) for line in pushed]
+
+    def test_buffers_until_close(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name)
+        strategy.push({'moe': 1})
+        strategy.push({'moe': 2})
+        self.assertEqual([], self._lines())
+        strategy.close()
+        self.assertEqual([{'moe': 1}, {'moe': 2}], self._lines())
+
+    def test_flush_ticks(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name,
+                                     flush_ticks=2, fsync=True)
+        strategy.push({'moe': 1})
+        self.assertEqual([], self._lines())
+        strategy.push({'moe': 2})
+        self.assertEqual([{'moe': 1}, {'moe': 2}], self._lines())
+        strategy.close()
+
+    def test_flush_seconds(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name,
+                                     flush_seconds=0.05)
+        strategy.push({'moe': 1})
+        self.assertEqual([], self._lines())
+        gevent.sleep(0.06)
+        strategy.push({'moe': 2})
+        self.assertEqual([{'moe': 1}, {'moe': 2}], self._lines())
+        strategy.close()
+
+    def test_rotate_by_size(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name,
+                                     max_bytes=20, backups=2)
+        for i in range(6):
+            strategy.push({'moe': i})
+        strategy.close()
+        # Each line takes 11 bytes, so a file holds two lines.
+        self.assertEqual([{'moe': 4}, {'moe': 5}],
+                         self._lines(self.file_name + '.1'))
+        self.assertEqual([{'moe': 2}, {'moe': 3}],
+                         self._lines(self.file_name + '.2'))
+        self.assertFalse(os.path.exists(self.file_name + '.3'))
+        self.assertEqual([], self._lines())
+
+    def test_reopen_when_moved(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name,
+                                     flush_ticks=1)
+        strategy.push({'moe': 1})
+        os.rename(self.file_name, self.file_name + '.old')
+        strategy.push({'moe': 2})
+        strategy.push({'moe': 3})
+        strategy.close()
+        self.assertEqual([{'moe': 1}, {'moe': 2}],
+                         self._lines(self.file_name + '.old'))
+        self.assertEqual([{'moe': 3}], self._lines())
+
+    def test_reopen_when_moved_without_flushes(self):
+        strategy = core.PushStrategy('buffered-file', self.file_name)
+        strategy.push({'moe': 1})
+        os.rename(self.file_name, self.file_name + '.old')
+        writer = strategy.close.__self__
+        writer.CHECK_SECONDS = 0
+        strategy.push({'moe': 2})
+        strategy.close()
+        self.assertEqual([{'moe': 1}], self._lines(self.file_name + '.old'))
+        self.assertEqual([{'moe': 2}], self._lines())
+
+    def test_pusher_close(self):
+        pusher = core.NumbersPusher(core.NumbersManager())
+        pusher.add_upstream('log', 'buffered-file', file_name=self.file_name)
+        pusher._push({'moe': 1})
+        pusher.close()
+        self.assertEqual([{'moe': 1}], self._lines())
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    PACKETS = [(10.0, {'moe': 60, 'larry': 0}),
+               (13.0, {'moe': 120, 'curly': 30}),
+               (16.0, {}),
+               (19.0, {'larry': 12, 'curly': 300, u'mo\xe9': 1})]
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'archive')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _write(self, packets):
+        writer = archive.ArchiveWriter(self.file_name)
+        for timestamp, packet in packets:
+            writer.write(timestamp, packet)
+        writer.close()
+
+    def test_empty(self):
+        self._write([])
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual(0, len(reader))
+        self.assertEqual([], list(reader.packets()))
+        self.assertEqual([], reader.series('moe'))
+
+    def test_packets(self):
+        self._write(self.PACKETS)
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual(4, len(reader))
+        expected = [(13.0, {'moe': 120, 'curly': 30}), (16.0, {})]
+        self.assertEqual(expected, list(reader.packets(11.0, 19.0)))
+        reader.close()
+
+    def test_large_values(self):
+        self._write([(1.0, {'moe': 70000, 'larry': 2 ** 40})])
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual([(1.0, {'moe': 70000, 'larry': archive.MAX_VALUE})],
+                         list(reader.packets()))
+        self.assertEqual([(1.0, 70000)], reader.series('moe'))
+
+    def test_series(self):
+        self._write(self.PACKETS)
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual([(10.0, 60), (13.0, 120)], reader.series('moe'))
+        self.assertEqual([(19.0, 12)], reader.series('larry', start=11.0))
+        self.assertEqual([(19.0, 1)], reader.series(u'mo\xe9'))
+        self.assertEqual([], reader.series('shemp'))
+        self.assertEqual(4, len(reader.users()))
+
+    def test_append_to_existing(self):
+        self._write(self.PACKETS[:2])
+        # An interrupted write leaves a truncated block behind.
+        with open(self.file_name, 'ab') as data:
+            data.write('T\xff\x00')
+        self._write(self.PACKETS[2:])
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual(self.PACKETS, list(reader.packets()))
+        self.assertEqual(4, len(reader.users()))
+
+    def test_failed_write(self):
+        writer = archive.ArchiveWriter(self.file_name)
+        writer.write(1.0, {'moe': 1})
+        # Not valid UTF-8, nothing written.
+        self.assertRaises(UnicodeDecodeError, writer.write, 2.0,
+                          {'larry': 2, 'b\xff': 3})
+        writer.write(3.0, {'bob': 4, 'moe': 5})
+        writer.close()
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual([(3.0, 4)], reader.series(u'bob'))
+        self.assertEqual([(1.0, {'moe': 1}), (3.0, {'bob': 4, 'moe': 5})],
+                         list(reader.packets()))
+        self.assertEqual(['moe', 'bob'], reader.users())
+
+    def test_not_an_archive(self):
+        with open(self.file_name, 'w') as data:
+            data.write('[]')
+        self.assertRaises(ValueError, archive.ArchiveWriter, self.file_name)
+        self.assertRaises(ValueError, archive.ArchiveReader, self.file_name)
+
+    def test_smaller_than_json_lines(self):
+        packet = dict(('user %s' % i, i % 300) for i in range(1000))
+        packets = [(float(t), packet) for t in range(20)]
+        self._write(packets)
+        json_size = sum(len(json.dumps(p)) + 1 for _, p in packets)
+        archive_size = os.path.getsize(self.file_name)
+        self.assertTrue(archive_size * 3 < json_size)
+
+    def test_push_strategy(self):
+        strategy = core.PushStrategy('archive', self.file_name)
+        packet = core.DataPacket(moe=60)
+        packet.timestamp = 42.0
+        strategy.push(packet)
+        strategy.close()
+        reader = archive.ArchiveReader(self.file_name)
+        self.assertEqual([(42.0, 60)], reader.series('moe'))
+
+
+###############################################################################
+
+class ProtocolTestCase(unittest.TestCase):
+
+    RECORDS = [(u'moe', 11), (u'larry', 22), (u'curly', 2 ** 40)]
+
+    def test_single(self):
+        data = protocol.encode_single('moe', 11)
+        self.assertEqual([(u'moe', 11)], protocol.decode(data))
+
+    def test_json_batch(self):
+        data = protocol.encode_json_batch(self.RECORDS)
+        self.assertEqual(self.RECORDS, protocol.decode(data))
+
+    def test_binary_batch(self):
+        data = protocol.encode_binary_batch(self.RECORDS)
+        self.assertEqual(self.RECORDS, protocol.decode(data))
+
+    def test_binary_batch_unicode_user(self):
+        records = [(u'mo\xe9', 1)]
+        data = protocol.encode_binary_batch(records)
+        self.assertEqual(records, protocol.decode(data))
+
+    def test_binary_batch_is_compact(self):
+        binary = protocol.encode_binary_batch(self.RECORDS)
+        json_batch = protocol.encode_json_batch(self.RECORDS)
+        self.assertTrue(len(binary) < len(json_batch))
+
+    def test_empty_batches(self):
+        self.assertEqual([], protocol.decode(protocol.encode_json_batch([])))
+        self.assertEqual([],
+                         protocol.decode(protocol.encode_binary_batch([])))
+
+    def test_bad_data(self):
+        bad_data = ['', 'not json', '[]', '5', '{"user": "moe"}',
+                    '{"user": "moe", "count": "many"}',
+                    '{"version": 1}',
+                    '{"version": 99, "counts": []}',
+                    '{"version": 1, "counts": [["moe"]]}',
+                    '{"user": "moe", "count": -5}',
+                    '{"user": 5, "count": 3}',
+                    '{"version": 1, "counts": [[null, 3]]}',
+                    '{"version": 1, "counts": [[["moe"], 3]]}']
+        for data in bad_data:
+            self.assertRaises(ValueError, protocol.decode, data)
+
+    def test_bad_binary_data(self):
+        data = protocol.encode_binary_batch(self.RECORDS)
+        # Truncated payloads.
+        for end in (1, 4, 6, 10, len(data) - 1):
+            self.assertRaises(ValueError, protocol.decode, data[:end])
+        # Unknown version.
+        self.assertRaises(ValueError, protocol.decode, 'KC\x09' + data[3:])
+
+    def test_binary_batch_count_range(self):
+        for count in (-1, 2 ** 64):
+            self.assertRaises(ValueError, protocol.encode_binary_batch,
+                              [('moe', count)])
+
+    def test_decoded_count_range(self):
+        largest = protocol.MAX_DECODED_COUNT
+        for encode in (protocol.encode_binary_batch,
+                       protocol.encode_json_batch):
+            self.assertEqual([(u'moe', largest)],
+                             protocol.decode(encode([('moe', largest)])))
+            self.assertRaises(ValueError, protocol.decode,
+                              encode([('moe', largest + 1)]))
+
+    def test_binary_batches(self):
+        records = [(u'user %s' % i, i) for i in range(100)]
+        batches = protocol.encode_binary_batches(records, 200)
+        self.assertTrue(len(batches) > 1)
+        self.assertTrue(all(len(batch) <= 200 for batch in batches))
+        decoded = []
+        for batch in batches:
+            decoded.extend(protocol.decode(batch))
+        self.assertEqual(records, decoded)
+        self.assertEqual([], protocol.encode_binary_batches([], 200))
+        self.assertRaises(ValueError, protocol.encode_binary_batches,
+                          [('moe' * 10, 1)], 20)
+
+
+class NumbersServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = core.NumbersManager()
+        self.server = core.NumbersServer(0, self.manager)
+
+    def test_handle_single(self):
+        self.server.handle(protocol.encode_single('moe', 11), None)
+        self.assertEqual({'moe': 11}, self.manager.aggregated)
+
+    def test_handle_large_count(self):
+        manager = core.InternedNumbersManager()
+        server = core.NumbersServer(0, manager)
+        server.handle(protocol.encode_binary_batch([('moe', 2 ** 63)]), None)
+        self.assertEqual({}, manager.aggregated)
+
+    def test_handle_batches(self):
+        self.server.handle(
+            protocol.encode_json_batch([('moe', 11), ('larry', 22)]), None)
+        self.server.handle(
+            protocol.encode_binary_batch([('moe', 33), ('curly', 44)]), None)
+        self.assertEqual({'moe': 33, 'larry': 22, 'curly': 44},
+                         self.manager.aggregated)
+
+    def test_handle_bad_data(self):
+        self.server.handle('{"user": "moe"}', None)
+        self.assertEqual({}, self.manager.aggregated)
+
+
+class BulkNumbersServerTestCase(unittest.TestCase):
+
+    PORT = 55755
+
+    def _check_receives(self, **kwargs):
+        import socket
+        manager = core.NumbersManager()
+        server = receive.BulkNumbersServer(self.PORT, manager, batch=4,
+                                           rcvbuf=65536, **kwargs)
+        server.start()
+        try:
+            sock = socket.socket(type=socket.SOCK_DGRAM)
+            for i in range(10):
+                sock.sendto(protocol.encode_single('user %s' % i, i),
+                            ('127.0.0.1', self.PORT))
+            sock.sendto('bad data', ('127.0.0.1', self.PORT))
+            sock.sendto(protocol.encode_binary_batch([('moe', 1),
+                                                      ('user 0', 5)]),
+                        ('127.0.0.1', self.PORT))
+            sock.close()
+            gevent.sleep(0.1)
+        finally:
+            server.stop()
+        expected = dict(('user %s' % i, i) for i in range(10))
+        expected.update({'moe': 1, 'user 0': 5})
+        self.assertEqual(expected, manager.aggregated)
+
+    def test_receive(self):
+        self._check_receives()
+
+    def test_receive_without_recvmmsg(self):
+        self._check_receives(recvmmsg=False)
+
+    def test_stop_before_start(self):
+        server = receive.BulkNumbersServer(self.PORT, core.NumbersManager())
+        server.stop()
+
+    def test_yields_under_load(self):
+        import socket
+
+        class FullReceiver (object):
+            "Return full batches, then nothing."
+            drains = 0
+
+            def drain(self):
+                self.drains += 1
+                if self.drains > 20:
+                    return []
+                return [protocol.encode_single('moe', self.drains)] * 4
+        receiver = FullReceiver()
+        server = receive.BulkNumbersServer(self.PORT, core.NumbersManager(),
+                                           batch=4)
+        server.socket = socket.socket(type=socket.SOCK_DGRAM)
+        # Readable right away.
+        server.socket.bind(('127.0.0.1', self.PORT))
+        server.socket.sendto('wake up', ('127.0.0.1', self.PORT))
+
+        def other():
+            # Runs again once the loop is draining.
+            while not receiver.drains:
+                gevent.sleep(0)
+            return receiver.drains
+        loop = gevent.spawn(server.receive_loop, receiver)
+        other = gevent.spawn(other)
+        try:
+            other.join(timeout=1)
+            self.assertTrue(0 < other.value < 20)
+        finally:
+            loop.kill()
+            server.socket.close()
+
+
+class SeatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import imp
+        script = os.path.join(os.path.dirname(__file__), '..', 'scripts',
+                              'key_counter_seats.py')
+        self.seats = imp.load_source('key_counter_seats', script)
+        import select
+        if not hasattr(select, 'epoll'):
+            # Monkey patched by the integration tests, the script never is.
+            from gevent import monkey
+
+            class original_select (object):
+                epoll = monkey.get_original('select', 'epoll')
+                EPOLLIN = select.EPOLLIN
+            self.seats.select = original_select
+        self.directory = tempfile.mkdtemp()
+        # FIFOs stand in for the input devices.
+        self.devices = []
+        for user in ('moe', 'larry'):
+            path = os.path.join(self.directory, user)
+            os.mkfifo(path)
+            self.devices.append((path, user))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _event(self, kind, value):
+        return self.seats.INPUT_EVENT.pack(0, 0, kind, 30, value)
+
+    def test_count_presses(self):
+        seats = self.seats.Seats(self.devices)
+        writers = [os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                   for path, _ in self.devices]
+        try:
+            self.assertEqual({'moe': 0, 'larry': 0}, seats.counts)
+            key, press, release, repeat = self.seats.EV_KEY, 1, 0, 2
+            os.write(writers[0], ''.join([
+                self._event(key, press), self._event(key, release),
+                self._event(key, repeat), self._event(0, press),
+                self._event(key, press)]))
+            os.write(writers[1], self._event(key, press))
+            for _ in range(2):
+                seats.wait(0.1)
+            # Only presses count, not releases, repeats nor other events.
+            self.assertEqual({'moe': 2, 'larry': 1}, seats.counts)
+        finally:
+            seats.close()
+            for writer in writers:
+                os.close(writer)
+
+
+class NumbersRelayTestCase(unittest.TestCase):
+
+    PORT = 55575
+    UPSTREAM_PORT = 55576
+
+    def setUp(self):
+        self.upstream = gevent.socket.socket(type=gevent.socket.SOCK_DGRAM)
+        self.upstream.bind(('127.0.0.1', self.UPSTREAM_PORT))
+        self.relay = relay.NumbersRelay(
+            self.PORT, ('127.0.0.1', self.UPSTREAM_PORT), interval=60,
+            max_datagram=100)
+        self.relay.start()
+        self.client = gevent.socket.socket(type=gevent.socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.relay.stop()
+        self.client.close()
+        self.upstream.close()
+
+    def _send(self, data):
+        self.client.sendto(data, ('127.0.0.1', self.PORT))
+
+    def _received(self):
+        "Return the records of the datagrams received upstream, by user."
+        records = {}
+        datagrams = 0
+        self.upstream.setblocking(False)
+        while True:
+            try:
+                data = self.upstream.recv(65536)
+            except gevent.socket.error:
+                break
+            datagrams += 1
+            records.update(protocol.decode(data))
+        return records, datagrams
+
+    def test_forward(self):
+        for i in range(20):
+            self._send(protocol.encode_single('user %s' % i, i))
+        # Last write wins.
+        self._send(protocol.encode_json_batch([('user 0', 5), ('moe', 1)]))
+        self._send('bad data')
+        gevent.sleep(0.1)
+        self.relay.forward()
+        gevent.sleep(0.1)
+        records, datagrams = self._received()
+        expected = dict(('user %s' % i, i) for i in range(20))
+        expected.update({'user 0': 5, 'moe': 1})
+        self.assertEqual(expected, records)
+        # Batched, but within max_datagram.
+        self.assertTrue(1 < datagrams < 21)
+
+    def test_forward_long_names(self):
+        self._send(protocol.encode_single('m' * 300, 7))
+        gevent.sleep(0.1)
+        self.relay.forward()
+        gevent.sleep(0.1)
+        self.assertEqual(({'m' * 300: 7}, 1), self._received())
+
+    def test_forward_bad_counts(self):
+        self._send(protocol.encode_json_batch([('moe', -5), ('larry', 1)]))
+        self._send(protocol.encode_single('curly', 2 ** 64))
+        self._send(protocol.encode_single('shemp', 3))
+        gevent.sleep(0.1)
+        # Out of range counts, and users not names, aggregated anyhow are
+        # not forwarded, but the other users are.
+        self.relay.manager.aggregate_user_data('moe', -5)
+        self.relay.manager.aggregate_user_data(None, 1)
+        self.relay.forward()
+        gevent.sleep(0.1)
+        self.assertEqual(({'shemp': 3}, 1), self._received())
+
+    def test_forward_nothing(self):
+        self.relay.forward()
+        gevent.sleep(0.1)
+        self.assertEqual(({}, 0), self._received())
+
+
+###############################################################################
+
+class MetricsTestCase(unittest.TestCase):
+
+    PORT = 55565
+
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = registry.counter('things_total', 'Things.')
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(3, counter.get().value)
+        self.assertIs(counter, registry.counter('things_total', 'Things.'))
+        self.assertEqual('# HELP things_total Things.\n'
+                         '# TYPE things_total counter\n'
+                         'things_total 3\n', registry.exposition())
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('size', 'Sizes.', label='kind',
+                                       buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.labels('a"b').observe(value)
+        self.assertEqual('# HELP size Sizes.\n'
+                         '# TYPE size histogram\n'
+                         'size_bucket{kind="a\\"b",le="1"} 2\n'
+                         'size_bucket{kind="a\\"b",le="10"} 3\n'
+                         'size_bucket{kind="a\\"b",le="+Inf"} 4\n'
+                         'size_sum{kind="a\\"b"} 56.5\n'
+                         'size_count{kind="a\\"b"} 4\n',
+                         registry.exposition())
+        self.assertRaises(ValueError, registry.counter, 'size', 'Sizes.')
+
+    def test_server_datagrams(self):
+        received = core.DATAGRAMS_RECEIVED.get().value
+        rejected = core.DATAGRAMS_REJECTED.get().value
+        server = core.NumbersServer(0, core.NumbersManager())
+        server.handle(protocol.encode_single('moe', 11), None)
+        server.handle('bad data', None)
+        self.assertEqual(received + 2, core.DATAGRAMS_RECEIVED.get().value)
+        self.assertEqual(rejected + 1, core.DATAGRAMS_REJECTED.get().value)
+
+    def test_pusher_ticks(self):
+        ticks = sum(core.TICK_USERS.get().counts)
+        pusher = core.NumbersPusher(core.NumbersManager(), 0.01)
+        pusher.add_upstream('metered', 'test')
+        pusher.manager.aggregate_user_data('moe', 1)
+        pusher._last_tick = 0
+        pusher._tick()
+        gevent.sleep(0)
+        self.assertEqual(ticks + 1, sum(core.TICK_USERS.get().counts))
+        self.assertEqual(1, sum(core.PUSH_SECONDS.get('metered').counts))
+        pusher.remove_upstream('metered')
+        self.assertIsNone(core.PUSH_SECONDS.get('metered'))
+
+    def _get(self, path):
+        "Return the status line and body of a GET to the metrics server."
+        sock = gevent.socket.create_connection(('127.0.0.1', self.PORT))
+        sock.sendall('GET %s HTTP/1.0\r\n\r\n' % path)
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        head, body = response.split('\r\n\r\n', 1)
+        return head.split('\r\n')[0], body
+
+    def test_endpoint(self):
+        registry = metrics.Registry()
+        registry.counter('things_total', 'Things.').inc()
+        server = metrics.MetricsServer(self.PORT, registry=registry)
+        server.start()
+        try:
+            status, body = self._get('/metrics')
+            self.assertIn('200', status)
+            self.assertIn('things_total 1\n', body)
+            status, _ = self._get('/')
+            self.assertIn('404', status)
+        finally:
+            server.stop()
+
+    def test_endpoint_routes(self):
+        def double(params):
+            return 2 * int(params['n'][0])
+        server = metrics.MetricsServer(self.PORT, routes={'/double': double})
+        server.start()
+        try:
+            status, body = self._get('/double?n=21')
+            self.assertIn('200', status)
+            self.assertEqual(42, json.loads(body))
+            status, body = self._get('/double?n=x')
+            self.assertIn('400', status)
+            self.assertIn('error', json.loads(body))
+        finally:
+            server.stop()
+
+
 ###############################################################################
 
 class ConfigManagerTestCase (unittest.TestCase):
@@ -295,6 +1895,37 @@ class ConfigManagerTestCase (unittest.TestCase):
         self.assertTrue(hasattr(testing_pusher, 'dummy_option'))
         self.assertEqual("1", testing_pusher.dummy_option)
 
+    def test_groups_config(self):
+        config = {
+            "upstreams": [{
+                "name": "teams",
+                "type": "test",
+                "options": {"level": "group", "group_stat": "max"}
+            }],
+            "groups": {"stooges": ["moe", "larry"]}
+        }
+        self.c.reconfigure(config)
+        self.assertEqual(['teams'], self.c._config.keys())
+        rollup = self.c.pusher.groups
+        self.assertEqual({'stooges': {'sum': 3, 'mean': 1.5, 'max': 2,
+                                      'users': 2}},
+                         rollup.rollup({'moe': 1, 'larry': 2}))
+        # Same groups, the rollup is kept.
+        self.c.reconfigure(config)
+        self.assertIs(rollup, self.c.pusher.groups)
+        self.c.reconfigure(config["upstreams"])
+        self.assertIsNone(self.c.pusher.groups)
+        self.assertRaises(ValueError, self.c.reconfigure,
+                          {"groups": {"stooges": "moe"}})
+
+    def test_bad_filter_config(self):
+        for options in ({"allow": "moe"}, {"deny_regex": "(moe"},
+                        {"sample": 2}, {"min_change": -1}):
+            config = [{"name": "testing", "type": "test",
+                       "options": options}]
+            self.assertRaises(ValueError, self.c.reconfigure, config)
+        self.assertEqual({}, self.c._config)
+
 
 class ConfigFileManagerTestCase (unittest.TestCase):
 
@@ -0,0 +1,166 @@
+"""Rolling windows of the values pushed for each user.
+
+The store keeps, per user, a ring buffer with the value of each of the last
+ticks (as many as the longest window holds), and for each window the
+statistics of the values in it: their sum, the candidates to be its peak (a
+deque of decreasing values) and a histogram. Each new value updates them, as
+does the value leaving each window, so no history is scanned.
+
+Ticks in which a user has no value count as zero. They are filled in lazily,
+when the user has a value again, or its statistics are asked for.
+
+Percentiles are approximated by the upper bound of the histogram bucket they
+fall in (see BUCKETS).
+"""
+from collections import deque
+from array import array
+import bisect
+
+# Default windows, as (name, seconds) pairs.
+DEFAULT_WINDOWS = (('1m', 60), ('5m', 300), ('1h', 3600))
+# Upper bounds of the histogram buckets, for percentiles.
+BUCKETS = (0, 10, 20, 40, 60, 80, 100, 150, 200, 250, 300, 400, 500, 750,
+           1000, 1500, 2000, 5000)
+PERCENTILES = (50, 90, 99)
+# Values are kept as unsigned shorts, larger ones are clamped.
+TYPECODE = 'H'
+MAX_VALUE = 0xFFFF
+
+
+class _Series (object):
+    "The ring buffer and window statistics of a user."
+
+    __slots__ = ('values', 'last', 'seen', 'sums', 'peaks', 'histograms')
+
+    def __init__(self, capacity, windows, tick):
+        self.values = array(TYPECODE, [0]) * capacity
+        # Tick of the last value, and number of values so far.
+        self.last = tick
+        self.seen = 0
+        self.sums = [0] * windows
+        # (tick, value) pairs, values decreasing, the first one the peak.
+        self.peaks = [deque() for _ in xrange(windows)]
+        self.histograms = [array('L', [0]) * (len(BUCKETS) + 1)
+                           for _ in xrange(windows)]
+
+
+###############################################################################
+
+class TimeSeriesStore (object):
+    "Rolling windows of values, by user, updated once per tick."
+
+    def __init__(self, interval, windows=DEFAULT_WINDOWS):
+        """Takes the tick interval (in seconds), and the windows as (name,
+        seconds) pairs.
+        """
+        self.names = [name for name, _ in windows]
+        # Window lengths, in ticks.
+        self._lengths = [max(1, int(round(seconds / float(interval))))
+                         for _, seconds in windows]
+        self._capacity = max(self._lengths)
+        self._series = {}
+        self.tick = 0
+
+    def __len__(self):
+        return len(self._series)
+
+    def add(self, packet):
+        "Record the values of a tick, as a user to value mapping."
+        self.tick += 1
+        tick, series = self.tick, self._series
+        for user, value in packet.iteritems():
+            user_series = series.get(user)
+            if user_series is None:
+                user_series = series[user] = _Series(
+                    self._capacity, len(self._lengths), tick - 1)
+            else:
+                self._fill(user_series, tick - 1)
+            self._record(user_series, tick, min(value, MAX_VALUE))
+        if tick % self._capacity == 0:
+            # Forget users without a value in any window.
+            idle = tick - self._capacity
+            for user in [user for user, user_series in series.iteritems()
+                         if user_series.last <= idle]:
+                del series[user]
+
+    def _record(self, series, tick, value):
+        "Add the value of a tick, the one after the last of the series."
+        values, capacity = series.values, self._capacity
+        position = tick % capacity
+        bucket = bisect.bisect_left(BUCKETS, value)
+        for i, length in enumerate(self._lengths):
+            histogram = series.histograms[i]
+            if series.seen >= length:
+                # The value of length ticks ago leaves the window.
+                leaving = values[(tick - length) % capacity]
+                series.sums[i] -= leaving
+                histogram[bisect.bisect_left(BUCKETS, leaving)] -= 1
+            series.sums[i] += value
+            histogram[bucket] += 1
+            peaks = series.peaks[i]
+            while peaks and peaks[-1][1] <= value:
+                peaks.pop()
+            peaks.append((tick, value))
+            if peaks[0][0] <= tick - length:
+                peaks.popleft()
+        values[position] = value
+        series.seen += 1
+        series.last = tick
+
+    def _fill(self, series, tick):
+        "Record zeros for the ticks after the last of a series, up to tick."
+        gap = tick - series.last
+        if gap <= 0:
+            return
+        if gap < self._capacity:
+            for missing in xrange(series.last + 1, tick + 1):
+                self._record(series, missing, 0)
+            return
+        # Every window holds zeros only.
+        series.values = array(TYPECODE, [0]) * self._capacity
+        series.seen += gap
+        zero = bisect.bisect_left(BUCKETS, 0)
+        for i, length in enumerate(self._lengths):
+            series.sums[i] = 0
+            series.peaks[i] = deque([(tick, 0)])
+            histogram = series.histograms[i]
+            histogram[:] = array('L', [0]) * len(histogram)
+            histogram[zero] = min(length, series.seen)
+        series.last = tick
+
+    def stats(self, user, names=None):
+        """Return the statistics of a user, as a mapping from window name to
+        its "mean", "peak" and percentiles ("p50", "p90", "p99"). Only the
+        windows in names are included, if given.
+
+        Windows only hold the ticks since the user had a value first. Return
+        None for unknown users.
+        """
+        series = self._series.get(user)
+        if series is None:
+            return None
+        self._fill(series, self.tick)
+        stats = {}
+        for i, name in enumerate(self.names):
+            if names is not None and name not in names:
+                continue
+            count = min(self._lengths[i], series.seen)
+            window = {'mean': series.sums[i] / float(count),
+                      'peak': series.peaks[i][0][1]}
+            histogram = series.histograms[i]
+            for percentile in PERCENTILES:
+                rank = count * percentile / 100.0
+                cumulative = 0
+                for bucket, bucket_count in enumerate(histogram):
+                    cumulative += bucket_count
+                    if cumulative >= rank:
+                        break
+                window['p%s' % percentile] = (BUCKETS[bucket]
+                                              if bucket < len(BUCKETS)
+                                              else MAX_VALUE)
+            stats[name] = window
+        return stats
+
+    def summary(self, users, names=None):
+        "Return the stats() of each of the users, by user."
+        return dict((user, self.stats(user, names)) for user in users)
@@ -0,0 +1,198 @@
+"""Ingest key counts with several forked worker processes.
+
+Each worker runs its own NumbersServer, all of them listening at the same port
+(SO_REUSEPORT), and aggregates the received counts locally. On every tick the
+pusher process asks each worker for its partial aggregate, through a socket
+pair, and feeds them to its own manager before computing the data packet.
+
+The counts of a client may land on several workers in a tick (clients sending
+each count from a new socket, thus a new source port, get spread across
+them), so the partial aggregates are merged keeping the highest count of each
+user, as counts only grow.
+"""
+from gevent import socket
+import gevent
+import marshal
+import signal
+import struct
+import os
+
+from core import NumbersManager, NumbersServer
+
+import logging
+
+_LENGTH = struct.Struct('!I')
+# Command sent to a worker to get (and drop) its partial aggregate.
+_FLUSH = 'F'
+
+
+def _recv_exactly(sock, size):
+    "Read exactly size bytes from sock. Raise EOFError if it gets closed."
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('connection closed.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+###############################################################################
+
+def merge(partials):
+    """Merge partial aggregates (user to count mappings) into one, keeping
+    the highest count of each user, whatever the order of the partials.
+    """
+    merged = {}
+    for partial in partials:
+        for user, count in partial.iteritems():
+            if count > merged.get(user, -1):
+                merged[user] = count
+    return merged
+
+
+class IngestWorkers (object):
+    "Fork worker processes receiving key counts at the same port."
+
+    logger = logging.getLogger('network.workers')
+
+    def __init__(self, port, workers, server_class=NumbersServer, timeout=1,
+                 **server_kwargs):
+        """Takes the port to listen at and the number of workers. Each worker
+        runs a server_class server, built with the other keyword arguments.
+
+        A worker not answering within timeout seconds (about a push interval)
+        is taken as stuck, and dropped.
+        """
+        self.port = port
+        self.workers = workers
+        self.timeout = timeout
+        self.server_class = server_class
+        self.server_kwargs = server_kwargs
+        # Parent side of the socket pair of each running worker, and its pid.
+        self._controls = []
+        self._pids = []
+
+    def start(self):
+        """Fork the workers.
+
+        Workers inherit every greenlet of the parent, so this should be
+        called before starting the pusher or any other service.
+        """
+        for _ in range(self.workers):
+            parent_end, child_end = socket.socketpair()
+            pid = gevent.fork()
+            if pid == 0:
+                parent_end.close()
+                for control in self._controls:
+                    control.close()
+                self._run_worker(child_end)
+            child_end.close()
+            parent_end.settimeout(self.timeout)
+            self._controls.append(parent_end)
+            self._pids.append(pid)
+        self.logger.info("Started %s ingest workers at *:%s"
+                         % (self.workers, self.port))
+
+    def stop(self):
+        "Stop the workers, waiting for them to finish."
+        # Workers exit as soon as their control socket gets closed.
+        for control in self._controls:
+            control.close()
+        for pid in self._pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._controls = []
+        self._pids = []
+
+    def collect(self):
+        """Return the partial aggregates of the workers, in worker order.
+
+        Each partial aggregate is a user to count mapping (see merge()). A
+        worker that can not be reached, or does not answer in time, is
+        dropped (and killed).
+        """
+        asked = []
+        for control, pid in zip(self._controls, self._pids):
+            try:
+                control.sendall(_FLUSH)
+            except socket.error:
+                self._drop(control, pid)
+            else:
+                asked.append((control, pid))
+        partials = []
+        for control, pid in asked:
+            try:
+                length, = _LENGTH.unpack(
+                    _recv_exactly(control, _LENGTH.size))
+                partials.append(marshal.loads(_recv_exactly(control, length)))
+            except (EOFError, socket.error):
+                self._drop(control, pid)
+        return partials
+
+    def _drop(self, control, pid):
+        self.logger.error("Ingest worker %s is gone, or stuck.", pid)
+        control.close()
+        self._controls.remove(control)
+        self._pids.remove(pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def _run_worker(self, control):
+        "Receive and aggregate counts until the control socket is closed."
+        manager = NumbersManager()
+        server = self.server_class(self.port, manager, reuse_port=True,
+                                   **self.server_kwargs)
+        server.start()
+        try:
+            while control.recv(1) == _FLUSH:
+                payload = marshal.dumps(manager.pop_aggregated())
+                control.sendall(_LENGTH.pack(len(payload)) + payload)
+        except (KeyboardInterrupt, socket.error):
+            pass
+        finally:
+            server.stop()
+            os._exit(0)
+
+
+class WorkersNumbersManager (object):
+    """Front a data manager with ingest workers.
+
+    Has the same interface as the manager: counts aggregated by the workers
+    are fed to it right before each data packet is computed.
+    """
+
+    def __init__(self, manager, workers):
+        """Takes a data manager and an IngestWorkers object."""
+        self.manager = manager
+        self.workers = workers
+
+    def _delegated(name):
+        def get(self):
+            return getattr(self.manager, name)
+
+        def set(self, value):
+            setattr(self.manager, name, value)
+        return property(get, set)
+
+    # Set by the pusher, but used by the fronted manager.
+    compute = _delegated('compute')
+    compute_batch = _delegated('compute_batch')
+    del _delegated
+
+    def aggregate_user_data(self, user, count):
+        self.manager.aggregate_user_data(user, count)
+
+    def aggregate_batch(self, records):
+        self.manager.aggregate_batch(records)
+
+    def get_data_packet(self):
+        self.manager.aggregate_batch(
+            merge(self.workers.collect()).iteritems())
+        return self.manager.get_data_packet()